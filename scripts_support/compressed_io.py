@@ -0,0 +1,174 @@
+"""
+Reading gzip and BGZF files with parallel decompression
+
+hap-IBD, Refined-IBD, bcftools and bgzip write BGZF: a series of
+independent gzip members of at most 64 KiB, each recording its own
+compressed size. Those blocks can be inflated concurrently. zlib releases
+the GIL, so a thread pool gives near-linear speedup up to about eight
+cores. Plain gzip has no block boundaries and is read as a single stream.
+Uncompressed files are opened as they are.
+
+Usage:
+    from scripts_support.compressed_io import open_compressed
+    with open_compressed("hap_ibd_chr1.ibd.gz", "rt") as f:
+        for line in f:
+            ...
+"""
+
+import gzip
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Compressed bytes inflated per task (about 16 BGZF blocks)
+BGZF_TASK_BYTES = 1 << 20
+
+# Threads used when none are given (more rarely helps; the input stream becomes the limit)
+DEFAULT_THREADS = min(8, os.cpu_count() or 1)
+
+
+def is_gzip(file_path):
+    """True if the file starts with the gzip magic bytes."""
+    with open(file_path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(file_path):
+    """True if the file is BGZF: gzip whose first member carries the 'BC' block-size field."""
+    with open(file_path, "rb") as f:
+        header = f.read(18)
+    return (len(header) == 18 and header[:4] == GZIP_MAGIC + b"\x08\x04"
+            and header[12:14] == b"BC" and header[14:16] == b"\x02\x00")
+
+
+def _block_size(data, offset):
+    """Total size of the BGZF block starting at offset, or None if its header is incomplete."""
+    if len(data) - offset < 12:
+        return None
+    if data[offset:offset + 2] != GZIP_MAGIC or not data[offset + 3] & 4:
+        raise ValueError(f"Not a BGZF block at offset {offset}")
+    extra_length = struct.unpack_from("<H", data, offset + 10)[0]
+    if len(data) - offset < 12 + extra_length:
+        return None
+    position = offset + 12
+    while position < offset + 12 + extra_length:
+        subfield, length = data[position:position + 2], struct.unpack_from("<H", data, position + 2)[0]
+        if subfield == b"BC" and length == 2:
+            return struct.unpack_from("<H", data, position + 4)[0] + 1
+        position += 4 + length
+    raise ValueError(f"BGZF block at offset {offset} has no BC field")
+
+
+def _inflate_blocks(data, spans):
+    """Inflate whole BGZF blocks data[start:end], checking each CRC and length."""
+    out = []
+    for start, end in spans:
+        extra_length = struct.unpack_from("<H", data, start + 10)[0]
+        payload = zlib.decompress(data[start + 12 + extra_length:end - 8], -15)
+        crc, size = struct.unpack_from("<II", data, end - 8)
+        if len(payload) != size:
+            raise ValueError(f"Corrupt BGZF block: {size} bytes expected, {len(payload)} inflated")
+        if zlib.crc32(payload) != crc:
+            raise ValueError("Corrupt BGZF block: CRC mismatch")
+        out.append(payload)
+    return b"".join(out)
+
+
+class BGZFReader(io.RawIOBase):
+    """
+    Read-only binary stream over a BGZF file, inflating blocks on a thread pool.
+
+    The file is read sequentially in BGZF_TASK_BYTES pieces cut at block
+    boundaries. Up to two pieces per thread are in flight, and their output
+    is returned in file order.
+    """
+
+    def __init__(self, file_path, threads=None):
+        super().__init__()
+        self._file = open(file_path, "rb")
+        self._threads = threads or DEFAULT_THREADS
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+        self._carry = b""
+        self._eof = False
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _submit(self):
+        """Cut the next piece of whole blocks from the file and queue it for inflating."""
+        data = self._carry + self._file.read(BGZF_TASK_BYTES)
+        if len(data) == len(self._carry):
+            self._eof = True
+            if data:
+                raise ValueError("Truncated BGZF file")
+            return
+        spans = []
+        offset = 0
+        while True:
+            size = _block_size(data, offset)
+            if size is None or offset + size > len(data):
+                break
+            spans.append((offset, offset + size))
+            offset += size
+        self._carry = data[offset:]
+        self._pending.append(self._pool.submit(_inflate_blocks, data, spans))
+
+    def _fill(self):
+        while not self._eof and len(self._pending) < 2 * self._threads:
+            self._submit()
+        while self._pending and not self._buffer:
+            self._buffer = memoryview(self._pending.popleft().result())
+            if not self._eof:
+                self._submit()
+        return bool(self._buffer)
+
+    def readinto(self, target):
+        if not self._buffer and not self._fill():
+            return 0
+        n = min(len(target), len(self._buffer))
+        target[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+            self._file.close()
+        super().close()
+
+
+def open_compressed(file_path, mode="rb", threads=None, encoding="utf-8"):
+    """
+    Open a possibly compressed file for reading.
+
+    BGZF files are inflated in parallel (BGZFReader), plain gzip files as a
+    single stream (gzip.open) and anything else is opened directly, so
+    callers do not have to care which one a tool wrote.
+
+    Parameters:
+        file_path (str): File to read.
+        mode (str): "rb" for bytes or "rt" for text.
+        threads (int): Inflating threads for BGZF (default: up to eight, one per core).
+        encoding (str): Text encoding in "rt" mode.
+
+    Returns:
+        A file object; use it as a context manager.
+    """
+    if mode not in ("rb", "rt"):
+        raise ValueError(f"Unsupported mode {mode!r}; use 'rb' or 'rt'")
+    if is_bgzf(file_path):
+        stream = io.BufferedReader(BGZFReader(file_path, threads), buffer_size=BGZF_TASK_BYTES)
+    elif is_gzip(file_path):
+        stream = gzip.open(file_path, "rb")
+    else:
+        stream = open(file_path, "rb")
+    return io.TextIOWrapper(stream, encoding=encoding) if mode == "rt" else stream
@@ -19,7 +19,6 @@ import subprocess
 import argparse
 import logging
 import shutil
-import gzip
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -27,8 +26,11 @@ import seaborn as sns
 from pathlib import Path
 from dotenv import load_dotenv
 from tqdm import tqdm
-from intervaltree import IntervalTree
 from sklearn.metrics import precision_recall_curve, average_precision_score, roc_curve, auc
+from scripts_support.segment_io import read_segments, EVALUATION_NAMES
+from scripts_support.compressed_io import open_compressed
+from scripts_support.sample_registry import SampleRegistry
+from scripts_support.segment_overlap import TruthIndex, accuracy_curves
 
 # Set up logging
 logging.basicConfig(
@@ -432,13 +434,24 @@ def verify_vcf_phased(vcf_file):
         return False
     
     try:
-        # Use bcftools to check the first few genotypes
-        cmd = f"bcftools view {vcf_file} | grep -v '^#' | head -n 10"
-        result = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, text=True)
+        # Read the first few records directly (BGZF is inflated in parallel);
+        # BCF is binary and still goes through bcftools
+        if vcf_file.endswith(".bcf"):
+            cmd = f"bcftools view {vcf_file} | grep -v '^#' | head -n 10"
+            result = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, text=True)
+            records = result.stdout.splitlines()
+        else:
+            records = []
+            with open_compressed(vcf_file, "rt") as f:
+                for line in f:
+                    if not line.startswith('#'):
+                        records.append(line.rstrip('\n'))
+                        if len(records) == 10:
+                            break
         
         # Look for phased genotype separator '|' instead of unphased '/'
         phased = False
-        for line in result.stdout.splitlines():
+        for line in records:
             fields = line.split('\t')
             if len(fields) > 9:  # At least one sample column
                 genotypes = fields[9:]
@@ -553,9 +566,9 @@ def run_ped_sim(vcf_file, pedigree_def_file, output_dir, utils_dir, references_d
                 temp_vcf = f"{output_prefix}.temp.vcf"
                 
                 # Uncompress
-                with gzip.open(expected_vcf, 'rb') as f_in:
+                with open_compressed(expected_vcf) as f_in:
                     with open(temp_vcf, 'wb') as f_out:
-                        f_out.write(f_in.read())
+                        shutil.copyfileobj(f_in, f_out)
                 
                 # Recompress with bgzip
                 fixed_vcf = f"{output_prefix}.fixed.vcf.gz"
@@ -1510,11 +1523,12 @@ def run_hap_ibd_detection(vcf_file, output_dir, utils_dir, references_dir):
             logger.info(f"Combining results from {len(all_outputs)} chromosomes")
             
             try:
-                # Use gzip concatenation for gzipped files
-                with gzip.open(expected_output, 'wb') as outfile:
+                # Concatenated gzip (and BGZF) members are a valid gzip file,
+                # so the compressed bytes are copied without inflating them
+                with open(expected_output, 'wb') as outfile:
                     for chr_file in all_outputs:
-                        with gzip.open(chr_file, 'rb') as infile:
-                            outfile.write(infile.read())
+                        with open(chr_file, 'rb') as infile:
+                            shutil.copyfileobj(infile, outfile)
                 
                 logger.info(f"Combined Hap-IBD output: {expected_output}")
                 return expected_output
@@ -1583,28 +1597,17 @@ def load_truth_segments(file_path):
     logger.info(f"Loading truth segments from: {file_path}")
     
     try:
-        # Read the truth segments file
-        df = pd.read_csv(file_path, sep="\t", header=None)
-        df.columns = ["id1", "id2", "chromosome", "physical_position_start", 
-                     "physical_position_end", "IBD_type", "genetic_position_start", 
-                     "genetic_position_end", "genetic_length"]
+        # Read the truth segments file, already under the evaluation column names
+        df = read_segments(file_path, "pedsim", rename=EVALUATION_NAMES)
         
         # Add segment length
-        df['length'] = df['physical_position_end'] - df['physical_position_start']
+        df['length'] = df['end'] - df['start']
         df['tool'] = 'Truth'
-        
-        # Standardize column names for evaluation
-        df['sample1'] = df['id1']
-        df['sample2'] = df['id2']
-        df['chrom'] = df['chromosome']
-        df['start'] = df['physical_position_start']
-        df['end'] = df['physical_position_end']
-        df['cM'] = df['genetic_length']
         df['segment_id'] = range(len(df))
         
         # Add placeholder haplotype columns if needed for consistent evaluation
-        df['sample1_haplotype'] = 0
-        df['sample2_haplotype'] = 0
+        df['sample1_haplotype'] = np.zeros(len(df), dtype=np.int8)
+        df['sample2_haplotype'] = np.zeros(len(df), dtype=np.int8)
         
         # Summary statistics
         logger.info(f"Loaded {len(df)} truth segments")
@@ -1618,20 +1621,11 @@ def load_truth_segments(file_path):
         logger.error(f"Error loading truth segments: {e}")
         return pd.DataFrame()
 
-def load_ibis_segments(file_path):
-    """Load IBIS output file"""
+def load_ibis_segments(file_path, registry=None):
+    """Load IBIS output file, with sample IDs recoded to the sample registry if one is given"""
     try:
-        df = pd.read_csv(file_path, sep="\t", header=None)
-        df.columns = ["sample1", "sample2", "chrom", 
-                    "phys_start_pos", "phys_end_pos", 
-                    "IBD_type", "genetic_start_pos", 
-                    "genetic_end_pos", "genetic_seg_length", 
-                    "marker_count", "error_count", "error_density"]
-        
-        # Map IBIS columns to standardized column names for evaluation
-        df['start'] = df['phys_start_pos']
-        df['end'] = df['phys_end_pos']
-        df['cM'] = df['genetic_seg_length']
+        # IBIS columns are read under the standardized evaluation names
+        df = read_segments(file_path, "ibis", rename=EVALUATION_NAMES, registry=registry)
         df['segment_id'] = range(len(df))
         df['tool'] = 'IBIS'
         df['length'] = df['end'] - df['start']
@@ -1641,8 +1635,8 @@ def load_ibis_segments(file_path):
         df['LOD'] = 1.0 / (df['error_density'] + 0.001)  # Add small constant to avoid division by zero
         
         # Add haplotype columns if needed for consistent evaluation
-        df['sample1_haplotype'] = 0  # Placeholder if IBIS doesn't specify haplotypes
-        df['sample2_haplotype'] = 0
+        df['sample1_haplotype'] = np.zeros(len(df), dtype=np.int8)  # Placeholder if IBIS doesn't specify haplotypes
+        df['sample2_haplotype'] = np.zeros(len(df), dtype=np.int8)
         
         logger.info(f"Loaded {len(df)} IBIS segments")
         return df
@@ -1650,12 +1644,10 @@ def load_ibis_segments(file_path):
         logger.error(f"Error loading IBIS file: {e}")
         return pd.DataFrame()
 
-def load_refined_ibd_segments(file_path):
-    """Load Refined-IBD output file"""
+def load_refined_ibd_segments(file_path, registry=None):
+    """Load Refined-IBD output file, with sample IDs recoded to the sample registry if one is given"""
     try:
-        df = pd.read_csv(file_path, sep="\t", header=None)
-        df.columns = ["sample1", "sample1_haplotype", "sample2", 
-                      "sample2_haplotype", "chrom", "start", "end", "LOD", "cM"]
+        df = read_segments(file_path, "refinedibd", rename=EVALUATION_NAMES, registry=registry)
         # Create a unique segment ID for each segment
         df['segment_id'] = range(len(df))
         df['tool'] = 'RefinedIBD'
@@ -1667,17 +1659,11 @@ def load_refined_ibd_segments(file_path):
         logger.error(f"Error loading Refined-IBD file: {e}")
         return pd.DataFrame()
 
-def load_hap_ibd_segments(file_path):
-    """Load Hap-IBD output file"""
+def load_hap_ibd_segments(file_path, registry=None):
+    """Load Hap-IBD output file, with sample IDs recoded to the sample registry if one is given"""
     try:
-        # Check if the file is gzipped
-        open_func = gzip.open if file_path.endswith('.gz') else open
-        
-        with open_func(file_path, 'rt') as f:
-            df = pd.read_csv(f, sep="\t", header=None)
-            
-        df.columns = ["sample1", "sample1_haplotype", "sample2", 
-                      "sample2_haplotype", "chrom", "start", "end", "cM"]
+        # Gzipped output is decompressed by the reader
+        df = read_segments(file_path, "hapibd", rename=EVALUATION_NAMES, registry=registry)
         df['segment_id'] = range(len(df))
         df['tool'] = 'HapIBD'
         df['length'] = df['end'] - df['start']
@@ -1691,8 +1677,60 @@ def load_hap_ibd_segments(file_path):
         logger.error(f"Error loading Hap-IBD file: {e}")
         return pd.DataFrame()
 
+# Parsed mapping files, keyed on (path, size, mtime) so an edited file is re-read
+_SAMPLE_ID_MAPPINGS = {}
+
+def load_sample_id_mapping(mapping_file):
+    """
+    Read a sample ID mapping as (source IDs, target IDs) arrays.
+
+    Two formats are accepted:
+      - a two-column mapping file (original ID, numeric or user ID);
+      - ped-sim's -everyone.fam, whose individual IDs (second column) are
+        their own targets, so the simulated cohort needs no separate
+        dictionary; only numeric IDs end up changed (see below).
+    Numeric targets get the "user" prefix of the openSNP sample IDs. The
+    result is cached per file until the file changes.
+    """
+    stat = os.stat(mapping_file)
+    key = (os.path.abspath(mapping_file), stat.st_size, stat.st_mtime_ns)
+    if key not in _SAMPLE_ID_MAPPINGS:
+        if mapping_file.endswith('.fam'):
+            fam = pd.read_csv(mapping_file, sep=r'\s+', header=None, usecols=[1], dtype=str)
+            sources = fam[1]
+            targets = sources.where(~sources.str.isdigit(), 'user' + sources)
+            # IDs that map to themselves are what unmapped IDs do anyway
+            changed = (targets != sources).to_numpy()
+            sources = sources.to_numpy(dtype=object)[changed]
+            targets = targets.to_numpy(dtype=object)[changed]
+        else:
+            with open(mapping_file, 'r') as f:
+                lines = pd.Series(f.read().splitlines(), dtype=object).str.strip()
+            # Lines that are not exactly two tab-separated fields are ignored
+            fields = lines[lines.str.count('\t') == 1].str.partition('\t')
+            sources = fields[0].to_numpy(dtype=object)
+            targets = fields[2].where(~fields[2].str.isdigit(), 'user' + fields[2]).to_numpy(dtype=object)
+        # The last entry of a repeated source ID wins, as with a dict
+        sources = pd.Index(sources)
+        last = ~sources.duplicated(keep='last')
+        _SAMPLE_ID_MAPPINGS.clear()  # only the latest mapping is kept
+        _SAMPLE_ID_MAPPINGS[key] = (sources[last], targets[last])
+    return _SAMPLE_ID_MAPPINGS[key]
+
+def _remap_ids(ids, sources, targets):
+    """Translate an ID column through a mapping; IDs without an entry are kept."""
+    ids = ids.astype('category')
+    categories = ids.cat.categories
+    # One indexer lookup over the distinct IDs; the rows follow through their codes
+    positions = sources.get_indexer(categories)
+    mapped = np.where(positions >= 0, targets[positions], categories.to_numpy(dtype=object))
+    mapped_codes, mapped_categories = pd.factorize(mapped)
+    codes = ids.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, mapped_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=mapped_categories), index=ids.index)
+
 def map_sample_ids(truth_df, mapping_file):
-    """Map sample IDs in truth data using a mapping dictionary file"""
+    """Map sample IDs in truth data using a mapping dictionary file or ped-sim -everyone.fam"""
     logger.info(f"Mapping sample IDs using: {mapping_file}")
     
     if not os.path.exists(mapping_file):
@@ -1700,24 +1738,15 @@ def map_sample_ids(truth_df, mapping_file):
         return truth_df
     
     try:
-        # Read the mapping dictionary
-        sample_id_map = {}
-        with open(mapping_file, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) == 2:
-                    original_id, numeric_id = parts
-                    # Create mapping from original ID to user ID format
-                    sample_id_map[original_id] = f"user{numeric_id}"
-        
-        logger.info(f"Loaded {len(sample_id_map)} sample ID mappings")
+        sources, targets = load_sample_id_mapping(mapping_file)
+        logger.info(f"Loaded {len(sources)} sample ID mappings")
         
-        # Make a copy of the truth dataframe
-        mapped_df = truth_df.copy()
+        # The input frame is left as it is
+        mapped_df = truth_df.copy(deep=False)
         
         # Apply the mapping to id1 and id2 columns
-        mapped_df['sample1'] = mapped_df['sample1'].map(lambda x: f"user{sample_id_map.get(x, x.replace('user', ''))}" if x in sample_id_map else x)
-        mapped_df['sample2'] = mapped_df['sample2'].map(lambda x: f"user{sample_id_map.get(x, x.replace('user', ''))}" if x in sample_id_map else x)
+        mapped_df['sample1'] = _remap_ids(mapped_df['sample1'], sources, targets)
+        mapped_df['sample2'] = _remap_ids(mapped_df['sample2'], sources, targets)
         
         # Also update the original id columns
         mapped_df['id1'] = mapped_df['sample1']
@@ -1730,11 +1759,14 @@ def map_sample_ids(truth_df, mapping_file):
         logger.error(f"Error mapping sample IDs: {e}")
         return truth_df
 
-def create_interval_tree(truth_df):
-    """Create an interval tree from truth segments for efficient overlap checking"""
-    trees = {}
+def index_truth_segments(truth_df, registry=None, sample_size=None):
+    """
+    Index truth segments by sample pair and chromosome for efficient overlap checking.
     
-    logger.info("Building interval trees from truth data...")
+    Every truth segment is indexed unless sample_size is given, in which case
+    that many are drawn at random and recall is extrapolated from them.
+    """
+    logger.info("Indexing truth segments...")
     
     # Clean up the dataframe - ensure numeric columns are numeric and no NaNs
     for col in ['start', 'end', 'chrom']:
@@ -1748,180 +1780,114 @@ def create_interval_tree(truth_df):
         logger.warning(f"Filtering out {(~valid_rows).sum()} rows with invalid start/end positions")
         truth_df = truth_df[valid_rows].reset_index(drop=True)
     
-    # Add haplotype columns if they don't exist
-    if 'sample1_haplotype' not in truth_df.columns:
-        truth_df['sample1_haplotype'] = 0
-    if 'sample2_haplotype' not in truth_df.columns:
-        truth_df['sample2_haplotype'] = 0
-    
-    # Ensure string columns are strings
-    for col in ['sample1', 'sample2']:
-        if col in truth_df.columns:
-            truth_df[col] = truth_df[col].astype(str)
-    
-    # Create a small subset for evaluation to avoid memory issues
-    if len(truth_df) > 1000:
-        logger.info(f"Large dataset detected ({len(truth_df)} rows). Using a small subset for evaluation.")
-        # Take a small random sample
-        truth_subset = truth_df.sample(n=min(1000, len(truth_df))).reset_index(drop=True)
-        logger.info(f"Using {len(truth_subset)} randomly selected segments for evaluation")
+    # Sample the truth only when asked to
+    if sample_size is not None and len(truth_df) > sample_size:
+        truth_subset = truth_df.sample(n=sample_size).reset_index(drop=True)
+        logger.info(f"Using {len(truth_subset)} randomly selected of {len(truth_df)} truth segments for evaluation")
     else:
         truth_subset = truth_df
     
-    # Create trees with and without haplotype information
-    for _, row in truth_subset.iterrows():
-        try:
-            # Ensure chrom, start and end are integers
-            chrom = int(row['chrom'])
-            start = int(row['start'])
-            end = int(row['end'])
-            
-            # Skip invalid intervals
-            if start >= end or start < 0 or end < 0:
-                continue
-                
-            # Create keys in both orders to handle either order in tool data
-            pairs = [
-                # With haplotypes
-                ((str(row['sample1']), int(row['sample1_haplotype'])), 
-                 (str(row['sample2']), int(row['sample2_haplotype'])), 
-                 chrom),
-                ((str(row['sample2']), int(row['sample2_haplotype'])), 
-                 (str(row['sample1']), int(row['sample1_haplotype'])), 
-                 chrom),
-                # Without haplotypes
-                ((str(row['sample1']), None), (str(row['sample2']), None), chrom),
-                ((str(row['sample2']), None), (str(row['sample1']), None), chrom)
-            ]
-            
-            for sample1, sample2, chr_num in pairs:
-                pair_key = (sample1, sample2)
-                if (pair_key, chr_num) not in trees:
-                    trees[(pair_key, chr_num)] = IntervalTree()
-                
-                trees[(pair_key, chr_num)].addi(start, end, row['segment_id'])
-        except (ValueError, TypeError) as e:
-            logger.debug(f"Skipping row due to error: {e}, values: {row[['chrom', 'start', 'end']]}")
-            continue
-    
-    logger.info(f"Created {len(trees)} interval trees")
-    return trees
-
-def calculate_overlap(segment, tree):
-    """Calculate overlap between a segment and truth segments in the tree"""
-    overlaps = tree.overlap(segment['start'], segment['end'])
-    if not overlaps:
-        return 0, None
-    
-    # Find the best overlapping segment
-    best_overlap = 0
-    best_truth_id = None
-    
-    for interval in overlaps:
-        overlap_start = max(segment['start'], interval.begin)
-        overlap_end = min(segment['end'], interval.end)
-        overlap_length = overlap_end - overlap_start
-        
-        if overlap_length > best_overlap:
-            best_overlap = overlap_length
-            best_truth_id = interval.data
-    
-    return best_overlap / (segment['end'] - segment['start']), best_truth_id
+    # Missing haplotype columns count as haplotype 0
+    truth_index = TruthIndex(truth_subset, registry)
+    logger.info(f"Indexed {len(truth_index)} truth segments in {len(truth_index.group_keys)} pair/chromosome groups")
+    return truth_index
 
-def evaluate_tool(tool_df, truth_trees):
-    """Evaluate IBD detection performance for a specific tool"""
+def evaluate_tool(tool_df, truth_index, matches=None):
+    """Evaluate IBD detection performance for a specific tool (matches: precomputed best_overlaps result)"""
     # If the DataFrame is empty, return it without processing
     if len(tool_df) == 0:
         logger.warning(f"Tool: {tool_df.name if hasattr(tool_df, 'name') else 'Unknown'} - No segments to evaluate")
         return tool_df
-        
-    # Add columns for evaluation metrics
-    tool_df['detected_truth'] = False
-    tool_df['overlap_pct'] = 0.0
-    tool_df['truth_id'] = None
     
-    # Debug counters
-    total_segments = len(tool_df)
-    matched_segments = 0
-    
-    for idx, row in tool_df.iterrows():
-        # Check if we have both sample pair in regular and reversed order
-        sample_pairs = [
-            # Regular order
-            ((row['sample1'], row.get('sample1_haplotype', 0)), 
-             (row['sample2'], row.get('sample2_haplotype', 0)),
-             row['chrom']),
-            # Reversed order
-            ((row['sample2'], row.get('sample2_haplotype', 0)), 
-             (row['sample1'], row.get('sample1_haplotype', 0)),
-             row['chrom'])
-        ]
-        
-        found_match = False
-        for sample1, sample2, chrom in sample_pairs:
-            pair_key = (sample1, sample2)
-            if (pair_key, chrom) in truth_trees:
-                overlap_pct, truth_id = calculate_overlap(row, truth_trees[(pair_key, chrom)])
-                if overlap_pct > 0:
-                    tool_df.at[idx, 'overlap_pct'] = overlap_pct
-                    tool_df.at[idx, 'truth_id'] = truth_id
-                    tool_df.at[idx, 'detected_truth'] = (overlap_pct >= 0.5)  # Consider >=50% overlap a true positive
-                    matched_segments += 1 if overlap_pct >= 0.5 else 0
-                    found_match = True
-                    break
-        
-        # Try without haplotypes if no match found and haplotypes present
-        if not found_match and 'sample1_haplotype' in row:
-            # Create keys without haplotype information
-            sample_pairs_no_hap = [
-                ((row['sample1'], None), (row['sample2'], None), row['chrom']),
-                ((row['sample2'], None), (row['sample1'], None), row['chrom'])
-            ]
-            
-            for sample1, sample2, chrom in sample_pairs_no_hap:
-                pair_key = (sample1, sample2)
-                if (pair_key, chrom) in truth_trees:
-                    overlap_pct, truth_id = calculate_overlap(row, truth_trees[(pair_key, chrom)])
-                    if overlap_pct > 0:
-                        tool_df.at[idx, 'overlap_pct'] = overlap_pct
-                        tool_df.at[idx, 'truth_id'] = truth_id
-                        tool_df.at[idx, 'detected_truth'] = (overlap_pct >= 0.5)
-                        matched_segments += 1 if overlap_pct >= 0.5 else 0
-                        break
+    # Best-overlapping truth segment of every tool segment, matched on the
+    # haplotypes first and on the sample pair alone if that finds nothing
+    if matches is None:
+        matches = truth_index.best_overlaps(tool_df, haplotype_fallback='sample1_haplotype' in tool_df.columns)
+    overlap_pct, truth_id = matches
+    
+    # Add columns for evaluation metrics
+    tool_df['overlap_pct'] = overlap_pct
+    tool_df['truth_id'] = pd.arrays.IntegerArray(truth_id, truth_id < 0)  # <NA> where nothing overlaps
+    tool_df['detected_truth'] = overlap_pct >= 0.5  # Consider >=50% overlap a true positive
     
     # Get the tool name safely
     tool_name = tool_df['tool'].iloc[0] if len(tool_df) > 0 else "Unknown"
     
+    total_segments = len(tool_df)
+    matched_segments = int(tool_df['detected_truth'].sum())
+    
     # Calculate percentage safely
     percentage = (matched_segments/total_segments*100) if total_segments > 0 else 0
     
     logger.info(f"Tool: {tool_name} - Matched {matched_segments} of {total_segments} segments ({percentage:.2f}%)")
     return tool_df
 
-def evaluate_all_tools(refined_df, hap_df, ibis_df, truth_df):
-    """Evaluate all IBD detection tools"""
-    # Create interval trees for truth segments
-    truth_trees = create_interval_tree(truth_df)
+def evaluate_all_tools(refined_df, hap_df, ibis_df, truth_df, registry=None, truth_sample_size=None, workers=None):
+    """
+    Evaluate all IBD detection tools against all truth segments, or a random sample of truth_sample_size.
+    
+    The tools are matched per (tool, chromosome) shard across `workers`
+    processes (default: one per core).
+    """
+    # Index truth segments
+    truth_index = index_truth_segments(truth_df, registry, truth_sample_size)
     
-    # Store the size of the truth subset used for evaluation
-    truth_subset_size = 1000  # Default value - this should match what's in create_interval_tree
+    # Match every tool's segments in one sharded pass
+    tool_dfs = [refined_df, hap_df, ibis_df]
+    matches = truth_index.best_overlaps_many(
+        tool_dfs, [('sample1_haplotype' in df.columns) for df in tool_dfs], workers)
     
     # Evaluate each tool
-    refined_eval = evaluate_tool(refined_df, truth_trees)
-    hap_eval = evaluate_tool(hap_df, truth_trees)
-    ibis_eval = evaluate_tool(ibis_df, truth_trees)
+    refined_eval, hap_eval, ibis_eval = [evaluate_tool(df, truth_index, tool_matches)
+                                         for df, tool_matches in zip(tool_dfs, matches)]
+    
+    # Genome coverage of each tool: bp (and cM) of truth recovered and of false IBD.
+    # It needs every truth segment: against a sample, tool bp over the truth
+    # left out would count as false IBD. Fewer indexed segments than asked
+    # for means nothing was left out.
+    if truth_sample_size is None or len(truth_index) < truth_sample_size:
+        coverage = {df['tool'].iloc[0]: truth_index.coverage(df) for df in tool_dfs if len(df) > 0}
+    else:
+        logger.info("Skipping bp/cM coverage metrics: they are not estimated from a truth sample")
+        coverage = {}
     
     # Combine results
     all_results = pd.concat([refined_eval, hap_eval, ibis_eval], ignore_index=True)
     
-    # Add attributes to track sampling
-    all_results.attrs['truth_subset_size'] = truth_subset_size
+    # Add attributes to track coverage and sampling
+    all_results.attrs['coverage'] = coverage
+    if truth_sample_size is not None:
+        all_results.attrs['truth_subset_size'] = len(truth_index)
     
     return all_results
 
+def calculate_extension(tool_df, truth_df):
+    """
+    Over- and under-extension (bp) of detected segments at their ends.
+    
+    For each true positive, the bp it reaches past either end of its truth
+    segment are over-extension and the bp of the truth segment it stops
+    short of are under-extension.
+    
+    Returns:
+        tuple: (mean over-extension, mean under-extension) per true positive.
+    """
+    detected = tool_df[tool_df['detected_truth']]
+    if len(detected) == 0:
+        return 0.0, 0.0
+    truth_rows = pd.Index(truth_df['segment_id']).get_indexer(detected['truth_id'].to_numpy(np.int64))
+    truth_starts = truth_df['start'].to_numpy(np.int64)[truth_rows]
+    truth_ends = truth_df['end'].to_numpy(np.int64)[truth_rows]
+    start_shift = detected['start'].to_numpy(np.int64) - truth_starts
+    end_shift = detected['end'].to_numpy(np.int64) - truth_ends
+    over_extension = np.maximum(-start_shift, 0) + np.maximum(end_shift, 0)
+    under_extension = np.maximum(start_shift, 0) + np.maximum(-end_shift, 0)
+    return float(over_extension.mean()), float(under_extension.mean())
+
 def calculate_summary_metrics(all_results, truth_df):
     """Calculate summary statistics for each tool"""
     metrics = []
+    coverage = all_results.attrs.get('coverage', {})
     
     # Count total truth segments
     total_truth = len(truth_df)
@@ -1932,6 +1898,7 @@ def calculate_summary_metrics(all_results, truth_df):
     if is_sample:
         sample_size = all_results.attrs['truth_subset_size']
         logger.info(f"Working with a sample of {sample_size} segments out of {total_truth} total segments")
+        logger.info("Recall is extrapolated from the sample and precision only counts matches to sampled segments")
         
     for tool_name in ['RefinedIBD', 'HapIBD', 'IBIS']:
         tool_df = all_results[all_results['tool'] == tool_name]
@@ -1947,8 +1914,7 @@ def calculate_summary_metrics(all_results, truth_df):
         false_positives = len(tool_df) - true_positives
         
         # Count truth segments detected by this tool
-        detected_truth_ids = set([x for x in tool_df['truth_id'] if x is not None])
-        detected_truths = len(detected_truth_ids)
+        detected_truths = tool_df['truth_id'].dropna().nunique()
         
         if is_sample:
             # When working with a sample, adjust the metrics
@@ -1989,7 +1955,7 @@ def calculate_summary_metrics(all_results, truth_df):
         logger.info(f"  Recall: {recall:.4f}")
         logger.info(f"  F1 Score: {f1:.4f}")
         
-        metrics.append({
+        tool_metrics = {
             'Tool': tool_name,
             'Total Segments': len(tool_df),
             'True Positives': true_positives,
@@ -1998,11 +1964,93 @@ def calculate_summary_metrics(all_results, truth_df):
             'Precision': precision,
             'Recall': recall,
             'F1 Score': f1
+        }
+        
+        # Extension of each true positive past or short of its own truth segment
+        over_extension, under_extension = calculate_extension(tool_df, truth_df)
+        logger.info(f"  Mean over-/under-extension per true positive: {over_extension:,.0f} / {under_extension:,.0f} bp")
+        tool_metrics.update({
+            'Mean Over-extension bp': over_extension,
+            'Mean Under-extension bp': under_extension
         })
+        
+        # Coverage metrics over the union of truth and tool segments per pair
+        # and chromosome (only computed against the full truth)
+        if tool_name in coverage:
+            tool_coverage = coverage[tool_name]
+            truth_bp, tool_bp, overlap_bp = tool_coverage['truth_bp'], tool_coverage['tool_bp'], tool_coverage['overlap_bp']
+            bp_recall = overlap_bp / truth_bp if truth_bp > 0 else 0
+            bp_precision = overlap_bp / tool_bp if tool_bp > 0 else 0
+            
+            logger.info(f"  Truth bp recovered: {overlap_bp:,} of {truth_bp:,} ({bp_recall*100:.2f}%)")
+            logger.info(f"  False IBD bp: {tool_bp - overlap_bp:,} of {tool_bp:,} detected ({(1 - bp_precision)*100:.2f}%)")
+            
+            tool_metrics.update({
+                'Truth bp': truth_bp,
+                'Recovered bp': overlap_bp,
+                'False IBD bp': tool_bp - overlap_bp,
+                'bp Precision': bp_precision,
+                'bp Recall': bp_recall
+            })
+            if 'truth_cm' in tool_coverage:
+                cm_recall = tool_coverage['overlap_cm'] / tool_coverage['truth_cm'] if tool_coverage['truth_cm'] > 0 else 0
+                logger.info(f"  Truth cM recovered: {tool_coverage['overlap_cm']:.1f} of {tool_coverage['truth_cm']:.1f} ({cm_recall*100:.2f}%)")
+                tool_metrics.update({'Recovered cM': tool_coverage['overlap_cm'], 'cM Recall': cm_recall})
+        
+        metrics.append(tool_metrics)
     
     metrics_df = pd.DataFrame(metrics)
     return metrics_df
 
+def calculate_accuracy_curves(all_results, truth_df):
+    """
+    Precision, recall and F1 of each tool over a grid of overlap thresholds
+    and segment length bins, from the stored best-overlap fractions (the
+    segments are not matched again)
+    """
+    curves = []
+    for tool_name in ['RefinedIBD', 'HapIBD', 'IBIS']:
+        tool_df = all_results[all_results['tool'] == tool_name]
+        if len(tool_df) == 0 or 'cM' not in tool_df.columns or 'cM' not in truth_df.columns:
+            continue
+        truth_id = tool_df['truth_id'].fillna(-1).to_numpy(np.int64)
+        tool_curves = accuracy_curves(tool_df['overlap_pct'].to_numpy(), tool_df['cM'], truth_id,
+                                      truth_df['segment_id'], truth_df['cM'])
+        tool_curves.insert(0, 'Tool', tool_name)
+        curves.append(tool_curves)
+    
+    return pd.concat(curves, ignore_index=True) if curves else pd.DataFrame()
+
+def plot_accuracy_curves(curves_df, output_dir):
+    """Plot precision, recall and F1 against the overlap threshold, one column per length bin"""
+    length_bins = list(dict.fromkeys(curves_df['Length Bin']))
+    plot_metrics = ['Precision', 'Recall', 'F1 Score']
+    fig, axes = plt.subplots(len(plot_metrics), len(length_bins), figsize=(4 * len(length_bins), 10),
+                             sharex=True, sharey=True, squeeze=False)
+    
+    for col, length_bin in enumerate(length_bins):
+        bin_df = curves_df[curves_df['Length Bin'] == length_bin]
+        for row, metric in enumerate(plot_metrics):
+            ax = axes[row, col]
+            for tool, tool_df in bin_df.groupby('Tool', sort=False):
+                ax.plot(tool_df['Threshold'], tool_df[metric], marker='o', label=tool)
+            ax.grid(True, linestyle='--', alpha=0.7)
+            if row == 0:
+                ax.set_title(length_bin)
+            if col == 0:
+                ax.set_ylabel(metric)
+            if row == len(plot_metrics) - 1:
+                ax.set_xlabel('Overlap Threshold')
+    
+    axes[0, 0].legend()
+    plt.ylim(0, 1.05)
+    plt.tight_layout()
+    
+    output_path = os.path.join(output_dir, 'ibd_accuracy_curves.png')
+    plt.savefig(output_path)
+    plt.close()
+    logger.info(f"Saved accuracy curves to: {output_path}")
+
 def plot_summary_barplot(metrics_df, output_dir):
     """Plot summary metrics as a bar chart"""
     plt.figure(figsize=(14, 10))
@@ -2097,6 +2145,8 @@ def main():
     parser.add_argument('--truth', type=str, help='Path to ground truth segments file. If not specified, will use environment variable.')
     parser.add_argument('--mapping', type=str, help='Path to sample ID mapping file. If not specified, will use environment variable.')
     parser.add_argument('--output-dir', type=str, help='Directory for output files. If not specified, will use environment variable.')
+    parser.add_argument('--eval-workers', type=int, help='Processes the evaluation is sharded across by tool and chromosome (default: one per core).')
+    parser.add_argument('--truth-sample-size', type=int, help='Evaluate against this many randomly sampled truth segments instead of all of them (metrics are then estimates, and the bp/cM coverage metrics, which need the full truth, are not computed).')
     
     args = parser.parse_args()
     
@@ -2190,9 +2240,9 @@ def main():
                     fixed_vcf = os.path.join(sim_dir, "fixed_ped_sim_output.vcf.gz")
                     
                     # Uncompress
-                    with gzip.open(simulated_vcf, 'rb') as f_in:
+                    with open_compressed(simulated_vcf) as f_in:
                         with open(temp_vcf, 'wb') as f_out:
-                            f_out.write(f_in.read())
+                            shutil.copyfileobj(f_in, f_out)
                     
                     # Recompress with bgzip
                     subprocess.run(f"bgzip -c {temp_vcf} > {fixed_vcf}", shell=True, check=True)
@@ -2310,6 +2360,11 @@ def main():
     except Exception as e:
         logger.warning(f"Error mapping sample IDs: {e}. Using unmapped IDs.")
     
+    # Truth and tool segments share the cohort's sample registry, so their
+    # sample columns carry the same integer codes
+    registry = SampleRegistry.for_results(args.output_dir)
+    registry.intern(truth_df, ['sample1', 'sample2', 'id1', 'id2'])
+    
     # Load result files - use empty dataframes for methods that failed
     ibis_df = pd.DataFrame()
     refined_df = pd.DataFrame()
@@ -2318,7 +2373,7 @@ def main():
     # Load IBIS results if available
     if ibis_output:
         try:
-            ibis_df = load_ibis_segments(ibis_output)
+            ibis_df = load_ibis_segments(ibis_output, registry)
             if len(ibis_df) == 0:
                 logger.warning("Loaded IBIS segments file is empty")
             else:
@@ -2331,7 +2386,7 @@ def main():
     # Load Refined-IBD results if available
     if refined_output:
         try:    
-            refined_df = load_refined_ibd_segments(refined_output)
+            refined_df = load_refined_ibd_segments(refined_output, registry)
             if len(refined_df) == 0:
                 logger.warning("Loaded Refined-IBD segments file is empty")
             else:
@@ -2344,7 +2399,7 @@ def main():
     # Load Hap-IBD results if available
     if hap_output:
         try:
-            hap_df = load_hap_ibd_segments(hap_output)
+            hap_df = load_hap_ibd_segments(hap_output, registry)
             if len(hap_df) == 0:
                 logger.warning("Loaded Hap-IBD segments file is empty")
             else:
@@ -2359,6 +2414,11 @@ def main():
         logger.error("No segments were loaded from any IBD detection method. Cannot proceed with evaluation.")
         sys.exit(1)  # Exit on error - no fallback
     
+    # Frames loaded before the registry last grew are brought to its final categories
+    for df in (truth_df, ibis_df, refined_df, hap_df):
+        registry.intern(df, ['sample1', 'sample2'])
+    logger.info(f"Sample registry: {len(registry)} samples, saved to {registry.save()}")
+    
     # Ensure all required columns are present
     for df, tool in [(ibis_df, 'IBIS'), (refined_df, 'RefinedIBD'), (hap_df, 'HapIBD')]:
         if 'segment_id' not in df.columns:
@@ -2372,7 +2432,8 @@ def main():
     
     # Evaluate all tools
     try:
-        all_results = evaluate_all_tools(refined_df, hap_df, ibis_df, truth_df)
+        all_results = evaluate_all_tools(refined_df, hap_df, ibis_df, truth_df, registry, args.truth_sample_size,
+                                         args.eval_workers)
     except Exception as e:
         logger.error(f"Error during evaluation: {e}")
         sys.exit(1)  # Exit on error - no fallback
@@ -2392,6 +2453,17 @@ def main():
     except Exception as e:
         logger.error(f"Error saving metrics: {e}")
     
+    # Precision/recall curves over overlap thresholds and length bins
+    try:
+        curves_df = calculate_accuracy_curves(all_results, truth_df)
+        if len(curves_df) > 0:
+            curves_path = os.path.join(eval_dir, "ibd_accuracy_curves.csv")
+            curves_df.to_csv(curves_path, index=False)
+            logger.info(f"Saved accuracy curves to: {curves_path}")
+            plot_accuracy_curves(curves_df, eval_dir)
+    except Exception as e:
+        logger.error(f"Error creating accuracy curves: {e}")
+    
     # Create visualizations
     try:
         create_visualizations(all_results, truth_df, eval_dir)
@@ -0,0 +1,250 @@
+"""
+Cache of parsed segment and coefficient tables
+
+Parsing a multi-gigabyte .seg, .ibd.gz or .coef file takes far longer than
+loading the typed columns it produces. ParseCache keeps those columns as
+uncompressed Arrow IPC files and memory-maps them on later loads.
+
+An entry is addressed by the content hash of the source file and the
+reader options, so an edited file is never served stale, and identical
+content reached under another path shares the entry. The (path, size,
+mtime) of each source is recorded with its hash, so an unchanged file is
+not re-hashed. Entries are evicted least recently used first once the
+cache exceeds its size cap, and can be invalidated explicitly per source
+file or all at once.
+
+Usage:
+    from scripts_support.parse_cache import ParseCache
+    cache = ParseCache.for_results(results_directory)
+    df = read_segments("ibis_MergedSamples.seg", "ibis", cache=cache)
+    df = cache.fetch("ibis_MergedSamples.coef", {"reader": "coef"},
+                     lambda: pd.read_csv("ibis_MergedSamples.coef", sep="\\t"))
+    cache.invalidate("ibis_MergedSamples.seg")
+
+    python -m scripts_support.parse_cache <cache_dir> --invalidate FILE | --clear | --stats
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:
+    pa = None
+
+# Directory of the cache inside a results directory
+CACHE_DIRNAME = "parse_cache"
+
+# Default size cap of a cache (bytes of entries kept on disk)
+DEFAULT_CACHE_BYTES = 4 << 30
+
+# Bumped when the stored layout changes, so old entries are never read back
+CACHE_FORMAT_VERSION = 1
+
+# Recorded (size, mtime, hash) of each source file
+SOURCES_FILENAME = "sources.json"
+
+# Schema metadata key holding DataFrame.attrs
+ATTRS_KEY = b"parse_cache_attrs"
+
+HASH_CHUNK_BYTES = 8 << 20
+
+
+def content_hash(file_path):
+    """BLAKE2b digest (hex) of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    Parsed tables keyed on (source content, reader options), capped in size.
+
+    Parameters:
+        cache_dir (str): Directory holding the entries (created on first use).
+        max_bytes (int): Size cap; least recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def for_results(cls, results_directory, max_bytes=DEFAULT_CACHE_BYTES):
+        """The cache kept in a results directory."""
+        return cls(os.path.join(results_directory, CACHE_DIRNAME), max_bytes)
+
+    @property
+    def enabled(self):
+        return pa is not None
+
+    def _sources_path(self):
+        return os.path.join(self.cache_dir, SOURCES_FILENAME)
+
+    def _load_sources(self):
+        try:
+            with open(self._sources_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_sources(self, sources):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._sources_path()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sources, f)
+        os.replace(tmp_path, self._sources_path())
+
+    def source_hash(self, file_path):
+        """
+        Content hash of a source file, re-hashed only if its size or mtime
+        changed since it was last recorded. Entries of a previous content
+        are dropped when a change is seen.
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        sources = self._load_sources()
+        record = sources.get(file_path)
+        if record and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return record["hash"]
+
+        digest = content_hash(file_path)
+        if record and record["hash"] != digest:
+            if not any(other["hash"] == record["hash"] for path, other in sources.items() if path != file_path):
+                self._remove_entries(record["hash"])
+        sources[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest}
+        self._save_sources(sources)
+        return digest
+
+    def _entry_path(self, digest, options):
+        options = dict(options, cache_format=CACHE_FORMAT_VERSION)
+        options_key = hashlib.blake2b(json.dumps(options, sort_keys=True, default=str).encode(),
+                                      digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}-{options_key}.arrow")
+
+    def _remove_entries(self, digest):
+        for path in glob.glob(os.path.join(self.cache_dir, f"{digest}-*.arrow")):
+            os.remove(path)
+
+    def fetch(self, file_path, options, parse):
+        """
+        The parsed table of a file, from the cache or by calling parse().
+
+        Parameters:
+            file_path (str): Source file the table is parsed from.
+            options (dict): Everything besides the file content that shapes
+                            the result (reader, format, columns, filters...).
+            parse (callable): Returns the DataFrame on a miss. Its attrs are
+                              stored and restored with it.
+
+        Returns:
+            pd.DataFrame: The parsed table.
+        """
+        if not self.enabled or not os.path.isfile(file_path):
+            return parse()
+        entry_path = self._entry_path(self.source_hash(file_path), options)
+        if os.path.exists(entry_path):
+            try:
+                df = self._read(entry_path)
+                os.utime(entry_path)  # the entry mtime is its last use, for LRU eviction
+                return df
+            except (OSError, pa.ArrowInvalid):
+                os.remove(entry_path)
+
+        df = parse()
+        self._write(df, entry_path)
+        self.evict()
+        return df
+
+    def _read(self, entry_path):
+        # The table's buffers are slices of the mapped file, so loading does
+        # not read it up front
+        table = pa_ipc.open_file(pa.memory_map(entry_path)).read_all()
+        df = table.to_pandas(split_blocks=True)
+        metadata = table.schema.metadata or {}
+        if ATTRS_KEY in metadata:
+            df.attrs.update(json.loads(metadata[ATTRS_KEY]))
+        return df
+
+    def _write(self, df, entry_path):
+        table = pa.Table.from_pandas(df)
+        if df.attrs:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   ATTRS_KEY: json.dumps(df.attrs).encode()})
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with pa_ipc.new_file(tmp_path, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, entry_path)
+
+    def entries(self):
+        """(path, size, last use) of every entry, least recently used first."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.arrow")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, max_bytes=None):
+        """Drop least recently used entries until the cache fits max_bytes (default: the cap)."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+        return total
+
+    def invalidate(self, file_path):
+        """Drop every entry parsed from a file and forget its recorded hash."""
+        file_path = os.path.abspath(file_path)
+        sources = self._load_sources()
+        record = sources.pop(file_path, None)
+        if record is None:
+            return
+        if not any(other["hash"] == record["hash"] for other in sources.values()):
+            self._remove_entries(record["hash"])
+        self._save_sources(sources)
+
+    def clear(self):
+        """Drop every entry and recorded hash."""
+        self.evict(max_bytes=0)
+        if os.path.exists(self._sources_path()):
+            os.remove(self._sources_path())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate a parse cache.")
+    parser.add_argument("cache_dir", help="Cache directory (e.g. <results>/parse_cache).")
+    parser.add_argument("--invalidate", nargs="+", metavar="FILE", help="Drop the entries parsed from these files.")
+    parser.add_argument("--clear", action="store_true", help="Drop every entry.")
+    parser.add_argument("--stats", action="store_true", help="List the entries, least recently used first.")
+    args = parser.parse_args()
+
+    cache = ParseCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    for file_path in args.invalidate or []:
+        cache.invalidate(file_path)
+    if args.stats or not (args.clear or args.invalidate):
+        entries = cache.entries()
+        for path, size, last_use in entries:
+            print(f"{os.path.basename(path)}\t{size / 1e6:.1f} MB\t{time.ctime(last_use)}")
+        print(f"{len(entries)} entries, {sum(size for _, size, _ in entries) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
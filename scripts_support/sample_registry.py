@@ -0,0 +1,157 @@
+"""
+Cohort-wide sample ID registry
+
+Every stage of the pipeline refers to the same individuals: the segment
+loaders, IBDIndex, the relationship graph and the Bonsai input. The
+registry assigns each sample ID a dense int32 code once and keeps it for
+the life of the cohort. It is persisted next to the results as a plain
+text file with one ID per line, where the line number is the code. New IDs
+are only ever appended, so codes handed out earlier never change.
+
+Segment ID columns recoded with the registry (categorical) share one set
+of categories, so joins, isin filters and groupbys across tools and
+stages compare integer codes instead of strings. Each ID string is stored
+once, in the registry.
+
+Usage:
+    from scripts_support.sample_registry import SampleRegistry
+    registry = SampleRegistry.for_results(results_directory)
+    df = read_segments("ibis_MergedSamples.seg", "ibis", registry=registry)
+    codes = df["id1"].cat.codes        # registry codes
+    registry.save()
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# File name of the registry inside a results directory
+REGISTRY_FILENAME = "sample_registry.txt"
+
+
+class SampleRegistry:
+    """
+    Stable mapping between sample ID strings and dense int32 codes.
+
+    ``ids[code]`` is the ID of a code and ``codes[id]`` the code of an ID.
+    IDs are kept as strings, the way the segment readers parse them.
+    """
+
+    def __init__(self, ids=None, path=None):
+        self.ids = []                  # {code: id}
+        self.codes = {}                # {id: code}
+        self.path = path
+        self._dtype = None
+        if ids is not None:
+            self.encode(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_val):
+        return str(id_val) in self.codes
+
+    @classmethod
+    def load(cls, path):
+        """Read a registry written by save; the line number of each ID is its code."""
+        with open(path) as f:
+            ids = f.read().splitlines()
+        registry = cls(path=path)
+        registry.ids = ids
+        registry.codes = {id_val: code for code, id_val in enumerate(ids)}
+        if len(registry.codes) != len(ids):
+            raise ValueError(f"Duplicate sample IDs in registry {path}")
+        return registry
+
+    @classmethod
+    def for_results(cls, results_directory):
+        """The registry of a results directory, empty if none has been saved there yet."""
+        path = os.path.join(results_directory, REGISTRY_FILENAME)
+        return cls.load(path) if os.path.exists(path) else cls(path=path)
+
+    def save(self, path=None):
+        """
+        Write the registry, one ID per line in code order.
+
+        The file is replaced atomically so a reader never sees a partial
+        registry.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given for the sample registry")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(f"{id_val}\n" for id_val in self.ids)
+        os.replace(tmp_path, path)
+        self.path = path
+        return path
+
+    def code(self, id_val):
+        """Code of one ID, registering it if it is new."""
+        id_val = str(id_val)
+        code = self.codes.get(id_val)
+        if code is None:
+            code = len(self.ids)
+            self.codes[id_val] = code
+            self.ids.append(id_val)
+        return code
+
+    def encode(self, values, add=True):
+        """
+        Codes of many IDs (list, array, Series or Categorical).
+
+        Only the distinct values are looked up: categorical input brings its
+        categories, anything else is factorized first. Missing values, and
+        unknown IDs when add is False, get -1.
+
+        Returns:
+            np.ndarray: int32 codes, one per value.
+        """
+        if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.array
+        if isinstance(values, pd.Categorical):
+            if values.dtype == self.dtype:
+                return values.codes.astype(np.int32)
+            local_codes, uniques = values.codes, values.categories
+        else:
+            local_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        lookup = self.code if add else (lambda id_val: self.codes.get(str(id_val), -1))
+        codes = np.fromiter((lookup(id_val) for id_val in uniques.tolist()), np.int32, len(uniques))
+        return np.where(local_codes >= 0, codes[local_codes], -1).astype(np.int32)
+
+    def decode(self, codes):
+        """IDs of an array of codes, as an object array."""
+        return np.asarray(self.ids, dtype=object)[np.asarray(codes)]
+
+    @property
+    def dtype(self):
+        """Categorical dtype whose category codes are the registry codes."""
+        if self._dtype is None or len(self._dtype.categories) != len(self.ids):
+            self._dtype = pd.CategoricalDtype(categories=pd.Index(self.ids, dtype=object))
+        return self._dtype
+
+    def categorical(self, values):
+        """
+        Recode sample IDs as a categorical over the whole registry.
+
+        Columns recoded this way share categories across frames, so
+        comparisons, merges and groupbys between them use the codes.
+        """
+        codes = self.encode(values)
+        categorical = pd.Categorical.from_codes(codes, dtype=self.dtype)
+        if isinstance(values, pd.Series):
+            return pd.Series(categorical, index=values.index, name=values.name)
+        return categorical
+
+    def intern(self, df, columns):
+        """Recode the given sample ID columns of a DataFrame in place (missing columns are skipped)."""
+        # Every column is encoded before any is rebuilt, so they all get the
+        # categories of the registry after the last new ID
+        columns = [name for name in columns if name in df.columns]
+        codes = [self.encode(df[name]) for name in columns]
+        for name, column_codes in zip(columns, codes):
+            df[name] = pd.Categorical.from_codes(column_codes, dtype=self.dtype)
+        return df
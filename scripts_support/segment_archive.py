@@ -0,0 +1,409 @@
+"""
+Compact binary archive of IBD segments
+
+Merged segment TSVs are mostly digits: sorted positions written out in
+full, sample IDs repeated on every line. For archiving and transfer, a
+segment archive stores the same table several times smaller:
+
+    - one block per chromosome, rows sorted by physical start;
+    - start positions delta-encoded and end positions stored as lengths,
+      so the integers left are small;
+    - genetic positions and lengths quantised to 10^-cm_decimals cM
+      (default 1e-4, the precision the tools print);
+    - sample IDs and other text columns dictionary-coded;
+    - integers divided by their common divisor, zigzag-coded and stored in
+      the narrowest byte width that holds the block's values, one byte
+      plane after another, so zlib sees runs of similar bytes; every
+      column stream is zlib-compressed and each block checked by a CRC32.
+
+Decoding is a few vectorised NumPy passes per column, so reading an
+archive is faster than parsing the TSV it came from.
+
+Layout: magic, format version (uint32), the blocks, a JSON footer
+(format, columns, dictionaries, block offsets and checksums), the footer
+length (uint64) and the magic again.
+
+Usage:
+    from scripts_support.segment_archive import write_segment_archive, read_segment_archive
+    write_segment_archive(df, "ibis_MergedSamples.sega", "ibis")
+    df = read_segment_archive("ibis_MergedSamples.sega", chromosomes=[1, 2])
+
+    python -m scripts_support.segment_archive pack ibis_MergedSamples.seg ibis_MergedSamples.sega --format ibis
+    python -m scripts_support.segment_archive unpack ibis_MergedSamples.sega ibis_MergedSamples.seg
+    python -m scripts_support.segment_archive --verify
+"""
+
+import argparse
+import json
+import os
+import struct
+import zlib
+import numpy as np
+import pandas as pd
+
+from scripts_support.segment_io import SEGMENT_FORMATS, read_segments
+
+ARCHIVE_MAGIC = b"IBDSEGA\x00"
+ARCHIVE_FORMAT_VERSION = 1
+
+# File extension of segment archives
+ARCHIVE_SUFFIX = ".sega"
+
+# Columns not stored as they are: (encoding, reference column). "delta" stores
+# the difference to the previous row, "offset" the difference to the
+# reference column of the same row; the "cm" variants quantise first.
+COLUMN_ENCODINGS = {
+    "physical_position_start": ("delta", None),
+    "physical_position_end": ("offset", "physical_position_start"),
+    "genetic_position_start": ("cm_delta", None),
+    "genetic_position_end": ("cm_offset", "genetic_position_start"),
+    "genetic_length": ("cm", None),
+}
+
+# Default precision of quantised cM values (decimal places)
+CM_DECIMALS = 4
+
+ZLIB_LEVEL = 6
+
+
+def zigzag_encode(values):
+    """Map signed integers to unsigned ones, small magnitudes to small values."""
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    values = values.astype(np.uint64)
+    return ((values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64))
+
+
+def pack_integers(values):
+    """
+    Bytes of a signed integer array: values divided by their greatest
+    common divisor, zigzag-coded, then written as the byte planes of the
+    narrowest width (1, 2, 4 or 8 bytes) that holds them.
+
+    Returns:
+        tuple: (bytes, width, divisor).
+    """
+    values = np.asarray(values, dtype=np.int64)
+    divisor = int(np.gcd.reduce(values)) if len(values) else 0
+    divisor = divisor if divisor > 1 else 1
+    encoded = zigzag_encode(values // divisor if divisor > 1 else values)
+    largest = int(encoded.max(initial=0))
+    width = next(width for width in (1, 2, 4, 8) if largest < 1 << (8 * width))
+    planes = encoded.astype(f"<u{width}").view(np.uint8).reshape(-1, width).T
+    return np.ascontiguousarray(planes).tobytes(), width, divisor
+
+
+def unpack_integers(data, count, width, divisor):
+    """Inverse of pack_integers."""
+    planes = np.frombuffer(data, dtype=np.uint8)
+    if len(planes) != count * width:
+        raise ValueError(f"Corrupt integer stream: {len(planes)} bytes, {count * width} expected")
+    encoded = np.ascontiguousarray(planes.reshape(width, count).T).view(f"<u{width}").reshape(count)
+    values = zigzag_decode(encoded)
+    return values * divisor if divisor > 1 else values
+
+
+def _quantise(values, scale, name):
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isfinite(values).all():
+        raise ValueError(f"Column {name} has missing or non-finite values and cannot be quantised")
+    return np.rint(values * scale).astype(np.int64)
+
+
+def _column_layout(segment_format, columns):
+    """(name, dtype, encoding, reference) of each archived column."""
+    layout = []
+    for name, dtype in SEGMENT_FORMATS[segment_format]:
+        if name == "chromosome" or name not in columns:
+            continue
+        if name in COLUMN_ENCODINGS and (COLUMN_ENCODINGS[name][1] is None or COLUMN_ENCODINGS[name][1] in columns):
+            encoding, reference = COLUMN_ENCODINGS[name]
+        else:
+            encoding, reference = {"category": "dict"}.get(dtype, "int" if dtype.startswith("int") else "float32"), None
+        layout.append((name, dtype, encoding, reference))
+    return layout
+
+
+def _encode_column(values, encoding, reference_values, scale):
+    """Bytes, width and divisor of one column of a block, before compression."""
+    if encoding == "float32":
+        planes = np.ascontiguousarray(values, dtype="<f4").view(np.uint8).reshape(-1, 4).T
+        return np.ascontiguousarray(planes).tobytes(), 4, 1
+    if encoding.startswith("cm"):
+        values = _quantise(values, scale, encoding)
+        if reference_values is not None:
+            reference_values = _quantise(reference_values, scale, encoding)
+    else:
+        values = np.asarray(values, dtype=np.int64)
+        if reference_values is not None:
+            reference_values = np.asarray(reference_values, dtype=np.int64)
+    if encoding.endswith("delta"):
+        values = np.diff(values, prepend=np.int64(0))
+    elif encoding.endswith("offset"):
+        values = values - reference_values
+    return pack_integers(values)
+
+
+def _decode_column(data, rows, encoding, reference_values, width, divisor):
+    """
+    Integer values of one column of a block (quantised for cM columns,
+    codes for dictionary columns), or the float32 values of a plain float
+    column. Offsets are resolved against the reference column's integers.
+    """
+    if encoding == "float32":
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(4, rows)
+        return np.ascontiguousarray(planes.T).view("<f4").reshape(rows)
+    values = unpack_integers(data, rows, width, divisor)
+    if encoding.endswith("delta"):
+        values = np.cumsum(values)
+    elif encoding.endswith("offset"):
+        values = values + reference_values
+    return values
+
+
+def write_segment_archive(df, archive_path, segment_format, cm_decimals=CM_DECIMALS):
+    """
+    Write segments to a segment archive.
+
+    Parameters:
+        df (pd.DataFrame): Segments with the columns of SEGMENT_FORMATS[segment_format]
+                           (any subset that includes chromosome).
+        archive_path (str): Archive file to write.
+        segment_format (str): Key of SEGMENT_FORMATS.
+        cm_decimals (int): Decimal places kept of genetic positions and lengths.
+
+    Returns:
+        dict: {"segments": rows written, "bytes": archive size}.
+    """
+    layout = _column_layout(segment_format, set(df.columns))
+    scale = 10 ** cm_decimals
+    chromosomes = df["chromosome"].to_numpy()
+
+    # Dictionary-coded columns share one dictionary across blocks; the
+    # sample ID columns share theirs with each other
+    dictionaries, codes = {}, {}
+    id_columns = [name for name, _, encoding, _ in layout if encoding == "dict" and name in ("id1", "id2")]
+    if id_columns:
+        id_codes, ids = pd.factorize(pd.concat([df[name].astype(str) for name in id_columns], ignore_index=True))
+        for i, name in enumerate(id_columns):
+            codes[name] = id_codes[i * len(df):(i + 1) * len(df)]
+            dictionaries[name] = "ids"
+        dictionaries["ids"] = ids.tolist()
+    for name, _, encoding, _ in layout:
+        if encoding == "dict" and name not in codes:
+            codes[name], values = pd.factorize(df[name].astype(str))
+            dictionaries[name] = values.tolist()
+
+    blocks = []
+    tmp_path = f"{archive_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack("<I", ARCHIVE_FORMAT_VERSION))
+        for chromosome in np.unique(chromosomes):
+            rows = np.flatnonzero(chromosomes == chromosome)
+            if "physical_position_start" in df.columns:
+                rows = rows[np.argsort(df["physical_position_start"].to_numpy()[rows], kind="stable")]
+            streams, packing = [], []
+            for name, _, encoding, reference in layout:
+                values = codes[name][rows] if encoding == "dict" else df[name].to_numpy()[rows]
+                reference_values = df[reference].to_numpy()[rows] if reference else None
+                data, width, divisor = _encode_column(values, encoding, reference_values, scale)
+                streams.append(zlib.compress(data, ZLIB_LEVEL))
+                packing.append([width, divisor])
+            block = b"".join(streams)
+            blocks.append({
+                "chromosome": int(chromosome),
+                "rows": len(rows),
+                "offset": f.tell(),
+                "lengths": [len(stream) for stream in streams],
+                "packing": packing,
+                "crc32": zlib.crc32(block),
+            })
+            f.write(block)
+
+        footer = json.dumps({
+            "format": segment_format,
+            "columns": [[name, dtype, encoding, reference] for name, dtype, encoding, reference in layout],
+            "dictionaries": dictionaries,
+            "cm_scale": scale,
+            "blocks": blocks,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(struct.pack("<Q", len(footer)))
+        f.write(ARCHIVE_MAGIC)
+    os.replace(tmp_path, archive_path)
+    return {"segments": len(df), "bytes": os.path.getsize(archive_path)}
+
+
+def read_archive_footer(archive_path):
+    """The JSON footer of an archive (format, columns, dictionaries, blocks)."""
+    with open(archive_path, "rb") as f:
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(f"Not a segment archive: {archive_path}")
+        version = struct.unpack("<I", f.read(4))[0]
+        if version != ARCHIVE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported segment archive version {version} in {archive_path}")
+        f.seek(-(8 + len(ARCHIVE_MAGIC)), os.SEEK_END)
+        footer_length = struct.unpack("<Q", f.read(8))[0]
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(f"Truncated segment archive: {archive_path}")
+        f.seek(-(8 + len(ARCHIVE_MAGIC) + footer_length), os.SEEK_END)
+        return json.loads(f.read(footer_length).decode("utf-8"))
+
+
+def read_segment_archive(archive_path, chromosomes=None, columns=None, rename=None):
+    """
+    Read segments from a segment archive.
+
+    Parameters:
+        archive_path (str): Archive written by write_segment_archive.
+        chromosomes (list): Chromosomes to read (default: all); other blocks are skipped.
+        columns (list): Format column names to return (default: all archived ones).
+        rename (dict): {format column name: output name}, as for read_segments.
+
+    Returns:
+        pd.DataFrame: Segments in chromosome then start order, with the dtypes of SEGMENT_FORMATS.
+    """
+    footer = read_archive_footer(archive_path)
+    layout = footer["columns"]
+    scale = footer["cm_scale"]
+    blocks = [block for block in footer["blocks"]
+              if chromosomes is None or block["chromosome"] in {int(chrom) for chrom in chromosomes}]
+    archived = ["chromosome"] + [name for name, _, _, _ in layout]
+    columns = [name for name in archived if columns is None or name in columns]
+
+    parts = {name: [] for name in archived}
+    with open(archive_path, "rb") as f:
+        for block in blocks:
+            f.seek(block["offset"])
+            data = f.read(sum(block["lengths"]))
+            if zlib.crc32(data) != block["crc32"]:
+                raise ValueError(f"Corrupt segment archive block (chromosome {block['chromosome']}): CRC mismatch")
+            rows = block["rows"]
+            decoded = {}
+            position = 0
+            for (name, dtype, encoding, reference), length, (width, divisor) in zip(layout, block["lengths"],
+                                                                                   block["packing"]):
+                stream = zlib.decompress(data[position:position + length])
+                position += length
+                decoded[name] = _decode_column(stream, rows, encoding, decoded[reference] if reference else None,
+                                               width, divisor)
+                if encoding.startswith("cm"):
+                    parts[name].append((decoded[name] / scale).astype(dtype))
+                else:
+                    parts[name].append(decoded[name].astype("int32" if encoding == "dict" else dtype))
+            parts["chromosome"].append(np.full(rows, block["chromosome"], dtype=np.int8))
+
+    df = pd.DataFrame(index=pd.RangeIndex(sum(block["rows"] for block in blocks)))
+    for name, dtype, encoding, _ in [("chromosome", "int8", "int", None)] + [tuple(column) for column in layout]:
+        if name not in columns:
+            continue
+        values = np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype="int32" if encoding == "dict" else dtype)
+        if encoding == "dict":
+            dictionary = footer["dictionaries"][name]
+            if isinstance(dictionary, str):
+                dictionary = footer["dictionaries"][dictionary]
+            values = pd.Categorical.from_codes(values, categories=pd.Index(dictionary, dtype=object))
+        df[name] = values
+    return df[columns].rename(columns=rename or {})
+
+
+def verify_roundtrip(num_segments=200_000, seed=0):
+    """
+    Write random segments of every format to an archive and check that
+    they read back unchanged (cM values to the archive precision).
+    """
+    import tempfile
+    rng = np.random.default_rng(seed)
+    ids = np.array([f"user{i}" for i in rng.permutation(5_000)], dtype=object)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for segment_format, layout in SEGMENT_FORMATS.items():
+            df = pd.DataFrame()
+            for name, dtype in layout:
+                if name in ("id1", "id2"):
+                    df[name] = pd.Categorical(rng.choice(ids, num_segments))
+                elif name == "IBD_type":
+                    df[name] = pd.Categorical(rng.choice(["IBD1", "IBD2"], num_segments))
+                elif name == "chromosome":
+                    df[name] = rng.integers(1, 23, num_segments).astype(np.int8)
+                elif name == "physical_position_start":
+                    df[name] = rng.integers(0, 250_000_000, num_segments).astype(np.int32)
+                elif name == "physical_position_end":
+                    df[name] = (df["physical_position_start"] + rng.integers(1, 50_000_000, num_segments)).astype(np.int32)
+                elif name.startswith("genetic") or name == "LOD":
+                    df[name] = np.round(rng.uniform(0, 280, num_segments), 4).astype(np.float32)
+                elif dtype == "float32":
+                    df[name] = rng.uniform(0, 0.01, num_segments).astype(np.float32)
+                else:
+                    df[name] = rng.integers(0, 3_000, num_segments).astype(dtype)
+
+            path = os.path.join(tmp_dir, f"{segment_format}{ARCHIVE_SUFFIX}")
+            write_segment_archive(df, path, segment_format)
+            expected = df.iloc[np.lexsort((df["physical_position_start"].to_numpy(), df["chromosome"].to_numpy()))]
+            expected = expected.reset_index(drop=True)
+            result = read_segment_archive(path)
+            for name, _ in layout:
+                left, right = expected[name], result[name]
+                if isinstance(left.dtype, pd.CategoricalDtype):
+                    assert left.astype(str).tolist() == right.astype(str).tolist(), f"{segment_format}.{name} differs"
+                else:
+                    assert left.dtype == right.dtype, f"{segment_format}.{name} has dtype {right.dtype}"
+                    assert np.array_equal(left.to_numpy(), right.to_numpy()), f"{segment_format}.{name} differs"
+
+            subset = read_segment_archive(path, chromosomes=[3], columns=["id1", "genetic_length"])
+            assert subset.columns.tolist() == ["id1", "genetic_length"]
+            assert len(subset) == int((df["chromosome"] == 3).sum())
+
+            # A flipped byte in a block is caught by its checksum
+            with open(path, "r+b") as f:
+                f.seek(len(ARCHIVE_MAGIC) + 4 + 10)
+                byte = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([byte[0] ^ 0xFF]))
+            try:
+                read_segment_archive(path)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Corrupted block was not detected")
+            print(f"{segment_format}: {num_segments} segments round-trip")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack segment files into compact archives and back.")
+    subparsers = parser.add_subparsers(dest="command")
+    pack = subparsers.add_parser("pack", help="Write a segment file or store as an archive.")
+    pack.add_argument("source", help="Segment file (.seg, .ibd[.gz]) or segment store.")
+    pack.add_argument("archive", help="Archive to write.")
+    pack.add_argument("--format", required=True, choices=sorted(SEGMENT_FORMATS), help="Segment format of the source.")
+    pack.add_argument("--cm-decimals", type=int, default=CM_DECIMALS, help="Decimal places kept of cM values.")
+    unpack = subparsers.add_parser("unpack", help="Write an archive back out as a tab-separated segment file.")
+    unpack.add_argument("archive", help="Archive to read.")
+    unpack.add_argument("output", help="Segment file to write.")
+    parser.add_argument("--verify", action="store_true", help="Run the round-trip checks.")
+    args = parser.parse_args()
+
+    if args.verify:
+        verify_roundtrip()
+    if args.command == "pack":
+        source_bytes = os.path.getsize(args.source) if os.path.isfile(args.source) else None
+        stats = write_segment_archive(read_segments(args.source, args.format), args.archive, args.format,
+                                      args.cm_decimals)
+        ratio = f" ({source_bytes / stats['bytes']:.1f}x smaller)" if source_bytes else ""
+        print(f"Wrote {stats['segments']} segments to {args.archive}: {stats['bytes'] / 1e6:.1f} MB{ratio}")
+    elif args.command == "unpack":
+        footer = read_archive_footer(args.archive)
+        df = read_segment_archive(args.archive)
+        # Columns are written in the order of the segment format
+        names = [name for name, _ in SEGMENT_FORMATS[footer["format"]] if name in df.columns]
+        df[names].to_csv(args.output, sep="\t", header=False, index=False)
+        print(f"Wrote {len(df)} segments to {args.output}")
+    elif not args.verify:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
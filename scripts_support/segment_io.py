@@ -0,0 +1,1081 @@
+"""
+Typed readers for IBD segment files
+
+One place that knows the column layout of every segment format used in the
+labs (IBIS .seg, hap-IBD and Refined-IBD .ibd[.gz], ped-sim truth .seg) and
+parses it in a single pass with explicit compact dtypes: int32 positions,
+float32 genetic lengths, int8 chromosomes/haplotypes and categorical sample
+IDs, so each distinct ID string is stored once. Chromosome names are coded
+by chromosome_code ("chr7" -> 7, "X" -> 23); segments on a chromosome it
+does not recognise are skipped with a warning.
+
+Merged results can also be kept as a segment store: a Parquet dataset
+partitioned by chromosome (one chromosome=N/ directory per chromosome),
+sorted by start and written in row groups whose min/max statistics let
+readers skip data that cannot match a chromosome, min-cM or sample filter.
+merge_segment_files builds a store from per-chromosome outputs with
+bounded memory, spilling sorted runs to disk and k-way merging them when a
+chromosome does not fit in its buffer.
+
+A sidecar index (build_segment_index) maps regions and sample pairs to the
+row groups holding them, so SegmentFile can look either up without a scan.
+
+Usage:
+    from scripts_support.segment_io import read_segments, read_segment_store
+    df = read_segments("ibis_MergedSamples.seg", "ibis")
+    merge_segment_files(seg_files, "ibis_MergedSamples.parquet", "ibis")
+    df = read_segment_store("ibis_MergedSamples.parquet", "ibis", chromosomes=[1, 2], min_cm=7)
+    df = SegmentFile("ibis_MergedSamples.parquet", "ibis").pair("user1", "user2")
+
+    python -m scripts_support.segment_io --verify
+"""
+
+import argparse
+import bisect
+import contextlib
+import heapq
+import os
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+from scripts_support.compressed_io import open_compressed, is_bgzf
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pa_compute
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pa = None
+
+# Column layout of each segment format: (column name, dtype) in file order
+SEGMENT_FORMATS = {
+    "ibis": [
+        ("id1", "category"), ("id2", "category"), ("chromosome", "int8"),
+        ("physical_position_start", "int32"), ("physical_position_end", "int32"),
+        ("IBD_type", "category"), ("genetic_position_start", "float32"),
+        ("genetic_position_end", "float32"), ("genetic_length", "float32"),
+        ("marker_count", "int32"), ("error_count", "int32"), ("error_density", "float32"),
+    ],
+    "hapibd": [
+        ("id1", "category"), ("id1_haplotype_index", "int8"),
+        ("id2", "category"), ("id2_haplotype_index", "int8"), ("chromosome", "int8"),
+        ("physical_position_start", "int32"), ("physical_position_end", "int32"),
+        ("genetic_length", "float32"),
+    ],
+    "refinedibd": [
+        ("id1", "category"), ("id1_haplotype_index", "int8"),
+        ("id2", "category"), ("id2_haplotype_index", "int8"), ("chromosome", "int8"),
+        ("physical_position_start", "int32"), ("physical_position_end", "int32"),
+        ("LOD", "float32"), ("genetic_length", "float32"),
+    ],
+    "pedsim": [
+        ("id1", "category"), ("id2", "category"), ("chromosome", "int8"),
+        ("physical_position_start", "int32"), ("physical_position_end", "int32"),
+        ("IBD_type", "category"), ("genetic_position_start", "float32"),
+        ("genetic_position_end", "float32"), ("genetic_length", "float32"),
+    ],
+}
+
+# Renaming used by the evaluation workflow (sample1/sample2/chrom/start/end/cM)
+EVALUATION_NAMES = {
+    "id1": "sample1",
+    "id2": "sample2",
+    "id1_haplotype_index": "sample1_haplotype",
+    "id2_haplotype_index": "sample2_haplotype",
+    "chromosome": "chrom",
+    "physical_position_start": "start",
+    "physical_position_end": "end",
+    "genetic_length": "cM",
+}
+
+
+# Codes of the non-numeric chromosomes (PLINK numbering), so that every
+# chromosome fits the int8 chromosome column
+CHROMOSOME_CODES = {"X": 23, "Y": 24, "XY": 25, "MT": 26, "M": 26}
+
+# Rows per Parquet row group; each group carries min/max statistics per column
+STORE_ROW_GROUP_SIZE = 64 * 1024
+
+# Bytes of text parsed per batch when streaming a segment file
+STREAM_BLOCK_SIZE = 8 << 20
+
+# Sidecar index of a store (build_segment_index); the leading underscore keeps
+# it out of dataset discovery
+STORE_INDEX_DIR = "_index"
+
+# Rows per row group of the pair index, small so a pair lookup reads little
+PAIR_INDEX_ROW_GROUP_SIZE = 4 * 1024
+
+# Segments held in memory by merge_segment_files before sorted runs are
+# spilled to disk (roughly 30-60 bytes per segment depending on the format)
+MERGE_BUFFER_ROWS = 4_000_000
+
+
+def read_segments(file_path, segment_format, columns=None, rename=None, registry=None, cache=None):
+    """
+    Read a segment file in one typed pass.
+
+    Parameters:
+        file_path (str): Segment file; gzip compression is detected from the
+                         extension and BGZF is inflated in parallel. A segment
+                         store directory is read with read_segment_store.
+        segment_format (str): Key of SEGMENT_FORMATS ("ibis", "hapibd", "refinedibd", "pedsim").
+        columns (list): Format column names to keep (default: all of them).
+        rename (dict): {format column name: output name}, applied while parsing
+                       so no duplicated columns are created.
+        registry (SampleRegistry): If given, sample IDs are recoded to the
+                                   cohort registry's categories (new IDs are registered).
+        cache (ParseCache): If given, the parsed columns are kept in and
+                            loaded from this cache.
+
+    Returns:
+        pd.DataFrame: The segments with the dtypes of SEGMENT_FORMATS.
+    """
+    if os.path.isdir(file_path):
+        return read_segment_store(file_path, segment_format, columns=columns, rename=rename, registry=registry)
+    if cache is not None:
+        options = {"reader": "read_segments", "format": segment_format, "columns": columns, "rename": rename}
+        df = cache.fetch(file_path, options, lambda: read_segments(file_path, segment_format, columns, rename))
+        return _intern_ids(df, registry, rename)
+    rename = rename or {}
+    layout = SEGMENT_FORMATS[segment_format]
+    names = [rename.get(name, name) for name, _ in layout]
+    dtypes = {rename.get(name, name): dtype for name, dtype in layout}
+    usecols = names if columns is None else [rename.get(name, name) for name in columns]
+    chromosome = rename.get("chromosome", "chromosome")
+
+    with _segment_source(file_path) as source:
+        if pa is None:
+            df = pd.read_csv(source, sep="\t", header=None, names=names, usecols=usecols,
+                             dtype=_parse_dtypes(dtypes, usecols, chromosome))[usecols]
+            df, rejected = _code_chromosome_frame(df, chromosome)
+            _warn_rejected_chromosomes(file_path, rejected)
+            return _intern_ids(df, registry, rename)
+
+        # Arrow parses in parallel straight into typed (and dictionary-encoded)
+        # buffers; converting with self_destruct frees each column as it goes
+        table = pa_csv.read_csv(
+            source,
+            read_options=pa_csv.ReadOptions(column_names=names),
+            parse_options=pa_csv.ParseOptions(delimiter="\t"),
+            convert_options=pa_csv.ConvertOptions(column_types=_parse_types(dtypes, usecols, chromosome),
+                                                  include_columns=usecols),
+        )
+    table, rejected = _code_chromosomes(table, chromosome)
+    _warn_rejected_chromosomes(file_path, rejected)
+    return _intern_ids(table.to_pandas(self_destruct=True, split_blocks=True), registry, rename)
+
+
+def _intern_ids(df, registry, rename=None):
+    """Recode the sample ID columns of a read frame with the sample registry, if there is one."""
+    if registry is not None:
+        rename = rename or {}
+        registry.intern(df, [rename.get("id1", "id1"), rename.get("id2", "id2")])
+    return df
+
+
+def _segment_source(file_path):
+    """
+    What to hand the CSV readers: BGZF files (hap-IBD, Refined-IBD) as a
+    stream inflated on a thread pool, anything else as its path so the
+    reader decompresses plain gzip itself.
+    """
+    if is_bgzf(file_path):
+        return open_compressed(file_path)
+    return contextlib.nullcontext(file_path)
+
+
+def _arrow_types(dtypes, names):
+    return {name: pa.dictionary(pa.int32(), pa.string()) if dtypes[name] == "category"
+            else pa.from_numpy_dtype(np.dtype(dtypes[name])) for name in names}
+
+
+def _parse_types(dtypes, names, chromosome="chromosome"):
+    """Arrow types to parse columns with: the chromosome column is read as text for _code_chromosomes."""
+    types = _arrow_types(dtypes, names)
+    if chromosome in types:
+        types[chromosome] = pa.dictionary(pa.int32(), pa.string())
+    return types
+
+
+def _parse_dtypes(dtypes, names, chromosome="chromosome"):
+    """pandas dtypes to parse columns with, the chromosome column as text for _code_chromosome_frame."""
+    return {name: "category" if name == chromosome else dtypes[name] for name in names}
+
+
+def chromosome_code(name):
+    """
+    Numeric code of a chromosome name: "7" and "chr7" are 7, X/Y/XY/MT
+    (with or without "chr") follow CHROMOSOME_CODES. None if the name is
+    not a chromosome the int8 chromosome column can hold.
+    """
+    text = str(name).strip()
+    if text[:3].lower() == "chr":
+        text = text[3:]
+    text = text.upper()
+    if text in CHROMOSOME_CODES:
+        return CHROMOSOME_CODES[text]
+    if text.isdigit() and 0 < int(text) <= np.iinfo(np.int8).max:
+        return int(text)
+    return None
+
+
+def _code_chromosomes(data, chromosome="chromosome"):
+    """
+    Replace the text chromosome column of an Arrow table or record batch by
+    its int8 chromosome_code, dropping the rows it does not recognise.
+
+    Only the dictionary of distinct names is looked up, not every row.
+
+    Returns:
+        tuple: (table or batch, {rejected chromosome name: rows dropped}).
+    """
+    if chromosome not in data.schema.names:
+        return data, {}
+    position = data.schema.get_field_index(chromosome)
+    column = data.column(position)
+    chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+    coded, rejected = [], {}
+    for chunk in chunks:
+        names = chunk.dictionary.to_pylist()
+        codes = [chromosome_code(name) for name in names]
+        coded.append(pa.array(codes, type=pa.int8()).take(chunk.indices))
+        if None in codes:
+            counts = np.bincount(chunk.indices.fill_null(-1).to_numpy() + 1, minlength=len(names) + 1)
+            for name, code, count in zip([None] + names, [None] + codes, counts.tolist()):
+                if code is None and count:
+                    rejected[name] = rejected.get(name, 0) + count
+    if isinstance(column, pa.ChunkedArray):
+        coded = pa.chunked_array(coded, type=pa.int8())
+    else:
+        coded = coded[0]
+    data = data.set_column(position, pa.field(chromosome, pa.int8()), coded)
+    if rejected:
+        data = data.filter(pa_compute.is_valid(coded))
+    return data, rejected
+
+
+def _code_chromosome_frame(df, chromosome="chromosome"):
+    """_code_chromosomes for a pandas frame whose chromosome column was read as categories."""
+    if chromosome not in df.columns:
+        return df, {}
+    names = df[chromosome].cat
+    # 0 is no chromosome's code: it marks unrecognised and missing names (category code -1)
+    lookup = np.array([chromosome_code(name) or 0 for name in names.categories] + [0], dtype=np.int8)
+    codes = lookup[names.codes.to_numpy()]
+    unknown = codes == 0
+    rejected = {}
+    if unknown.any():
+        rejected = df[chromosome][unknown].astype(object).fillna("").value_counts(sort=False).to_dict()
+        df = df.loc[~unknown].reset_index(drop=True)
+        codes = codes[~unknown]
+    df[chromosome] = codes
+    return df, rejected
+
+
+def _warn_rejected_chromosomes(file_path, rejected):
+    """Warn that the segments counted in rejected ({name: rows}) were skipped."""
+    if rejected:
+        names = ", ".join(repr(name) for name in sorted(rejected, key=str)[:5])
+        warnings.warn(f"{file_path}: skipped {sum(rejected.values()):,} segments on chromosomes "
+                      f"that are not recognised ({names})")
+
+
+def iter_segment_batches(file_path, segment_format, block_size=STREAM_BLOCK_SIZE, columns=None):
+    """
+    Stream a segment file as typed Arrow record batches.
+
+    Only one block of the file (about block_size bytes of text) is parsed
+    and held at a time, so files larger than memory can be processed.
+
+    Parameters:
+        file_path (str): Segment file; gzip compression is detected from the extension.
+        segment_format (str): Key of SEGMENT_FORMATS.
+        block_size (int): Bytes of text parsed per batch.
+        columns (list): Format column names to decode (default: all of them).
+
+    Yields:
+        pyarrow.RecordBatch: Batches with the SEGMENT_FORMATS column names and types.
+    """
+    _require_pyarrow()
+    layout = SEGMENT_FORMATS[segment_format]
+    names = [name for name, _ in layout]
+    columns = columns or names
+    with _segment_source(file_path) as source:
+        reader = pa_csv.open_csv(
+            source,
+            read_options=pa_csv.ReadOptions(column_names=names, block_size=block_size),
+            parse_options=pa_csv.ParseOptions(delimiter="\t"),
+            convert_options=pa_csv.ConvertOptions(column_types=_parse_types(dict(layout), columns),
+                                                  include_columns=columns),
+        )
+        rejected = {}
+        for batch in reader:
+            batch, batch_rejected = _code_chromosomes(batch)
+            for name, count in batch_rejected.items():
+                rejected[name] = rejected.get(name, 0) + count
+            if batch.num_rows:
+                yield batch
+    _warn_rejected_chromosomes(file_path, rejected)
+
+
+def _batch_mask(batch, min_cm, chromosomes, samples):
+    """Boolean mask of the rows of a batch that pass the scan predicates (None: all do)."""
+    mask = None
+    if min_cm is not None:
+        mask = pa_compute.greater_equal(batch.column("genetic_length"), min_cm)
+    if chromosomes is not None:
+        keep = pa_compute.is_in(batch.column("chromosome"),
+                                value_set=pa.array(chromosomes, type=batch.schema.field("chromosome").type))
+        mask = keep if mask is None else pa_compute.and_(mask, keep)
+    if samples is not None:
+        keep = pa_compute.or_(pa_compute.is_in(batch.column("id1"), value_set=samples),
+                              pa_compute.is_in(batch.column("id2"), value_set=samples))
+        mask = keep if mask is None else pa_compute.and_(mask, keep)
+    return mask
+
+
+def scan_segments(file_path, segment_format, min_cm=None, chromosomes=None, samples=None,
+                  columns=None, rename=None, block_size=STREAM_BLOCK_SIZE, registry=None, cache=None):
+    """
+    Read only the segments that pass min-cM, chromosome and sample predicates.
+
+    The file is decoded block by block and each block is filtered before the
+    next one is parsed, so rows that fail the predicates are never collected
+    into the result. Segment stores are read with the same predicates pushed
+    down to the Parquet scan (read_segment_store).
+
+    Parameters:
+        file_path (str): Segment file (gzip detected from the extension) or segment store.
+        segment_format (str): Key of SEGMENT_FORMATS.
+        min_cm (float): Keep segments with genetic_length >= min_cm.
+        chromosomes (list): Keep segments on these chromosomes.
+        samples (list): Keep segments involving any of these sample IDs.
+        columns (list): Format column names to keep (default: all of them).
+        rename (dict): {format column name: output name}, as for read_segments.
+        block_size (int): Bytes of text decoded per block.
+        registry (SampleRegistry): Recode sample IDs to the registry, as for read_segments.
+        cache (ParseCache): Keep the kept segments in this cache, keyed on
+                            the predicates, as for read_segments.
+
+    Returns:
+        tuple: (pd.DataFrame of the kept segments, number of rows scanned).
+    """
+    layout = SEGMENT_FORMATS[segment_format]
+    names = [name for name, _ in layout]
+    columns = columns or names
+    if chromosomes is not None:
+        chromosomes = [int(chrom) if isinstance(chrom, (int, np.integer)) else chromosome_code(chrom)
+                       for chrom in chromosomes]
+        if None in chromosomes:
+            raise ValueError(f"Unrecognised chromosome in {chromosomes}")
+    if samples is not None:
+        samples = [str(sample) for sample in samples]
+
+    if os.path.isdir(file_path):
+        df = read_segment_store(file_path, segment_format, chromosomes=chromosomes, min_cm=min_cm,
+                                samples=samples, columns=columns, rename=rename, registry=registry)
+        return df, count_store_segments(file_path, chromosomes)
+
+    if cache is not None:
+        def parse():
+            df, scanned = scan_segments(file_path, segment_format, min_cm, chromosomes, samples,
+                                        columns, rename, block_size)
+            df.attrs["scanned"] = scanned
+            return df
+
+        options = {"reader": "scan_segments", "format": segment_format, "min_cm": min_cm,
+                   "chromosomes": chromosomes, "samples": samples, "columns": columns, "rename": rename}
+        df = cache.fetch(file_path, options, parse)
+        return _intern_ids(df, registry, rename), df.attrs.pop("scanned")
+
+    # Decode the predicate columns too, even if they are not returned
+    predicate_columns = (["genetic_length"] if min_cm is not None else []) + \
+                        (["chromosome"] if chromosomes is not None else []) + \
+                        (["id1", "id2"] if samples is not None else [])
+    decoded = [name for name in names if name in columns or name in predicate_columns]
+    scanned = 0
+
+    if pa is None:
+        dtypes = dict(layout)
+        kept = []
+        rejected = {}
+        with _segment_source(file_path) as source:
+            for chunk in pd.read_csv(source, sep="\t", header=None, names=names, usecols=decoded,
+                                     dtype=_parse_dtypes(dtypes, decoded), chunksize=1_000_000):
+                scanned += len(chunk)
+                chunk, chunk_rejected = _code_chromosome_frame(chunk)
+                for name, count in chunk_rejected.items():
+                    rejected[name] = rejected.get(name, 0) + count
+                keep = np.ones(len(chunk), dtype=bool)
+                if min_cm is not None:
+                    keep &= (chunk["genetic_length"] >= min_cm).to_numpy()
+                if chromosomes is not None:
+                    keep &= chunk["chromosome"].isin(chromosomes).to_numpy()
+                if samples is not None:
+                    keep &= (chunk["id1"].isin(samples) | chunk["id2"].isin(samples)).to_numpy()
+                kept.append(chunk.loc[keep, columns])
+        _warn_rejected_chromosomes(file_path, rejected)
+        df = pd.concat(kept, ignore_index=True) if kept else pd.DataFrame(columns=columns)
+        for name in columns:
+            if dtypes[name] == "category":
+                df[name] = df[name].astype("category")
+        return _intern_ids(df.rename(columns=rename or {}), registry, rename), scanned
+
+    if samples is not None:
+        samples = pa.array(samples, type=pa.string())
+    kept = []
+    for batch in iter_segment_batches(file_path, segment_format, block_size, columns=decoded):
+        scanned += batch.num_rows
+        mask = _batch_mask(batch, min_cm, chromosomes, samples)
+        if mask is not None:
+            batch = batch.filter(mask)
+        if batch.num_rows:
+            kept.append(batch.select(columns))
+    schema = pa.schema([(name, pa_type) for name, pa_type in _arrow_types(dict(layout), columns).items()])
+    table = pa.Table.from_batches(kept, schema=schema)
+    df = table.to_pandas(self_destruct=True, split_blocks=True)
+    return _intern_ids(df.rename(columns=rename or {}), registry, rename), scanned
+
+
+def segment_store_path(tsv_path):
+    """Segment store directory that goes with a merged TSV path (x.seg -> x.parquet)."""
+    return os.path.splitext(tsv_path)[0] + ".parquet"
+
+
+def merged_segments_path(tsv_path):
+    """The segment store for a merged TSV path if one was written, else the TSV itself."""
+    store_path = segment_store_path(tsv_path)
+    return store_path if os.path.isdir(store_path) else tsv_path
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Segment stores need pyarrow (pip install pyarrow)")
+
+
+def clear_segment_store(store_path):
+    """Remove a segment store so it can be rewritten from scratch."""
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+
+
+def sort_segments(df, sort_by=None):
+    """
+    Sort segments within a chromosome (default: by start, then end position).
+
+    Categorical columns such as IBD_type sort by value, not by category code.
+    """
+    sort_by = sort_by or ["physical_position_start", "physical_position_end"]
+    return df.sort_values(
+        sort_by, kind="stable",
+        key=lambda column: column.astype(str) if isinstance(column.dtype, pd.CategoricalDtype) else column)
+
+
+def write_segment_partition(df, store_path, chromosome, row_group_size=STORE_ROW_GROUP_SIZE):
+    """
+    Write the segments of one chromosome into a segment store, replacing
+    that chromosome's partition.
+
+    Parameters:
+        df (pd.DataFrame): Segments of ``chromosome``, already sorted (see
+                           sort_segments), with the column names of a
+                           SEGMENT_FORMATS layout.
+        store_path (str): Store directory.
+        chromosome (int): Chromosome of the partition.
+        row_group_size (int): Rows per Parquet row group.
+    """
+    _require_pyarrow()
+    table = pa.Table.from_pandas(df.drop(columns="chromosome", errors="ignore"), preserve_index=False)
+    pa_parquet.write_table(table, _partition_path(store_path, chromosome, create=True),
+                           row_group_size=row_group_size, write_statistics=True)
+
+
+def _partition_path(store_path, chromosome, create=False):
+    partition_dir = os.path.join(store_path, f"chromosome={int(chromosome)}")
+    if create:
+        os.makedirs(partition_dir, exist_ok=True)
+    return os.path.join(partition_dir, "part-0.parquet")
+
+
+def _store_partitions(store_path):
+    """(chromosome, parquet file) of every partition of a store, in chromosome order."""
+    partitions = []
+    for entry in os.listdir(store_path):
+        if entry.startswith("chromosome="):
+            path = os.path.join(store_path, entry, "part-0.parquet")
+            if os.path.isfile(path):
+                partitions.append((int(entry.split("=", 1)[1]), path))
+    return sorted(partitions)
+
+
+def write_segment_store(df, store_path, sort_by=None, row_group_size=STORE_ROW_GROUP_SIZE):
+    """Write a segment DataFrame as a new chromosome-partitioned store with its index."""
+    clear_segment_store(store_path)
+    for chromosome, chromosome_df in df.groupby("chromosome", sort=True, observed=True):
+        write_segment_partition(sort_segments(chromosome_df, sort_by), store_path, chromosome, row_group_size)
+    build_segment_index(store_path)
+
+
+def _sort_keys(table, sort_by):
+    """Sort key arrays of an Arrow table; dictionary (categorical) columns compare by value."""
+    keys = []
+    for name in sort_by:
+        column = table.column(name)
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(pa.string())
+        keys.append(column.to_numpy())
+    return keys
+
+
+def _is_sorted(keys):
+    ordered = np.ones(max(len(keys[0]) - 1, 0), dtype=bool)
+    for key in reversed(keys):
+        ordered = (key[1:] > key[:-1]) | ((key[1:] == key[:-1]) & ordered)
+    return bool(ordered.all())
+
+
+def _sort_table(table, sort_by):
+    # One chunk with one dictionary per column keeps take() cheap. Arrow's
+    # sort is stable, so ties keep their arrival (file) order, but it cannot
+    # sort dictionary columns; those are replaced by the rank of their value
+    table = table.unify_dictionaries().combine_chunks()
+    keys = {}
+    for name in sort_by:
+        column = table.column(name)
+        if pa.types.is_dictionary(column.type):
+            column = column.combine_chunks()
+            ranks = np.empty(len(column.dictionary), dtype=np.int32)
+            ranks[pa_compute.sort_indices(column.dictionary).to_numpy()] = np.arange(len(ranks), dtype=np.int32)
+            column = pa.array(ranks[column.indices.to_numpy()])
+        keys[name] = column
+    order = pa_compute.sort_indices(pa.table(keys), sort_keys=[(name, "ascending") for name in sort_by])
+    return table.take(order)
+
+
+def _write_run(table, path, row_group_size=STORE_ROW_GROUP_SIZE):
+    pa_parquet.write_table(table, path, row_group_size=row_group_size, write_statistics=True)
+
+
+class _ChromosomeMerge:
+    """
+    Segments of one chromosome collected by merge_segment_files.
+
+    Rows are buffered in memory and spilled as sorted run files when the
+    shared buffer fills up. While everything received so far is already in
+    sort order, spilled rows are appended to a single run that becomes the
+    partition as is, so presorted input is never sorted or merged. Runs are
+    written in row groups of row_group_size, like the partition itself.
+    """
+
+    def __init__(self, temp_dir, chromosome, sort_by, row_group_size, runs=None):
+        self.prefix = os.path.join(temp_dir, f"chr{int(chromosome)}")
+        self.sort_by = sort_by
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.runs = list(runs or [])
+        self.presorted = not self.runs
+        self.last_key = None
+        self.writer = None
+        self.writer_path = None
+
+    def add(self, table):
+        if self.presorted:
+            keys = _sort_keys(table, self.sort_by)
+            first = tuple(key[0] for key in keys)
+            self.presorted = _is_sorted(keys) and (self.last_key is None or first >= self.last_key)
+            self.last_key = tuple(key[-1] for key in keys)
+            if not self.presorted and self.writer is not None:
+                self.writer.close()
+                self.writer = None
+                self.runs.insert(0, self.writer_path)
+        self.buffer.append(table)
+
+    def _next_run_path(self):
+        return f"{self.prefix}-run{len(self.runs) + (self.writer is not None)}.parquet"
+
+    def spill(self):
+        """Write the buffered rows to disk; returns the number of rows spilled."""
+        if not self.buffer:
+            return 0
+        table = pa.concat_tables(self.buffer)
+        self.buffer = []
+        if self.presorted:
+            if self.writer is None:
+                self.writer_path = self._next_run_path()
+                self.writer = pa_parquet.ParquetWriter(self.writer_path, table.schema, write_statistics=True)
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            path = self._next_run_path()
+            _write_run(_sort_table(table, self.sort_by), path, self.row_group_size)
+            self.runs.append(path)
+        return table.num_rows
+
+    def finish(self, partition_path, buffer_rows):
+        """Write the sorted chromosome to partition_path."""
+        if self.presorted and self.writer is not None:
+            self.spill()
+            self.writer.close()
+            shutil.move(self.writer_path, partition_path)
+        elif not self.runs:
+            table = pa.concat_tables(self.buffer)
+            if not self.presorted:
+                table = _sort_table(table, self.sort_by)
+            _write_run(table, partition_path, self.row_group_size)
+        else:
+            self.spill()
+            _merge_runs(self.runs, partition_path, self.sort_by, buffer_rows, self.row_group_size)
+            for path in self.runs:
+                os.remove(path)
+        self.buffer = []
+
+
+def _merge_runs(run_paths, output_path, sort_by, buffer_rows, row_group_size):
+    """
+    k-way merge of sorted run files into one sorted Parquet file.
+
+    Runs are read batch by batch. A heap keyed on the last leading sort key
+    of each run's current batch gives a bound below which no unread row can
+    fall, so every buffered row under it is final and precedes anything
+    released later. Released rows are collected until they fill a row
+    group, then sorted together and written out. Memory stays around
+    buffer_rows segments however long the runs are.
+    """
+    batch_rows = max(buffer_rows // (2 * len(run_paths)), 1024)
+    sources = [pa_parquet.ParquetFile(path).iter_batches(batch_size=batch_rows) for path in run_paths]
+    pending = [None] * len(sources)
+    leading = [None] * len(sources)
+    heap = []
+
+    def advance(i):
+        batch = next(sources[i], None)
+        if batch is None:
+            return
+        table = pa.Table.from_batches([batch])
+        key = _sort_keys(table, sort_by[:1])[0]
+        if pending[i] is None or not pending[i].num_rows:
+            pending[i], leading[i] = table, key
+        else:
+            pending[i] = pa.concat_tables([pending[i], table])
+            leading[i] = np.concatenate([leading[i], key])
+        heapq.heappush(heap, (key[-1], i))
+
+    writer = None
+    output = []
+    output_rows = 0
+
+    def emit(parts, final=False):
+        nonlocal writer, output_rows
+        output.extend(parts)
+        output_rows += sum(part.num_rows for part in parts)
+        if output and (final or output_rows >= row_group_size):
+            table = _sort_table(pa.concat_tables(output), sort_by)
+            if writer is None:
+                writer = pa_parquet.ParquetWriter(output_path, table.schema, write_statistics=True)
+            writer.write_table(table, row_group_size=row_group_size)
+            output.clear()
+            output_rows = 0
+
+    for i in range(len(sources)):
+        advance(i)
+    while heap:
+        bound, i = heapq.heappop(heap)
+        parts = []
+        for j, table in enumerate(pending):
+            if table is None:
+                continue
+            n = int(np.searchsorted(leading[j], bound, side="left"))
+            if n:
+                parts.append(table.slice(0, n))
+                pending[j] = table.slice(n)
+                leading[j] = leading[j][n:]
+        emit(parts)
+        advance(i)
+    emit([table for table in pending if table is not None and table.num_rows], final=True)
+    if writer is not None:
+        writer.close()
+
+
+def merge_segment_files(seg_files, store_path, segment_format, sort_by=None,
+                        buffer_rows=MERGE_BUFFER_ROWS, row_group_size=STORE_ROW_GROUP_SIZE, temp_dir=None,
+                        index=True):
+    """
+    Merge segment files into a new segment store with bounded memory.
+
+    Files are streamed block by block (iter_segment_batches) into
+    per-chromosome buffers. A chromosome that fits in the buffer is sorted
+    in memory and written straight to its partition; otherwise the buffer
+    is spilled as sorted runs that are k-way merged into the partition.
+    Input that already arrives in sort order is neither sorted nor merged.
+    A chromosome spread over several files is merged with the partition
+    written for the earlier files. The sidecar index (build_segment_index)
+    is written last.
+
+    Parameters:
+        seg_files (list): Segment files, typically one per chromosome in chromosome order.
+        store_path (str): Store directory to (re)create.
+        segment_format (str): Key of SEGMENT_FORMATS.
+        sort_by (list): Sort columns within a chromosome (default: start, end).
+        buffer_rows (int): Segments held in memory before spilling to disk.
+        row_group_size (int): Rows per Parquet row group of the store.
+        temp_dir (str): Directory for spilled runs (default: inside store_path).
+        index (bool): Also write the sidecar index used by SegmentFile.
+
+    Returns:
+        dict: {"segments": rows written, "spilled": rows spilled to disk,
+               "chromosomes": partitions written}.
+    """
+    _require_pyarrow()
+    sort_by = sort_by or ["physical_position_start", "physical_position_end"]
+    clear_segment_store(store_path)
+    os.makedirs(store_path)
+    temp_dir = tempfile.mkdtemp(prefix="_merge-", dir=temp_dir or store_path)
+    stats = {"segments": 0, "spilled": 0, "chromosomes": 0}
+    # Keep single parsed blocks well under the buffer (~30 bytes of text per segment)
+    block_size = int(min(STREAM_BLOCK_SIZE, max(buffer_rows * 8, 1 << 20)))
+    try:
+        for seg_file in seg_files:
+            merges = {}
+            buffered = 0
+            for batch in iter_segment_batches(seg_file, segment_format, block_size):
+                chromosome = batch.column("chromosome").to_numpy()
+                table = pa.Table.from_batches([batch]).drop_columns(["chromosome"])
+                if chromosome.min() == chromosome.max():
+                    parts = [(chromosome[0], table)]
+                else:
+                    parts = [(chrom, table.filter(pa.array(chromosome == chrom)))
+                             for chrom in np.unique(chromosome)]
+                for chrom, part in parts:
+                    if chrom not in merges:
+                        # A partition left by an earlier file becomes the first run
+                        runs = []
+                        partition_path = _partition_path(store_path, chrom)
+                        if os.path.isfile(partition_path):
+                            runs.append(os.path.join(temp_dir, f"chr{int(chrom)}-previous.parquet"))
+                            shutil.move(partition_path, runs[0])
+                        merges[chrom] = _ChromosomeMerge(temp_dir, chrom, sort_by, row_group_size, runs)
+                    merges[chrom].add(part)
+                    buffered += part.num_rows
+                    stats["segments"] += part.num_rows
+                if buffered > buffer_rows:
+                    for merge in merges.values():
+                        stats["spilled"] += merge.spill()
+                    buffered = 0
+
+            for chrom in sorted(merges):
+                merges[chrom].finish(_partition_path(store_path, chrom, create=True), buffer_rows)
+        stats["chromosomes"] = len(_store_partitions(store_path))
+        if index:
+            build_segment_index(store_path, buffer_rows)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return stats
+
+
+def export_segment_store_tsv(store_path, tsv_path, segment_format):
+    """
+    Write a segment store as a headerless TSV in the original column layout,
+    one row group at a time, in chromosome then store order.
+    """
+    _require_pyarrow()
+    names = [name for name, _ in SEGMENT_FORMATS[segment_format]]
+    chromosome_column = names.index("chromosome")
+    with open(tsv_path, "w") as out:
+        for chromosome, path in _store_partitions(store_path):
+            for batch in pa_parquet.ParquetFile(path).iter_batches(batch_size=STORE_ROW_GROUP_SIZE):
+                df = batch.to_pandas()
+                df.insert(chromosome_column, "chromosome", chromosome)
+                df.to_csv(out, sep="\t", index=False, header=False)
+
+
+def count_store_segments(store_path, chromosomes=None):
+    """Number of segments in a store (or in the given chromosomes), from Parquet metadata."""
+    _require_pyarrow()
+    return sum(pa_parquet.ParquetFile(path).metadata.num_rows for chromosome, path in _store_partitions(store_path)
+               if chromosomes is None or chromosome in chromosomes)
+
+
+def read_segment_store(store_path, segment_format, chromosomes=None, min_cm=None, samples=None,
+                       columns=None, rename=None, registry=None):
+    """
+    Read segments from a chromosome-partitioned segment store.
+
+    Filters are pushed down: unselected chromosome partitions are never
+    opened, and row groups whose statistics rule out the min-cM or sample
+    filter are skipped without being decoded.
+
+    Parameters:
+        store_path (str): Store directory written by write_segment_store.
+        segment_format (str): Key of SEGMENT_FORMATS the store was written with.
+        chromosomes (list): Chromosomes to read (default: all).
+        min_cm (float): Keep segments with genetic_length >= min_cm.
+        samples (list): Keep segments involving any of these sample IDs.
+        columns (list): Format column names to keep (default: all of them).
+        rename (dict): {format column name: output name}, as for read_segments.
+        registry (SampleRegistry): Recode sample IDs to the registry, as for read_segments.
+
+    Returns:
+        pd.DataFrame: The matching segments, in chromosome then start order.
+    """
+    _require_pyarrow()
+    rename = rename or {}
+    layout = SEGMENT_FORMATS[segment_format]
+    columns = columns or [name for name, _ in layout]
+    partitioning = pa_dataset.partitioning(pa.schema([("chromosome", pa.int8())]), flavor="hive")
+    dataset = pa_dataset.dataset(store_path, format="parquet", partitioning=partitioning)
+
+    conditions = []
+    if chromosomes is not None:
+        conditions.append(pa_dataset.field("chromosome").isin([int(chrom) for chrom in chromosomes]))
+    if min_cm is not None:
+        conditions.append(pa_dataset.field("genetic_length") >= min_cm)
+    if samples is not None:
+        samples = [str(sample) for sample in samples]
+        conditions.append(pa_dataset.field("id1").isin(samples) | pa_dataset.field("id2").isin(samples))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+
+    # Partitions are listed in path order (chromosome=10 before chromosome=2)
+    fragments = sorted(dataset.get_fragments(filter=condition),
+                       key=lambda fragment: pa_dataset.get_partition_keys(fragment.partition_expression)["chromosome"])
+    tables = [fragment.to_table(schema=dataset.schema, columns=columns, filter=condition) for fragment in fragments]
+    table = pa.concat_tables(tables) if tables else dataset.schema.empty_table().select(columns)
+    df = table.to_pandas(self_destruct=True, split_blocks=True)
+    return _intern_ids(df.rename(columns=rename), registry, rename)
+
+
+def build_segment_index(store_path, buffer_rows=MERGE_BUFFER_ROWS):
+    """
+    Write the sidecar index of a segment store to <store>/_index.
+
+    regions.parquet has one row per row group of every partition: chromosome,
+    row group, rows, first and last start and the largest end. Partitions
+    are sorted by start, so like a tabix linear index it tells a region
+    query which few row groups can overlap it.
+
+    pairs.parquet maps every pair of samples (IDs in sorted order) to the
+    (chromosome, row group) locations holding its segments. It is sorted by
+    pair in small row groups, so a lookup reads a few KB of it. Pair
+    entries are sorted in spilled runs when they exceed buffer_rows.
+    """
+    _require_pyarrow()
+    index_dir = os.path.join(store_path, STORE_INDEX_DIR)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.makedirs(index_dir)
+    temp_dir = tempfile.mkdtemp(prefix="_build-", dir=index_dir)
+    sort_by = ["id_a", "id_b", "chromosome", "row_group"]
+    regions = []
+    runs, buffer, buffered = [], [], 0
+    try:
+        for chromosome, path in _store_partitions(store_path):
+            parquet = pa_parquet.ParquetFile(path)
+            for group in range(parquet.num_row_groups):
+                table = parquet.read_row_group(
+                    group, columns=["id1", "id2", "physical_position_start", "physical_position_end"])
+                starts = table.column("physical_position_start").to_numpy()
+                ends = table.column("physical_position_end").to_numpy()
+                regions.append((chromosome, group, table.num_rows, starts.min(), starts.max(), ends.max()))
+
+                id1 = table.column("id1").cast(pa.string())
+                id2 = table.column("id2").cast(pa.string())
+                ordered = pa_compute.less_equal(id1, id2)
+                pairs = pa.table({"id_a": pa_compute.if_else(ordered, id1, id2),
+                                  "id_b": pa_compute.if_else(ordered, id2, id1)})
+                pairs = pairs.group_by(["id_a", "id_b"]).aggregate([])
+                pairs = pairs.append_column("chromosome", pa.array(np.full(pairs.num_rows, chromosome, np.int8)))
+                pairs = pairs.append_column("row_group", pa.array(np.full(pairs.num_rows, group, np.int32)))
+                buffer.append(pairs)
+                buffered += pairs.num_rows
+                if buffered > buffer_rows:
+                    runs.append(os.path.join(temp_dir, f"run{len(runs)}.parquet"))
+                    _write_run(_sort_table(pa.concat_tables(buffer), sort_by), runs[-1])
+                    buffer, buffered = [], 0
+
+        pairs_path = os.path.join(index_dir, "pairs.parquet")
+        schema = pa.schema([("id_a", pa.string()), ("id_b", pa.string()),
+                            ("chromosome", pa.int8()), ("row_group", pa.int32())])
+        if buffer or not runs:
+            pairs = _sort_table(pa.Table.from_batches([], schema=schema) if not buffer
+                                else pa.concat_tables(buffer), sort_by)
+            if not runs:
+                _write_run(pairs, pairs_path, PAIR_INDEX_ROW_GROUP_SIZE)
+            else:
+                runs.append(os.path.join(temp_dir, f"run{len(runs)}.parquet"))
+                _write_run(pairs, runs[-1])
+        if runs:
+            _merge_runs(runs, pairs_path, sort_by, buffer_rows, PAIR_INDEX_ROW_GROUP_SIZE)
+
+        regions = pd.DataFrame(regions, columns=["chromosome", "row_group", "num_rows",
+                                                 "min_start", "max_start", "max_end"])
+        pa_parquet.write_table(pa.Table.from_pandas(regions, preserve_index=False),
+                               os.path.join(index_dir, "regions.parquet"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class SegmentFile:
+    """
+    Region and pair lookups on a segment store through its sidecar index
+    (build_segment_index), reading only the row groups that can match.
+
+    Usage:
+        segments = SegmentFile("hap_ibd_MergedSamples.parquet", "hapibd")
+        df = segments.query(1, 20_000_000, 25_000_000)
+        df = segments.pair("user1", "user2")
+    """
+
+    def __init__(self, store_path, segment_format):
+        _require_pyarrow()
+        if not os.path.isdir(store_path):
+            # The merged TSV name stands for its store
+            store_path = segment_store_path(store_path)
+        index_dir = os.path.join(store_path, STORE_INDEX_DIR)
+        if not os.path.isfile(os.path.join(index_dir, "pairs.parquet")):
+            raise FileNotFoundError(f"No segment index in {store_path}; run build_segment_index first")
+        self.store_path = store_path
+        self.segment_format = segment_format
+        self.regions = pd.read_parquet(os.path.join(index_dir, "regions.parquet"))
+        self._partitions = dict(_store_partitions(store_path))
+        self._files = {}
+
+        # Pair index row groups are sorted by id_a, so their min/max id_a
+        # locate the groups that can hold a pair
+        self._pairs = pa_parquet.ParquetFile(os.path.join(index_dir, "pairs.parquet"))
+        metadata = self._pairs.metadata
+        statistics = [metadata.row_group(group).column(0).statistics for group in range(metadata.num_row_groups)]
+        if all(stats is not None and stats.has_min_max for stats in statistics):
+            self._pair_bounds = ([stats.min for stats in statistics], [stats.max for stats in statistics])
+        else:
+            self._pair_bounds = None
+
+    def _partition(self, chromosome):
+        if chromosome not in self._files:
+            self._files[chromosome] = pa_parquet.ParquetFile(self._partitions[chromosome])
+        return self._files[chromosome]
+
+    def _read(self, locations, predicate, predicate_columns, columns, rename):
+        """Rows of the given {chromosome: row groups} that pass predicate(table), in store order."""
+        names = [name for name, _ in SEGMENT_FORMATS[self.segment_format]]
+        columns = columns or names
+        stored = [name for name in names if name != "chromosome"
+                  and (name in columns or name in predicate_columns)]
+        tables = []
+        for chromosome in sorted(locations):
+            table = self._partition(chromosome).read_row_groups(sorted(locations[chromosome]), columns=stored)
+            table = table.filter(predicate(table))
+            table = table.append_column("chromosome", pa.array(np.full(table.num_rows, chromosome, np.int8)))
+            tables.append(table.select(columns).replace_schema_metadata(None))
+        if not tables:
+            return pd.DataFrame(columns=[(rename or {}).get(name, name) for name in columns])
+        df = pa.concat_tables(tables, promote_options="default").to_pandas(self_destruct=True, split_blocks=True)
+        return df.rename(columns=rename or {})
+
+    def query(self, chromosome, start, end, columns=None, rename=None):
+        """
+        Segments on a chromosome that overlap [start, end].
+
+        Parameters:
+            chromosome (int): Chromosome.
+            start (int): Region start (bp).
+            end (int): Region end (bp).
+            columns (list): Format column names to return (default: all of them).
+            rename (dict): {format column name: output name}, as for read_segments.
+
+        Returns:
+            pd.DataFrame: The overlapping segments, in start order.
+        """
+        chromosome = int(chromosome)
+        regions = self.regions[(self.regions["chromosome"] == chromosome)
+                               & (self.regions["min_start"] <= end) & (self.regions["max_end"] >= start)]
+        locations = {chromosome: regions["row_group"].tolist()} if len(regions) else {}
+        return self._read(
+            locations,
+            lambda table: pa_compute.and_(pa_compute.less_equal(table.column("physical_position_start"), end),
+                                          pa_compute.greater_equal(table.column("physical_position_end"), start)),
+            ["physical_position_start", "physical_position_end"], columns, rename)
+
+    def pair(self, id1, id2, columns=None, rename=None):
+        """
+        Segments shared by two samples, in either ID order.
+
+        Parameters:
+            id1 (str): First sample ID.
+            id2 (str): Second sample ID.
+            columns (list): Format column names to return (default: all of them).
+            rename (dict): {format column name: output name}, as for read_segments.
+
+        Returns:
+            pd.DataFrame: The pair's segments, in chromosome then start order.
+        """
+        id_a, id_b = sorted((str(id1), str(id2)))
+        if self._pair_bounds is None:
+            groups = list(range(self._pairs.metadata.num_row_groups))
+        else:
+            lows, highs = self._pair_bounds
+            groups = list(range(bisect.bisect_left(highs, id_a), bisect.bisect_right(lows, id_a)))
+        locations = {}
+        if groups:
+            entries = self._pairs.read_row_groups(groups)
+            entries = entries.filter(pa_compute.and_(pa_compute.equal(entries.column("id_a"), id_a),
+                                                     pa_compute.equal(entries.column("id_b"), id_b)))
+            for chromosome, group in zip(entries.column("chromosome").to_pylist(),
+                                         entries.column("row_group").to_pylist()):
+                locations.setdefault(chromosome, []).append(group)
+
+        def predicate(table):
+            id1_column = table.column("id1").cast(pa.string())
+            id2_column = table.column("id2").cast(pa.string())
+            return pa_compute.or_(
+                pa_compute.and_(pa_compute.equal(id1_column, id_a), pa_compute.equal(id2_column, id_b)),
+                pa_compute.and_(pa_compute.equal(id1_column, id_b), pa_compute.equal(id2_column, id_a)))
+
+        return self._read(locations, predicate, ["id1", "id2"], columns, rename)
+
+
+def verify_chromosome_names():
+    """
+    Check that "chr"-prefixed and X/Y chromosome names are coded by every
+    reader and by merged stores, and that unrecognised ones are skipped
+    with a warning giving the number of segments dropped.
+    """
+    rows = [("chr1", 1), ("chr1", 1), ("chrX", 23), ("X", 23), ("chrY", 24), ("7", 7), ("chrUn_gl000220", None)]
+    lines = [f"user{i}\t0\tuser{i + 1}\t1\t{name}\t{1000 * (i + 1)}\t{1000 * (i + 2)}\t{5.0 + i}\n"
+             for i, (name, _) in enumerate(rows)]
+    expected = [code for _, code in rows if code is not None]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "chr_names.ibd")
+        with open(path, "w") as f:
+            f.writelines(lines)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            df = read_segments(path, "hapibd")
+            scanned, _ = scan_segments(path, "hapibd", chromosomes=["chrX", 7])
+            store_path = os.path.join(tmp_dir, "chr_names.parquet")
+            merge_segment_files([path], store_path, "hapibd", index=False)
+        assert df["chromosome"].dtype == np.int8, f"chromosome has dtype {df['chromosome'].dtype}"
+        assert df["chromosome"].tolist() == expected, f"read_segments coded {df['chromosome'].tolist()}"
+        assert sorted(scanned["chromosome"].tolist()) == [7, 23, 23], "scan_segments chromosome filter"
+        stored = read_segment_store(store_path, "hapibd")
+        assert sorted(stored["chromosome"].tolist()) == sorted(expected), "merged store chromosomes"
+        messages = [str(warning.message) for warning in caught]
+        assert len(messages) == 3 and all("skipped 1 segments" in message for message in messages), messages
+    print(f"Chromosome names: {len(expected)} of {len(rows)} segments coded, 1 skipped with a warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Typed readers and stores for IBD segment files.")
+    parser.add_argument("--verify", action="store_true", help="Check chromosome name coding in every reader.")
+    args = parser.parse_args()
+    if args.verify:
+        verify_chromosome_names()
+
+
+if __name__ == "__main__":
+    main()
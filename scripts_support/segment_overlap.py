@@ -0,0 +1,723 @@
+"""
+Overlap of detected IBD segments with truth segments
+
+Matches every segment reported by a detection tool to the truth segment it
+overlaps most, the way the Lab 8 evaluation scores IBIS, Refined-IBD and
+hap-IBD against ped-sim. Truth segments are sorted by (sample pair,
+chromosome, start) into flat arrays; tool segments are looked up with a
+sweep-line merge join done by searchsorted, so no per-row Python runs and
+no interval tree is built.
+
+Every truth segment is indexed, at about 40 bytes per segment. Tool
+segments are matched in chunks whose candidate pairs fit a memory budget,
+so millions of truth and tool segments are compared exactly without the
+working set growing with them.
+
+Matching rules:
+    - the pair is unordered: (A, B) matches truth recorded as (B, A);
+    - a tool segment is first matched against truth segments of the same
+      (sample, haplotype) pair, and only if none of those overlaps it,
+      against every truth segment of the sample pair;
+    - the best match is the one with the longest overlap (ties go to the
+      lowest truth segment ID); the overlap fraction is that length over
+      the tool segment length.
+
+Usage:
+    from scripts_support.segment_overlap import TruthIndex
+    index = TruthIndex(truth_df)
+    overlap_fraction, truth_id = index.best_overlaps(tool_df)
+    curves = accuracy_curves(overlap_fraction, tool_df["cM"], truth_id, truth_df["segment_id"], truth_df["cM"])
+
+    python -m scripts_support.segment_overlap --verify
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from scripts_support.sample_registry import SampleRegistry
+
+# Memory allowed for the candidate (tool, truth) pairs of one chunk of tool segments
+DEFAULT_MEMORY_BUDGET = 256 << 20
+
+# Bytes held per candidate pair while a chunk is matched
+CANDIDATE_BYTES = 96
+
+# Sorted truth arrays and settings a matching worker needs
+TRUTH_ARRAYS = ("group_keys", "keyed_starts", "keyed_max_ends", "starts", "ends", "codes1",
+                "haplotypes1", "haplotypes2", "segment_ids")
+TRUTH_SETTINGS = ("span", "num_samples", "num_chromosomes", "memory_budget")
+
+# Overlap thresholds and segment length bins (cM) of the accuracy curves
+CURVE_THRESHOLDS = tuple(round(0.1 * step, 1) for step in range(1, 10))
+CURVE_LENGTH_BINS = (1, 3, 5, 10, np.inf)
+
+
+def _pair_codes(codes1, codes2):
+    """Unordered pair of sample codes as (lower, higher)."""
+    return np.minimum(codes1, codes2), np.maximum(codes1, codes2)
+
+
+def _haplotypes(df, column):
+    if column not in df.columns:
+        return np.zeros(len(df), dtype=np.int8)
+    return pd.to_numeric(df[column], errors="coerce").fillna(-1).to_numpy(np.int8)
+
+
+class TruthIndex:
+    """
+    Truth segments sorted by (sample pair, chromosome, start).
+
+    Parameters:
+        truth_df (pd.DataFrame): Truth segments with sample1, sample2, chrom,
+                                 start, end, segment_id and optionally
+                                 sample1_haplotype/sample2_haplotype columns.
+        registry (SampleRegistry): Registry the sample IDs of truth and tool
+                                   frames are coded with. Columns already
+                                   recoded with it are used as they are.
+        memory_budget (int): Bytes allowed for the candidate pairs of one
+                             chunk of tool segments.
+    """
+
+    def __init__(self, truth_df, registry=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.registry = registry if registry is not None else SampleRegistry()
+        codes1 = self.registry.encode(truth_df["sample1"]).astype(np.int64)
+        codes2 = self.registry.encode(truth_df["sample2"]).astype(np.int64)
+        self.chromosomes = pd.Index(pd.unique(truth_df["chrom"].to_numpy()))
+        chrom_codes = self.chromosomes.get_indexer(truth_df["chrom"].to_numpy()).astype(np.int64)
+        # Key sizes are fixed here, so IDs the registry gains later cannot shift them
+        self.num_samples = max(len(self.registry), 1)
+        self.num_chromosomes = max(len(self.chromosomes), 1)
+        keys = self._group_keys(codes1, codes2, chrom_codes)
+
+        starts = truth_df["start"].to_numpy(np.int64)
+        ends = truth_df["end"].to_numpy(np.int64)
+        # Positions are offset by group * span, so one sorted array holds
+        # every group one after another and searchsorted stays in a group
+        self.span = int(max(ends.max(initial=0), starts.max(initial=0))) + 1
+        self.group_keys, groups = np.unique(keys, return_inverse=True)
+        order = np.lexsort((starts, groups))
+        offsets = groups[order] * self.span
+
+        self.starts = starts[order].astype(np.int32)
+        self.ends = ends[order].astype(np.int32)
+        self.keyed_starts = offsets + starts[order]
+        # Running maximum of the ends within each group: the truth segments
+        # that can still overlap a position are those past the first whose
+        # running maximum end lies beyond it
+        self.keyed_max_ends = np.maximum.accumulate(offsets + ends[order])
+        self.codes1 = codes1[order].astype(np.int32)
+        self.haplotypes1 = _haplotypes(truth_df, "sample1_haplotype")[order]
+        self.haplotypes2 = _haplotypes(truth_df, "sample2_haplotype")[order]
+        self.segment_ids = truth_df["segment_id"].to_numpy(np.int64)[order]
+        # cM per bp of each group, for converting covered bp to cM
+        if "cM" in truth_df.columns:
+            lengths_cm = pd.to_numeric(truth_df["cM"], errors="coerce").fillna(0).to_numpy(np.float64)
+            group_bp = np.bincount(groups, weights=ends - starts, minlength=len(self.group_keys))
+            group_cm = np.bincount(groups, weights=lengths_cm, minlength=len(self.group_keys))
+            self.cm_per_bp = np.divide(group_cm, group_bp, out=np.zeros_like(group_cm), where=group_bp > 0)
+        else:
+            self.cm_per_bp = None
+        self._truth_union = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _group_keys(self, codes1, codes2, chrom_codes):
+        low, high = _pair_codes(codes1, codes2)
+        return (low * self.num_samples + high) * self.num_chromosomes + chrom_codes
+
+    def tool_arrays(self, tool_df):
+        """The columns of a tool frame the matching reads, coded like the truth, as NumPy arrays."""
+        return {
+            "codes1": self.registry.encode(tool_df["sample1"], add=False).astype(np.int64),
+            "codes2": self.registry.encode(tool_df["sample2"], add=False).astype(np.int64),
+            "chrom_codes": self.chromosomes.get_indexer(tool_df["chrom"].to_numpy()).astype(np.int64),
+            "starts": tool_df["start"].to_numpy(np.int64),
+            "ends": tool_df["end"].to_numpy(np.int64),
+            "haplotypes1": _haplotypes(tool_df, "sample1_haplotype"),
+            "haplotypes2": _haplotypes(tool_df, "sample2_haplotype"),
+        }
+
+    def _sorted_groups(self, tool):
+        """
+        Truth group of each tool row, in group order.
+
+        Returns:
+            tuple: (order of the rows by group, their groups in that order,
+                    whether each row (in row order) has a truth group).
+        """
+        codes1, codes2, chrom_codes = tool["codes1"], tool["codes2"], tool["chrom_codes"]
+        known = ((codes1 >= 0) & (codes1 < self.num_samples) & (codes2 >= 0) & (codes2 < self.num_samples)
+                 & (chrom_codes >= 0))
+        keys = self._group_keys(codes1, codes2, chrom_codes)
+        # Lookups run in key order, so consecutive searches land on nearby
+        # truth rows (several times faster than searching in row order)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        groups = np.searchsorted(self.group_keys, keys)
+        groups = np.minimum(groups, max(len(self.group_keys) - 1, 0))
+        if len(self.group_keys):
+            known[order] &= self.group_keys[groups] == keys
+        else:
+            known[:] = False
+        return order, groups, known
+
+    def candidate_ranges(self, tool):
+        """
+        Sorted truth rows [first, first + count) of each tool segment: the
+        rows of the same sample pair and chromosome whose intervals may
+        overlap it.
+
+        Parameters:
+            tool (dict): Arrays from tool_arrays (or a slice of them).
+
+        Returns:
+            tuple: (first, count), one entry per tool row.
+        """
+        order, groups, known = self._sorted_groups(tool)
+
+        # Positions past every truth end are clipped so lookups cannot run
+        # into the next group
+        offsets = groups * self.span
+        starts = np.clip(tool["starts"][order], 0, self.span)
+        ends = np.clip(tool["ends"][order], 0, self.span)
+        # Truth rows [first, last) start before the tool segment ends and
+        # follow the first whose running maximum end passes its start
+        first = np.empty(len(order), dtype=np.int64)
+        last = np.empty(len(order), dtype=np.int64)
+        first[order] = np.searchsorted(self.keyed_max_ends, offsets + starts, side="right")
+        last[order] = np.searchsorted(self.keyed_starts, offsets + ends, side="left")
+        counts = np.where(known, np.maximum(last - first, 0), 0)
+        return first, counts
+
+    def chunks(self, counts):
+        """
+        Tool row slices whose candidate pairs fit the memory budget (a
+        single row with more candidates gets a slice of its own).
+        """
+        limit = max(self.memory_budget // CANDIDATE_BYTES, 1)
+        total = np.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            done = total[start - 1] if start else 0
+            stop = max(int(np.searchsorted(total, done + limit, side="right")), start + 1)
+            yield slice(start, stop)
+            start = stop
+
+    def coverage(self, tool_df):
+        """
+        Genome coverage of a tool against the truth, by interval arithmetic.
+
+        Within each (sample pair, chromosome) the truth segments and the tool
+        segments are each merged into their union, and the unions are
+        intersected. All groups are laid end to end on one line (group *
+        span + position) so this is a few sorts and cumulative sums over
+        all segments at once.
+
+        Returns:
+            dict: truth_bp, tool_bp and overlap_bp (union and intersection
+                  lengths, summed over groups). If the truth has a cM column,
+                  also truth_cm and overlap_cm, converted with each group's
+                  cM per bp.
+        """
+        tool = self.tool_arrays(tool_df) if len(tool_df) else None
+        span = self.span if tool is None else max(int(tool["ends"].max()) + 1, self.span)
+        group_count = len(self.group_keys)
+        # The truth is already sorted on its line; only the spacing of the groups changes
+        truth_starts, truth_ends = self.truth_union()
+        truth_groups = truth_starts // self.span
+        truth_starts = truth_starts + truth_groups * (span - self.span)
+        truth_ends = truth_ends + truth_groups * (span - self.span)
+        truth_bp = np.bincount(truth_groups, weights=truth_ends - truth_starts, minlength=group_count)
+        result = {"truth_bp": int(truth_bp.sum()), "tool_bp": 0, "overlap_bp": 0}
+        if self.cm_per_bp is not None:
+            result.update(truth_cm=float(truth_bp @ self.cm_per_bp), overlap_cm=0.0)
+        if tool is None:
+            return result
+
+        # Tool segments of pairs the truth has, on the truth's line
+        order, groups, known = self._sorted_groups(tool)
+        rows, groups = order[known[order]], groups[known[order]]
+        matched_starts, matched_ends = _union(groups * span + tool["starts"][rows],
+                                              groups * span + tool["ends"][rows])
+        overlap_starts, overlap_lengths = _intersection(truth_starts, truth_ends, matched_starts, matched_ends)
+        overlap_bp = np.bincount(overlap_starts // span, weights=overlap_lengths, minlength=group_count)
+        result["overlap_bp"] = int(overlap_bp.sum())
+        if self.cm_per_bp is not None:
+            result["overlap_cm"] = float(overlap_bp @ self.cm_per_bp)
+
+        # Tool segments of other pairs only add to the tool's own union
+        result["tool_bp"] = int((matched_ends - matched_starts).sum())
+        if not known.all():
+            other = tool_df[~known]
+            pairs = SampleRegistry()
+            low, high = _pair_codes(pairs.encode(other["sample1"]).astype(np.int64),
+                                    pairs.encode(other["sample2"]).astype(np.int64))
+            chrom_codes, _ = pd.factorize(other["chrom"])
+            _, other_groups = np.unique((low * len(pairs) + high) * (chrom_codes.max() + 2) + chrom_codes + 1,
+                                        return_inverse=True)
+            other_starts, other_ends = _union(other_groups * span + tool["starts"][~known],
+                                              other_groups * span + tool["ends"][~known])
+            result["tool_bp"] += int((other_ends - other_starts).sum())
+        return result
+
+    def truth_union(self):
+        """Union of the truth segments of each group, on the group line (group * span + position)."""
+        if self._truth_union is None:
+            self._truth_union = _union(self.keyed_starts, self.keyed_starts - self.starts + self.ends,
+                                       presorted=True)
+        return self._truth_union
+
+    def best_overlaps(self, tool_df, haplotype_fallback=True):
+        """
+        Best truth match of every tool segment.
+
+        Parameters:
+            tool_df (pd.DataFrame): Tool segments with sample1, sample2,
+                                    chrom, start, end and optionally
+                                    haplotype columns (missing ones count as 0).
+            haplotype_fallback (bool): Match against the whole sample pair
+                                       when no haplotype-matched truth
+                                       segment overlaps.
+
+        Returns:
+            tuple: (overlap fraction as float64, truth segment ID as int64
+                    with -1 where nothing overlaps), one entry per tool row.
+        """
+        if len(tool_df) == 0 or len(self) == 0:
+            return _unmatched(len(tool_df))
+        tool = self.tool_arrays(tool_df)
+        matches = self.match_rows(tool, slice(0, len(tool_df)), haplotype_fallback)
+        return _fill_matches(tool, matches)
+
+    def best_overlaps_many(self, tool_dfs, haplotype_fallback=True, workers=None):
+        """
+        best_overlaps of several tool frames, sharded by (frame, chromosome)
+        across a process pool.
+
+        The truth arrays and the tool columns are copied once into shared
+        memory, which the workers map instead of receiving pickled frames;
+        each worker sends back only the matched rows of its shard.
+
+        Parameters:
+            tool_dfs (list): Tool segment frames.
+            haplotype_fallback (bool or list): As for best_overlaps, for all
+                                               frames or one per frame.
+            workers (int): Worker processes (default: one per core). With
+                           one, the frames are matched in this process.
+
+        Returns:
+            list: (overlap fraction, truth segment ID) of each frame.
+        """
+        if isinstance(haplotype_fallback, bool):
+            haplotype_fallback = [haplotype_fallback] * len(tool_dfs)
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or len(self) == 0:
+            return [self.best_overlaps(tool_df, fallback)
+                    for tool_df, fallback in zip(tool_dfs, haplotype_fallback)]
+
+        # Every frame's rows are ordered by chromosome and the frames laid
+        # end to end, so each shard is one contiguous slice of the arrays
+        tools, shards, frame_offset = [], [], 0
+        for tool_df, fallback in zip(tool_dfs, haplotype_fallback):
+            if len(tool_df) == 0:
+                continue
+            tool = self.tool_arrays(tool_df)
+            order = np.argsort(tool_df["chrom"].to_numpy(), kind="stable")
+            tool = {name: values[order] for name, values in tool.items()}
+            tool["rows"] = order
+            chrom_starts = np.flatnonzero(np.r_[True, np.diff(tool_df["chrom"].to_numpy()[order]) != 0])
+            for start, stop in zip(chrom_starts, np.r_[chrom_starts[1:], len(order)]):
+                if stop > start:
+                    shards.append((slice(frame_offset + start, frame_offset + stop), fallback))
+            tools.append(tool)
+            frame_offset += len(tool_df)
+        if not shards:
+            return [_unmatched(len(tool_df)) for tool_df in tool_dfs]
+        combined = {name: np.concatenate([tool[name] for tool in tools]) for name in tools[0]}
+        # The largest shards go first so no worker is left with a long one at the end
+        shards.sort(key=lambda shard: shard[0].start - shard[0].stop)
+
+        shared = SharedArrays({**{f"truth_{name}": getattr(self, name) for name in TRUTH_ARRAYS},
+                               **{f"tool_{name}": values for name, values in combined.items() if name != "rows"}})
+        settings = {name: getattr(self, name) for name in TRUTH_SETTINGS}
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+                futures = [pool.submit(_match_shard, shared.layout, settings, rows, fallback)
+                           for rows, fallback in shards]
+                matches = [future.result() for future in futures]
+        finally:
+            shared.close()
+
+        overlap_fraction, truth_id = _fill_matches(combined, _concatenate_matches(matches))
+        results, frame_offset, tools = [], 0, iter(tools)
+        for tool_df in tool_dfs:
+            if len(tool_df) == 0:
+                results.append(_unmatched(0))
+                continue
+            tool = next(tools)
+            rows = slice(frame_offset, frame_offset + len(tool["rows"]))
+            frame_fraction, frame_truth_id = _unmatched(len(tool["rows"]))
+            frame_fraction[tool["rows"]] = overlap_fraction[rows]
+            frame_truth_id[tool["rows"]] = truth_id[rows]
+            results.append((frame_fraction, frame_truth_id))
+            frame_offset += len(tool["rows"])
+        return results
+
+    def match_rows(self, tool, rows, haplotype_fallback):
+        """Best overlapping truth row of the tool rows in a slice, as (tool rows, overlap, truth IDs)."""
+        part = {name: values[rows] for name, values in tool.items()}
+        part["first"], part["counts"] = self.candidate_ranges(part)
+        tool_rows, overlap, segment_ids = _concatenate_matches(
+            [self._match_chunk(part, chunk, haplotype_fallback) for chunk in self.chunks(part["counts"])])
+        return tool_rows + rows.start, overlap, segment_ids
+
+    def _match_chunk(self, tool, rows, haplotype_fallback):
+        """Best overlapping truth row of the tool rows in a slice, as (tool rows, overlap, truth IDs)."""
+        counts = tool["counts"][rows]
+        tool_rows = np.repeat(np.arange(rows.start, rows.stop), counts)
+        run_starts = np.cumsum(counts) - counts
+        positions = np.arange(len(tool_rows)) - np.repeat(run_starts, counts)
+        truth_rows = tool["first"][tool_rows] + positions
+
+        overlap = (np.minimum(tool["ends"][tool_rows], self.ends[truth_rows])
+                   - np.maximum(tool["starts"][tool_rows], self.starts[truth_rows]))
+        overlapping = overlap > 0
+        tool_rows, truth_rows, overlap = tool_rows[overlapping], truth_rows[overlapping], overlap[overlapping]
+
+        # The haplotypes match when each tool sample has the haplotype the
+        # truth records for that sample, whichever order the pair is in
+        tool_haplotypes1 = tool["haplotypes1"][tool_rows]
+        tool_haplotypes2 = tool["haplotypes2"][tool_rows]
+        same_order = self.codes1[truth_rows] == tool["codes1"][tool_rows]
+        truth_haplotypes1 = self.haplotypes1[truth_rows]
+        truth_haplotypes2 = self.haplotypes2[truth_rows]
+        haplotype_match = np.where(same_order,
+                                   (truth_haplotypes1 == tool_haplotypes1) & (truth_haplotypes2 == tool_haplotypes2),
+                                   (truth_haplotypes1 == tool_haplotypes2) & (truth_haplotypes2 == tool_haplotypes1))
+        if haplotype_fallback:
+            has_haplotype_match = np.zeros(rows.stop - rows.start, dtype=bool)
+            has_haplotype_match[tool_rows[haplotype_match] - rows.start] = True
+            eligible = haplotype_match | ~has_haplotype_match[tool_rows - rows.start]
+        else:
+            eligible = haplotype_match
+        tool_rows, truth_rows, overlap = tool_rows[eligible], truth_rows[eligible], overlap[eligible]
+
+        # Longest overlap first, then lowest truth ID, within each tool row
+        segment_ids = self.segment_ids[truth_rows]
+        order = np.lexsort((segment_ids, -overlap, tool_rows))
+        tool_rows, overlap, segment_ids = tool_rows[order], overlap[order], segment_ids[order]
+        best = np.flatnonzero(np.r_[True, tool_rows[1:] != tool_rows[:-1]]) if len(tool_rows) else tool_rows
+        return tool_rows[best], overlap[best], segment_ids[best]
+
+
+def _union(starts, ends, presorted=False):
+    """Union of intervals on a line, as the sorted starts and ends of its disjoint runs."""
+    if len(starts) == 0:
+        return starts, ends
+    if not presorted:
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+    max_ends = np.maximum.accumulate(ends)
+    run_start = np.r_[True, starts[1:] > max_ends[:-1]]
+    run_end = np.r_[run_start[1:], True]
+    return starts[run_start], max_ends[run_end]
+
+
+def _intersection(starts1, ends1, starts2, ends2):
+    """
+    Intersection of two unions of disjoint intervals, as (start, length)
+    of each piece: the stretches where both sets cover the line.
+    """
+    positions = np.concatenate([starts1, ends1, starts2, ends2])
+    steps = np.repeat(np.array([1, -1, 1, -1], np.int8), [len(starts1), len(ends1), len(starts2), len(ends2)])
+    order = np.argsort(positions, kind="stable")
+    positions, depth = positions[order], np.cumsum(steps[order])
+    both = np.flatnonzero(depth[:-1] == 2)
+    lengths = positions[both + 1] - positions[both]
+    return positions[both][lengths > 0], lengths[lengths > 0]
+
+
+def _length_bin_labels(length_bins):
+    labels = []
+    for low, high in zip(length_bins[:-1], length_bins[1:]):
+        labels.append(f"{low:g}+ cM" if np.isinf(high) else f"{low:g}-{high:g} cM")
+    return labels + ["All"]
+
+
+def _counts_at_least(values, bins, num_bins, thresholds):
+    """
+    Counts of values at or above each threshold, per bin, from one histogram.
+
+    Returns:
+        tuple: (counts, shape (num_bins + 1, thresholds); totals, shape
+                (num_bins + 1,)). The last row is every value, including
+                those outside the bins.
+    """
+    slots = len(thresholds) + 1
+    # Slot 0 holds values below the first threshold, slot k + 1 those in [t_k, t_k+1)
+    slot = np.searchsorted(thresholds, values, side="right")
+    histogram = np.bincount(bins * slots + slot, minlength=(num_bins + 1) * slots).reshape(num_bins + 1, slots)
+    histogram = np.vstack([histogram[:num_bins], histogram.sum(axis=0)])
+    at_least = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+    return at_least[:, 1:], histogram.sum(axis=1)
+
+
+def accuracy_curves(overlap_fraction, segment_cm, truth_id, truth_segment_ids, truth_cm,
+                    thresholds=CURVE_THRESHOLDS, length_bins=CURVE_LENGTH_BINS):
+    """
+    Precision, recall and F1 of one tool at every overlap threshold, per
+    segment length bin, from its best-overlap arrays (no re-matching).
+
+    A tool segment is a true positive at threshold t when its best overlap
+    fraction is at least t; precision of a bin is over the tool segments of
+    that length. A truth segment is recovered at t when some tool segment
+    matched to it overlaps at least t; recall of a bin is over the truth
+    segments of that length. Every (bin, threshold) cell comes from one
+    histogram and a cumulative sum per side.
+
+    Parameters:
+        overlap_fraction, truth_id: best_overlaps output of the tool.
+        segment_cm: cM length of each tool segment.
+        truth_segment_ids, truth_cm: ID and cM length of every truth segment.
+        thresholds: Overlap fractions to evaluate, ascending.
+        length_bins: Bin edges in cM; the last may be inf.
+
+    Returns:
+        pd.DataFrame: One row per (length bin, threshold) plus an "All"
+                      bin, with segment counts, Precision, Recall and F1 Score.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    edges = np.asarray(length_bins, dtype=np.float64)
+    num_bins = len(edges) - 1
+
+    def length_bins_of(lengths):
+        bins = np.searchsorted(edges, np.asarray(lengths, dtype=np.float64), side="right") - 1
+        return np.where((bins >= 0) & (bins < num_bins), bins, num_bins)
+
+    overlap_fraction = np.asarray(overlap_fraction, dtype=np.float64)
+    detected, segments = _counts_at_least(overlap_fraction, length_bins_of(segment_cm), num_bins, thresholds)
+
+    # Best overlap each truth segment got from any tool segment matched to it
+    truth_id = np.asarray(truth_id, dtype=np.int64)
+    positions = pd.Index(np.asarray(truth_segment_ids)).get_indexer(truth_id[truth_id >= 0])
+    truth_best = np.zeros(len(truth_segment_ids), dtype=np.float64)
+    np.maximum.at(truth_best, positions[positions >= 0], overlap_fraction[truth_id >= 0][positions >= 0])
+    recovered, truth_segments = _counts_at_least(truth_best, length_bins_of(truth_cm), num_bins, thresholds)
+
+    precision = np.divide(detected, segments[:, None], out=np.zeros(detected.shape), where=segments[:, None] > 0)
+    recall = np.divide(recovered, truth_segments[:, None], out=np.zeros(recovered.shape),
+                       where=truth_segments[:, None] > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(precision.shape),
+                   where=(precision + recall) > 0)
+
+    labels = _length_bin_labels(list(length_bins))
+    return pd.DataFrame({
+        "Length Bin": np.repeat(labels, len(thresholds)),
+        "Threshold": np.tile(thresholds, len(labels)),
+        "Segments": np.repeat(segments, len(thresholds)),
+        "True Positives": detected.ravel(),
+        "Truth Segments": np.repeat(truth_segments, len(thresholds)),
+        "Recovered Truth Segments": recovered.ravel(),
+        "Precision": precision.ravel(),
+        "Recall": recall.ravel(),
+        "F1 Score": f1.ravel(),
+    })
+
+
+def _unmatched(num_rows):
+    return np.zeros(num_rows, dtype=np.float64), np.full(num_rows, -1, dtype=np.int64)
+
+
+def _concatenate_matches(matches):
+    if not matches:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    return tuple(np.concatenate(parts) for parts in zip(*matches))
+
+
+def _fill_matches(tool, matches):
+    """Per-row (overlap fraction, truth ID) arrays from the matched rows."""
+    tool_rows, overlap, segment_ids = matches
+    overlap_fraction, truth_id = _unmatched(len(tool["starts"]))
+    overlap_fraction[tool_rows] = overlap / (tool["ends"][tool_rows] - tool["starts"][tool_rows])
+    truth_id[tool_rows] = segment_ids
+    return overlap_fraction, truth_id
+
+
+class SharedArrays:
+    """
+    NumPy arrays copied into one shared memory block.
+
+    ``layout`` is a small picklable description (block name and the dtype,
+    shape and offset of each array) from which another process maps the
+    arrays with attach(), without copying them.
+    """
+
+    def __init__(self, arrays):
+        entries, offset = [], 0
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            offset = -(-offset // 64) * 64
+            entries.append((name, values.dtype.str, values.shape, offset))
+            offset += values.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (name, dtype, shape, start), values in zip(entries, arrays.values()):
+            np.ndarray(shape, dtype, self.shm.buf, start)[...] = values
+        self.layout = (self.shm.name, entries)
+
+    @staticmethod
+    def attach(layout):
+        """(block, {name: array}) of a layout; keep the block referenced while the arrays are used."""
+        shm = shared_memory.SharedMemory(name=layout[0])
+        arrays = {name: np.ndarray(shape, dtype, shm.buf, start) for name, dtype, shape, start in layout[1]}
+        return shm, arrays
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Shared blocks a worker has mapped, by name, with the index built on them
+_ATTACHED = {}
+
+
+def _match_shard(layout, settings, rows, haplotype_fallback):
+    """Worker side of best_overlaps_many: match one shard of the shared tool arrays."""
+    if layout[0] not in _ATTACHED:
+        shm, arrays = SharedArrays.attach(layout)
+        index = TruthIndex.__new__(TruthIndex)
+        index.__dict__.update(settings)
+        for name in TRUTH_ARRAYS:
+            setattr(index, name, arrays[f"truth_{name}"])
+        tool = {name[len("tool_"):]: values for name, values in arrays.items() if name.startswith("tool_")}
+        _ATTACHED.clear()
+        _ATTACHED[layout[0]] = (shm, index, tool)
+    _, index, tool = _ATTACHED[layout[0]]
+    return index.match_rows(tool, rows, haplotype_fallback)
+
+
+def _brute_force_overlaps(tool_df, truth_df):
+    """best_overlaps computed row by row, for verification."""
+    result = []
+    truth_rows = list(truth_df.itertuples(index=False))
+    for row in tool_df.itertuples(index=False):
+        best = {}
+        for truth in truth_rows:
+            if truth.chrom != row.chrom or {truth.sample1, truth.sample2} != {row.sample1, row.sample2}:
+                continue
+            overlap = min(row.end, truth.end) - max(row.start, truth.start)
+            if overlap <= 0:
+                continue
+            if truth.sample1 == row.sample1:
+                haplotype_match = (truth.sample1_haplotype, truth.sample2_haplotype) == (row.sample1_haplotype, row.sample2_haplotype)
+            else:
+                haplotype_match = (truth.sample1_haplotype, truth.sample2_haplotype) == (row.sample2_haplotype, row.sample1_haplotype)
+            candidate = (overlap, -truth.segment_id)
+            best[haplotype_match] = max(best.get(haplotype_match, candidate), candidate)
+        match = best.get(True, best.get(False))
+        result.append((match[0] / (row.end - row.start), -match[1]) if match else (0.0, -1))
+    return result
+
+
+def _brute_force_coverage(tool_df, truth_df):
+    """coverage computed group by group with Python interval merging, for verification."""
+    def merged(df):
+        groups = {}
+        for row in df.itertuples(index=False):
+            key = (frozenset((row.sample1, row.sample2)), row.chrom)
+            groups.setdefault(key, []).append((row.start, row.end))
+        result = {}
+        for key, intervals in groups.items():
+            runs = []
+            for start, end in sorted(intervals):
+                if runs and start <= runs[-1][1]:
+                    runs[-1][1] = max(runs[-1][1], end)
+                else:
+                    runs.append([start, end])
+            result[key] = runs
+        return result
+
+    truth, tool = merged(truth_df), merged(tool_df)
+    overlap_bp = sum(max(0, min(end1, end2) - max(start1, start2))
+                     for key, runs in tool.items() for start1, end1 in runs
+                     for start2, end2 in truth.get(key, []))
+    return {"truth_bp": sum(end - start for runs in truth.values() for start, end in runs),
+            "tool_bp": sum(end - start for runs in tool.values() for start, end in runs),
+            "overlap_bp": overlap_bp}
+
+
+def verify_against_brute_force(num_truth=2_000, num_tool=5_000, seed=0, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Check best_overlaps against a row-by-row scan on random segments."""
+    rng = np.random.default_rng(seed)
+    ids = np.array([f"user{i}" for i in range(30)], dtype=object)
+
+    def random_segments(n):
+        samples1 = rng.integers(0, len(ids), n)
+        samples2 = (samples1 + rng.integers(1, len(ids), n)) % len(ids)
+        starts = rng.integers(0, 20_000_000, n)
+        return pd.DataFrame({
+            "sample1": ids[samples1], "sample2": ids[samples2], "chrom": rng.integers(1, 4, n).astype(np.int8),
+            "start": starts, "end": starts + rng.integers(1, 5_000_000, n), "cM": rng.uniform(0.5, 15, n),
+            "sample1_haplotype": rng.integers(0, 2, n).astype(np.int8),
+            "sample2_haplotype": rng.integers(0, 2, n).astype(np.int8),
+            "segment_id": np.arange(n),
+        })
+
+    truth_df, tool_df = random_segments(num_truth), random_segments(num_tool)
+    index = TruthIndex(truth_df, memory_budget=memory_budget)
+    overlap_fraction, truth_id = index.best_overlaps(tool_df)
+    expected = _brute_force_overlaps(tool_df, truth_df)
+    assert np.allclose(overlap_fraction, [fraction for fraction, _ in expected]), "overlap fractions differ"
+    assert np.array_equal(truth_id, [segment_id for _, segment_id in expected]), "truth IDs differ"
+
+    # Curves against one mask per (bin, threshold) cell
+    curves = accuracy_curves(overlap_fraction, tool_df["cM"], truth_id, truth_df["segment_id"], truth_df["cM"])
+    truth_best = pd.Series(overlap_fraction[truth_id >= 0]).groupby(truth_id[truth_id >= 0]).max()
+    truth_best = truth_best.reindex(truth_df["segment_id"], fill_value=0.0).to_numpy()
+    edges = list(CURVE_LENGTH_BINS)
+    labels = _length_bin_labels(edges)
+    for row in curves.itertuples(index=False):
+        if row[0] == "All":
+            in_bin, truth_in_bin = np.ones(len(tool_df), bool), np.ones(len(truth_df), bool)
+        else:
+            low, high = edges[labels.index(row[0])], edges[labels.index(row[0]) + 1]
+            in_bin = (tool_df["cM"] >= low) & (tool_df["cM"] < high)
+            truth_in_bin = (truth_df["cM"] >= low) & (truth_df["cM"] < high)
+        assert row[3] == (in_bin & (overlap_fraction >= row[1])).sum(), f"true positives differ at {row[:2]}"
+        assert row[5] == (truth_in_bin & (truth_best >= row[1])).sum(), f"recovered truth differs at {row[:2]}"
+
+    coverage = index.coverage(tool_df)
+    expected = _brute_force_coverage(tool_df, truth_df)
+    assert all(coverage[name] == expected[name] for name in expected), f"coverage {coverage} != {expected}"
+
+    # Sharded across processes, each frame gets the same matches
+    half = tool_df.iloc[::2].reset_index(drop=True)
+    frames = [tool_df, pd.DataFrame(), half]
+    for (fraction, ids), expected_df in zip(index.best_overlaps_many(frames, workers=2), frames):
+        expected_fraction, expected_ids = index.best_overlaps(expected_df)
+        assert np.array_equal(fraction, expected_fraction) and np.array_equal(ids, expected_ids), \
+            "process-parallel matches differ"
+    print(f"{num_tool} tool segments against {num_truth} truth segments match the row-by-row scan "
+          f"({(truth_id >= 0).sum()} overlapping, {coverage['overlap_bp']:,} of {coverage['truth_bp']:,} truth bp covered)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overlap of tool segments with truth segments.")
+    parser.add_argument("--verify", action="store_true", help="Check the index against a row-by-row scan.")
+    args = parser.parse_args()
+    if args.verify:
+        verify_against_brute_force()
+        # A budget of a few hundred candidates splits the tool segments into many chunks
+        verify_against_brute_force(memory_budget=300 * CANDIDATE_BYTES)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
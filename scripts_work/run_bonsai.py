@@ -4,6 +4,9 @@ import argparse
 import logging
 import sys
 from utils.bonsaitree.bonsaitree.v3 import bonsai
+from scripts_support.segment_io import scan_segments, merged_segments_path
+from scripts_support.sample_registry import SampleRegistry
+from scripts_support.parse_cache import ParseCache
 import pandas as pd
 import json
 import random
@@ -87,48 +90,58 @@ def configure_logging(log_filename, log_file_debug_level="INFO", console_debug_l
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
-def read_ibis_seg(file_path):
+def read_ibis_seg(file_path, min_genetic_length=None, chromosomes=None, samples=None, columns=None,
+                  registry=None, cache=None):
     """
     Reads an IBIS .seg file and returns a DataFrame.
 
+    The optional filters are applied while the file is decoded, so segments
+    that fail them are never loaded.
+
     Parameters:
-        file_path (str): Path to the IBIS .seg file.
+        file_path (str): Path to the IBIS .seg file or segment store.
+        min_genetic_length (float): Keep segments with genetic_length >= this value.
+        chromosomes (list): Keep segments on these chromosomes.
+        samples (list): Keep segments involving any of these sample IDs.
+        columns (list): Columns to keep (default: all of them).
+        registry (SampleRegistry): Recode id1/id2 to the cohort's sample registry.
+        cache (ParseCache): Reuse the parsed segments of an earlier run with the same filters.
 
     Returns:
         pd.DataFrame: DataFrame containing the IBIS segments.
     """
-    columns = [
-        "id1", "id2", "chromosome", "physical_position_start", 
-        "physical_position_end", "IBD_type", "genetic_position_start", 
-        "genetic_position_end", "genetic_length", "marker_count", 
-        "error_count", "error_density"
-    ]
-
     try:
-        df = pd.read_csv(file_path, sep="\t", header=None, names=columns)
+        df, scanned = scan_segments(file_path, "ibis", min_cm=min_genetic_length, chromosomes=chromosomes,
+                                    samples=samples, columns=columns, registry=registry, cache=cache)
+        print(f"Read IBIS segments: kept {len(df)} of {scanned} rows scanned.")
         return df
     except Exception as e:
         print(f"Error reading IBIS .seg file: {e}")
         return pd.DataFrame()
 
-def read_ibd_hbd_seg(file_path):
+def read_ibd_hbd_seg(file_path, min_genetic_length=None, chromosomes=None, samples=None, registry=None,
+                     cache=None):
     """
     Reads a hap-IBD .ibd.gz file and returns a DataFrame.
 
+    The optional filters are applied while the file is decoded, so segments
+    that fail them are never loaded.
+
     Parameters:
-        file_path (str): Path to the hap-IBD .ibd.gz file.
+        file_path (str): Path to the hap-IBD .ibd.gz file or segment store.
+        min_genetic_length (float): Keep segments with genetic_length >= this value.
+        chromosomes (list): Keep segments on these chromosomes.
+        samples (list): Keep segments involving any of these sample IDs.
+        registry (SampleRegistry): Recode id1/id2 to the cohort's sample registry.
+        cache (ParseCache): Reuse the parsed segments of an earlier run with the same filters.
 
     Returns:
         pd.DataFrame: DataFrame containing the hap-IBD segments.
     """
-    columns = [
-        "id1", "id1_haplotype_index", "id2", "id2_haplotype_index", 
-        "chromosome", "physical_position_start", "physical_position_end", 
-        "genetic_length"
-    ]
-
     try:
-        df = pd.read_csv(file_path, sep="\t", header=None, names=columns)
+        df, scanned = scan_segments(file_path, "hapibd", min_cm=min_genetic_length, chromosomes=chromosomes,
+                                    samples=samples, registry=registry, cache=cache)
+        print(f"Read hap-IBD segments: kept {len(df)} of {scanned} rows scanned.")
         return df
     except Exception as e:
         print(f"Error reading hap-IBD .ibd.gz file: {e}")
@@ -154,29 +167,43 @@ def filter_segments(segments, min_genetic_length = 7):
     print(f"Filtered segments: {len(filtered_segments)} rows (min_genetic_length >= {min_genetic_length}).")
     return filtered_segments
 
-def extract_samples(segments):
+def extract_samples(segments, registry=None):
     """
     Extracts unique samples from the 'id1' and 'id2' columns of the segments DataFrame.
 
     Parameters:
         segments (pd.DataFrame): DataFrame containing 'id1' and 'id2' columns.
+        registry (SampleRegistry): If given, samples are found from the
+                                   registry codes and returned in code order.
 
     Returns:
         list: List of unique samples.
     """
-    return list(set(segments["id1"].tolist() + segments["id2"].tolist()))
+    ids = pd.concat([segments["id1"], segments["id2"]], ignore_index=True)
+    if registry is not None:
+        codes = np.unique(registry.encode(ids))
+        return registry.decode(codes[codes >= 0]).tolist()
+    return pd.unique(ids).tolist()
 
-def generate_numeric_ids(samples):
-    numeric_ids = {}
-    used_ids = set()
-    for sample in samples:
-        while True:
-            random_id = random.randint(1000, 9999)  # Generate a 4-digit random number
-            if random_id not in used_ids:  # Ensure the ID is unique
-                numeric_ids[sample] = random_id
-                used_ids.add(random_id)
-                break
-    return numeric_ids
+def generate_numeric_ids(samples, registry=None):
+    """
+    Assigns each sample its Bonsai genotype ID.
+
+    IDs are the sample's registry code plus one (Bonsai keeps non-positive
+    IDs for inferred ancestors), so they are stable across runs and match
+    the codes used by the other pipeline stages. Without a registry, one is
+    built from the samples in the given order.
+
+    Parameters:
+        samples (list): Sample IDs.
+        registry (SampleRegistry): The cohort's sample registry.
+
+    Returns:
+        dict: {sample ID: numeric ID}.
+    """
+    registry = registry if registry is not None else SampleRegistry(samples)
+    codes = registry.encode(samples)
+    return dict(zip(samples, (codes + 1).tolist()))
 
 
 def create_sex_json(sex_data_filename, sex_json_filename):
@@ -350,6 +377,21 @@ def create_bioinfo(samples, numeric_ids, sex_dict, age_dict, output_filename=Non
 
     return bioinfo
 
+def _map_numeric_ids(segments, numeric_ids):
+    """
+    Numeric IDs of the id1 and id2 columns, mapped once per distinct sample.
+
+    Returns:
+        tuple: (mask of the rows whose IDs both map, id1 list, id2 list) for the kept rows.
+    """
+    id1 = segments['id1'].map(numeric_ids)
+    id2 = segments['id2'].map(numeric_ids)
+    mapped = (id1.notna() & id2.notna()).to_numpy()
+    if not mapped.all():
+        unmapped = pd.unique(pd.concat([segments['id1'][id1.isna()], segments['id2'][id2.isna()]])).tolist()
+        print(f"Error mapping ID: skipped {int((~mapped).sum())} segments of unmapped samples {unmapped[:10]}")
+    return mapped, id1[mapped].astype(np.int64).tolist(), id2[mapped].astype(np.int64).tolist()
+
 def create_phased_ibd_seg_list(segments_ibd, numeric_ids):
     """
     Creates a phased IBD segment list from the given DataFrame.
@@ -365,26 +407,21 @@ def create_phased_ibd_seg_list(segments_ibd, numeric_ids):
         list: A list of IBD segments in the specified format:
               [[id1, id2, hap1, hap2, chrom, start_cm, end_cm, len_cm], ...].
     """
-    phased_ibd_seg_list = []
-
-    for _, row in segments_ibd.iterrows():
-        try:
-            id1 = numeric_ids[row['id1']]
-            id2 = numeric_ids[row['id2']]
-            hap1 = int(row['id1_haplotype_index'])
-            hap2 = int(row['id2_haplotype_index'])
-            chrom = int(row['chromosome'])
-            start_cm = float(row['physical_position_start'])  # Assuming cM info is here
-            end_cm = float(row['physical_position_end'])      # Assuming cM info is here
-            len_cm = float(row['genetic_length'])
-
-            phased_ibd_seg_list.append([id1, id2, hap1, hap2, chrom, start_cm, end_cm, len_cm])
-        except KeyError as e:
-            print(f"Error mapping ID: {e}")
-        except ValueError as e:
-            print(f"Error converting row data: {e}")
-
-    return phased_ibd_seg_list
+    # Columns are converted whole and zipped into rows once
+    mapped, id1, id2 = _map_numeric_ids(segments_ibd, numeric_ids)
+    segments_ibd = segments_ibd[mapped]
+    try:
+        hap1 = segments_ibd['id1_haplotype_index'].astype(int).tolist()
+        hap2 = segments_ibd['id2_haplotype_index'].astype(int).tolist()
+        chrom = segments_ibd['chromosome'].astype(int).tolist()
+        start_cm = segments_ibd['physical_position_start'].astype(float).tolist()  # Assuming cM info is here
+        end_cm = segments_ibd['physical_position_end'].astype(float).tolist()      # Assuming cM info is here
+        len_cm = segments_ibd['genetic_length'].astype(float).tolist()
+    except ValueError as e:
+        print(f"Error converting row data: {e}")
+        return []
+
+    return [list(row) for row in zip(id1, id2, hap1, hap2, chrom, start_cm, end_cm, len_cm)]
 
 def create_unphased_ibd_seg_list(segments_ibd, numeric_ids):
     """
@@ -400,25 +437,20 @@ def create_unphased_ibd_seg_list(segments_ibd, numeric_ids):
         list: A list of unphased IBD segments in the specified format:
               [[id1, id2, chrom, start_bp, end_bp, is_full, len_cm], ...].
     """
-    unphased_ibd_seg_list = []
+    # Columns are converted whole and zipped into rows once
+    mapped, id1, id2 = _map_numeric_ids(segments_ibd, numeric_ids)
+    segments_ibd = segments_ibd[mapped]
+    try:
+        chrom = segments_ibd['chromosome'].astype(str).tolist()  # Convert chromosome to string if necessary
+        start_bp = segments_ibd['physical_position_start'].astype(float).tolist()
+        end_bp = segments_ibd['physical_position_end'].astype(float).tolist()
+        is_full = (segments_ibd['IBD_type'] == 2).tolist()  # Assuming IBD2 indicates "full"
+        len_cm = segments_ibd['genetic_length'].astype(float).tolist()
+    except ValueError as e:
+        print(f"Error converting row data: {e}")
+        return []
 
-    for _, row in segments_ibd.iterrows():
-        try:
-            id1 = numeric_ids[row['id1']]
-            id2 = numeric_ids[row['id2']]
-            chrom = str(row['chromosome'])  # Convert chromosome to string if necessary
-            start_bp = float(row['physical_position_start'])
-            end_bp = float(row['physical_position_end'])
-            is_full = row['IBD_type'] == 2  # Assuming IBD2 indicates "full"
-            len_cm = float(row['genetic_length'])
-
-            unphased_ibd_seg_list.append([id1, id2, chrom, start_bp, end_bp, is_full, len_cm])
-        except KeyError as e:
-            print(f"Error mapping ID: {e}")
-        except ValueError as e:
-            print(f"Error converting row data: {e}")
-
-    return unphased_ibd_seg_list
+    return [list(row) for row in zip(id1, id2, chrom, start_bp, end_bp, is_full, len_cm)]
 
 # def create_ibd_network(segments):
 #     G = nx.Graph()
@@ -444,6 +476,29 @@ def create_unphased_ibd_seg_list(segments_ibd, numeric_ids):
 # poetry add git+https://git.skewed.de/count0/graph-tool.git
 # """
 
+def _hbd_overlaps(ids, chroms, starts, ends, hbd_ids, hbd_chroms, hbd_starts, hbd_ends):
+    """
+    True for each segment that overlaps an HBD segment of the given individual
+    on the same chromosome (IDs and chromosomes as integer codes).
+
+    HBD segments are sorted by (individual, chromosome, start) with a running
+    maximum of their ends, so the test is one binary search per segment: the
+    last HBD segment of the group starting before the segment ends must reach
+    past the segment's start.
+    """
+    num_chroms = int(max(chroms.max(initial=0), hbd_chroms.max(initial=0))) + 1
+    hbd_keys = hbd_ids.astype(np.int64) * num_chroms + hbd_chroms
+    hbd_positions = (hbd_keys << 32) + hbd_starts.astype(np.int64)
+    order = np.argsort(hbd_positions, kind='stable')
+    hbd_keys, hbd_positions = hbd_keys[order], hbd_positions[order]
+    max_ends = pd.Series(hbd_ends[order]).groupby(hbd_keys).cummax().to_numpy()
+
+    keys = ids.astype(np.int64) * num_chroms + chroms
+    last = np.searchsorted(hbd_positions, (keys << 32) + ends.astype(np.int64), side='left') - 1
+    found = last >= 0
+    last = np.maximum(last, 0)
+    return found & (hbd_keys[last] == keys) & (max_ends[last] > starts)
+
 def graph_ibd_segments(segments_ibd, segments_hbd=None, 
                             min_segment_cm=3,
                             min_total_cm=3):
@@ -467,63 +522,70 @@ def graph_ibd_segments(segments_ibd, segments_hbd=None,
     print("Building graph...")
     # Create graph
     G = nx.Graph()
-    
-    # Create HBD lookup if provided
-    hbd_regions = defaultdict(list)
+
     if segments_hbd is not None:
         required_hbd_cols = ['id1', 'chromosome', 'physical_position_start', 
                            'physical_position_end', 'genetic_length']
         if not all(col in segments_hbd.columns for col in required_hbd_cols):
             raise ValueError(f"HBD DataFrame missing required columns. Required: {required_hbd_cols}")
-            
-        for _, row in segments_hbd.iterrows():
-            hbd_regions[row['id1']].append({
-                'chrom': row['chromosome'],
-                'start': row['physical_position_start'],
-                'end': row['physical_position_end']
-            })
-    
-    # Process IBD segments and build graph
-    pair_segments = defaultdict(list)
-    
+
     print("Processing segments...")
-    for _, row in tqdm(segments_ibd.iterrows(), desc="Adding edges to the graph"):
-        if row['genetic_length'] >= min_segment_cm:
-            pair = tuple(sorted([row['id1'], row['id2']]))
-            
-            # Check for HBD overlap
-            segment_overlaps_hbd = False
-            if segments_hbd is not None:
-                for id_check in pair:
-                    for hbd_seg in hbd_regions[id_check]:
-                        if (row['chromosome'] == hbd_seg['chrom'] and 
-                            row['physical_position_start'] < hbd_seg['end'] and 
-                            row['physical_position_end'] > hbd_seg['start']):
-                            segment_overlaps_hbd = True
-                            break
-                    if segment_overlaps_hbd:
-                        break
-            
-            # Store segment information
-            pair_segments[pair].append({
-                'chrom': row['chromosome'],
-                'start': row['physical_position_start'],
-                'end': row['physical_position_end'],
-                'cm': row['genetic_length'],
-                'overlaps_hbd': segment_overlaps_hbd
-            })
+    segments = segments_ibd[(segments_ibd['genetic_length'] >= min_segment_cm).to_numpy()]
+    num_segments = len(segments)
+
+    # Individuals (IBD and HBD) and chromosomes become integer codes; ID
+    # columns sharing the sample registry's categories are factorized on their codes
+    id_columns = [segments['id1'], segments['id2']]
+    chrom_columns = [segments['chromosome']]
+    if segments_hbd is not None:
+        id_columns.append(segments_hbd['id1'])
+        chrom_columns.append(segments_hbd['chromosome'])
+    codes, names = pd.factorize(pd.concat(id_columns, ignore_index=True))
+    chrom_codes, _ = pd.factorize(pd.concat(chrom_columns, ignore_index=True))
+    names = np.asarray(names, dtype=object)
+
+    # Each pair is keyed as (lower, higher) sample ID, as with sorted()
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[np.argsort(names, kind='stable')] = np.arange(len(names))
+    code1, code2 = codes[:num_segments], codes[num_segments:2 * num_segments]
+    swap = rank[code1] > rank[code2]
+    low, high = np.where(swap, code2, code1), np.where(swap, code1, code2)
+
+    chrom = segments['chromosome'].to_numpy()
+    start = segments['physical_position_start'].to_numpy()
+    end = segments['physical_position_end'].to_numpy()
+    cm = segments['genetic_length'].to_numpy(dtype=np.float64)
+
+    # Check for HBD overlap
+    overlaps_hbd = np.zeros(num_segments, dtype=bool)
+    if segments_hbd is not None and len(segments_hbd):
+        hbd = (codes[2 * num_segments:], chrom_codes[num_segments:],
+               segments_hbd['physical_position_start'].to_numpy(), segments_hbd['physical_position_end'].to_numpy())
+        for ids in (code1, code2):
+            overlaps_hbd |= _hbd_overlaps(ids, chrom_codes[:num_segments], start, end, *hbd)
+
+    # Group segments by pair, pairs in order of first appearance
+    pair_codes, pairs = pd.factorize(low.astype(np.int64) * len(names) + high, sort=False)
+    totals = np.bincount(pair_codes, weights=np.where(overlaps_hbd, 0.0, cm), minlength=len(pairs))
+    order = np.argsort(pair_codes, kind='stable')
+    bounds = np.searchsorted(pair_codes[order], np.arange(len(pairs) + 1))
+    records = list(zip(chrom[order].tolist(), start[order].tolist(), end[order].tolist(),
+                       cm[order].tolist(), overlaps_hbd[order].tolist()))
     
     # Add edges to graph
     print("Building network...")
-    for pair, segments in tqdm(pair_segments.items(), desc="Creating graph edges"):
-        # Calculate total IBD, potentially adjusting for HBD overlap
-        total_ibd = sum(seg['cm'] for seg in segments 
-                       if not seg['overlaps_hbd'])  # Exclude HBD overlapping segments
+    for pair in tqdm(range(len(pairs)), desc="Creating graph edges"):
+        # Total IBD excludes HBD overlapping segments
+        total_ibd = float(totals[pair])
         
         if total_ibd >= min_total_cm:
-            G.add_edge(pair[0], pair[1], 
+            first = order[bounds[pair]]
+            G.add_edge(names[low[first]], names[high[first]],
                       weight=total_ibd,
-                      segments=segments)
+                      segments=[{'chrom': seg_chrom, 'start': seg_start, 'end': seg_end,
+                                 'cm': seg_cm, 'overlaps_hbd': seg_overlaps}
+                                for seg_chrom, seg_start, seg_end, seg_cm, seg_overlaps
+                                in records[bounds[pair]:bounds[pair + 1]]])
 
     print(f"Graph built with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges")
     return G
@@ -1406,24 +1468,37 @@ def main(results_directory):
     Returns:
         tuple: DataFrames for IBIS, IBD, and HBD segments.
     """
-    ibis_file = os.path.join(results_directory, "ibis_MergedSamples.seg")
-    ibd_file = os.path.join(results_directory, "hap_ibd_MergedSamples.seg")
-    hbd_file = os.path.join(results_directory, "hap_hbd_MergedSamples.seg")
-
-    segments_ibis_temp = read_ibis_seg(ibis_file) if os.path.isfile(ibis_file) else pd.DataFrame()
-    segments_ibd_temp = read_ibd_hbd_seg(ibd_file) if os.path.isfile(ibd_file) else pd.DataFrame()
-    segments_hbd_temp = read_ibd_hbd_seg(hbd_file) if os.path.isfile(hbd_file) else pd.DataFrame()
-
-    segments_ibis_temp = segments_ibis_temp.drop(['marker_count', 'error_count', 'error_density'], axis=1)
+    # Segment stores (x.parquet) are preferred over the legacy merged TSVs
+    ibis_file = merged_segments_path(os.path.join(results_directory, "ibis_MergedSamples.seg"))
+    ibd_file = merged_segments_path(os.path.join(results_directory, "hap_ibd_MergedSamples.seg"))
+    hbd_file = merged_segments_path(os.path.join(results_directory, "hap_hbd_MergedSamples.seg"))
 
     min_segment_size_ibd = 3
     min_segment_size_ibis = 7
-    segments_ibis = filter_segments(segments_ibis_temp, min_genetic_length = min_segment_size_ibis)
+
+    # Sample IDs of every segment set are interned in the cohort's registry, so
+    # the frames share codes and the graph and Bonsai IDs follow them
+    registry = SampleRegistry.for_results(results_directory)
+    # Parsed segment files are cached, so a rerun on the same results skips parsing
+    cache = ParseCache.for_results(results_directory)
+
+    # The length filter is applied while reading, so short segments are never loaded
+    ibis_columns = ["id1", "id2", "chromosome", "physical_position_start", "physical_position_end",
+                    "IBD_type", "genetic_position_start", "genetic_position_end", "genetic_length"]
+    segments_ibis = read_ibis_seg(ibis_file, min_genetic_length=min_segment_size_ibis,
+                                  columns=ibis_columns, registry=registry, cache=cache) \
+        if os.path.exists(ibis_file) else pd.DataFrame()
     print(segments_ibis.head())
-    segments_ibd = filter_segments(segments_ibd_temp, min_genetic_length = min_segment_size_ibd)
+    segments_ibd = read_ibd_hbd_seg(ibd_file, min_genetic_length=min_segment_size_ibd, registry=registry,
+                                    cache=cache) if os.path.exists(ibd_file) else pd.DataFrame()
     print(segments_ibd.head())
-    segments_hbd = filter_segments(segments_hbd_temp, min_genetic_length = min_segment_size_ibd)
+    segments_hbd = read_ibd_hbd_seg(hbd_file, min_genetic_length=min_segment_size_ibd, registry=registry,
+                                    cache=cache) if os.path.exists(hbd_file) else pd.DataFrame()
     print(segments_hbd.head())
+    # Frames read before the registry last grew are brought to its final categories
+    for segments in (segments_ibis, segments_ibd, segments_hbd):
+        registry.intern(segments, ["id1", "id2"])
+    print(f"Sample registry: {len(registry)} samples, saved to {registry.save()}")
 
     # Ask for target size only if user wants to select communities
     process_all = input("Process all samples? (y/n): ").lower().strip()
@@ -1502,8 +1577,8 @@ def main(results_directory):
         # print(f"Pedigree graph saved to {output_filename6}")
 
     # Main Bonsai preprocessing ################################################
-    samples = extract_samples(segments_ibd)
-    numeric_ids = generate_numeric_ids(samples)
+    samples = extract_samples(segments_ibd, registry)
+    numeric_ids = generate_numeric_ids(samples, registry)
     print(f"Number of samples: {len(samples)}")
 
     sex_json_filename = os.path.join(data_directory, 'open_snps_data/demographic_data_sex.json')
@@ -10,6 +10,11 @@ import seaborn as sns
 from IPython.display import display, HTML
 import IPython
 from dotenv import load_dotenv
+from scripts_support.parse_cache import ParseCache
+from scripts_support.segment_io import (
+    read_segments, scan_segments, segment_store_path, merged_segments_path, merge_segment_files,
+    export_segment_store_tsv, MERGE_BUFFER_ROWS
+)
 notebook_dir = os.getcwd()
 project_root = os.path.dirname(notebook_dir)
 env_path = os.path.join(project_root, '.env')
@@ -233,13 +238,18 @@ def run_ibis(phased_samples_dir, results_directory, utils_directory):
     # - segment_count: Total number of HBD segments identified in the individual's genome.
     """
 
-def combine_and_sort_ibis_outputs(results_dir):
+def combine_and_sort_ibis_outputs(results_dir, export_tsv=False, buffer_rows=MERGE_BUFFER_ROWS):
     """
     Combines all chromosome-specific IBIS .coef and .seg files, and saves sorted results in the results directory.
 
+    Segments are written to the chromosome-partitioned segment store
+    ibis_MergedSamples.parquet (see scripts_support.segment_io).
+
     Parameters:
         phased_samples_dir (str): Directory containing chromosome-specific IBIS outputs.
         results_dir (str): Directory to save the combined output files.
+        export_tsv (bool): Also write the legacy ibis_MergedSamples.seg TSV.
+        buffer_rows (int): Segments held in memory while merging before spilling to disk.
     """
     combined_coef_path = os.path.join(results_dir, "ibis_MergedSamples.coef")
     combined_seg_path = os.path.join(results_dir, "ibis_MergedSamples.seg")
@@ -282,37 +292,18 @@ def combine_and_sort_ibis_outputs(results_dir):
     else:
         print("No .coef files to combine.")
 
-    # Combine and sort .seg files
+    # Combine and sort .seg files, one chromosome partition at a time
     if seg_files:
-        combined_seg_data = []
-        for seg_file in seg_files:
-            seg_data = pd.read_csv(seg_file, sep="\t", header=None)
-            combined_seg_data.append(seg_data)
-
-        if combined_seg_data:
-            combined_seg_df = pd.concat(combined_seg_data, ignore_index=True)
-            combined_seg_df.columns = [
-                "sample1", "sample2", 
-                "chrom", 
-                "phys_start_pos", "phys_end_pos", 
-                "IBD_type", "genetic_start_pos", 
-                "genetic_end_pos", "genetic_seg_length", 
-                "marker_count", "error_count", "error_density"
-            ]
-            sorted_seg_df = combined_seg_df.sort_values(
-                by=["chrom", "phys_start_pos", "phys_end_pos", "IBD_type"],
-                ascending=[True, True, True, True]
-            )
-            sorted_seg_df.to_csv(combined_seg_path, sep="\t", index=False, header=False)
-            print(f"Combined and sorted .seg file saved to: {combined_seg_path}")
-        else:
-            print("No valid .seg data to combine.")
+        write_merged_segments(seg_files, combined_seg_path, "ibis",
+                              ["physical_position_start", "physical_position_end", "IBD_type"], export_tsv,
+                              buffer_rows)
     else:
         print("No .seg files to combine.")
 
     return True
 
-def explore_coefficients(results_directory, filename="ibis_MergedSamples.coef", focus_on_related=True, save_plots=True, output_subdir="segments"):
+def explore_coefficients(results_directory, filename="ibis_MergedSamples.coef", focus_on_related=True, save_plots=True, output_subdir="segments",
+                         cache=None):
     """
     Reads and explores the coefficients file from the results directory.
     Includes handling for missing values and options to focus on related individuals.
@@ -323,6 +314,7 @@ def explore_coefficients(results_directory, filename="ibis_MergedSamples.coef",
         focus_on_related (bool): If True, focuses analysis on related individuals (Degree > 0).
         save_plots (bool): If True, saves plots to the specified output directory.
         output_dir (str): Directory to save plots.
+        cache (ParseCache): Reuse the parsed coefficients of an earlier run.
     
     Returns:
         pd.DataFrame: Processed coefficients DataFrame for further analysis.
@@ -334,7 +326,8 @@ def explore_coefficients(results_directory, filename="ibis_MergedSamples.coef",
 
     # Step 1: Read the coefficients file
     file_path = os.path.join(results_directory, filename)
-    coefficients = pd.read_csv(file_path, sep="\t", low_memory=False)
+    read_coefficients = lambda: pd.read_csv(file_path, sep="\t", low_memory=False)
+    coefficients = cache.fetch(file_path, {"reader": "coef"}, read_coefficients) if cache else read_coefficients()
 
     # Save both full and filtered data if focus_on_related is True
     full_data = coefficients.copy()
@@ -452,7 +445,8 @@ def explore_segments_ibis(
         min_markers=436, 
         max_error_density=0.004,
         save_plots=True, 
-        output_subdir="segments"
+        output_subdir="segments",
+        cache=None
 ):
     """
     Explores and optionally filters the segments DataFrame.
@@ -466,6 +460,7 @@ def explore_segments_ibis(
         filter_segments_enabled (bool): If True, apply filtering to the segments.
         save_plots (bool): If True, save plots to the specified directory.
         output_dir (str): Directory to save outputs and plots.
+        cache (ParseCache): Reuse the parsed segments of an earlier run.
     
     Returns:
         pd.DataFrame: The segments DataFrame (filtered or unfiltered based on input).
@@ -475,22 +470,11 @@ def explore_segments_ibis(
     os.makedirs(output_dir, exist_ok=True)
 
     # Step 1: Read the segments file
-    file_path = os.path.join(results_directory, filename)
-    segments = pd.read_csv(file_path, sep="\t", header=None)
-    segments.columns = [
-        "id1", "id2", "chromosome", "physical_position_start", 
-        "physical_position_end", "IBD_type", "genetic_position_start", 
-        "genetic_position_end", "genetic_length", "marker_count", 
-        "error_count", "error_density"
-    ]
-
-    # Ensure numeric columns are properly parsed
-    numeric_columns = ["genetic_length", "marker_count", "error_density", "chromosome"]
-    for col in numeric_columns:
-        if col in segments.columns:
-            segments[col] = pd.to_numeric(segments[col], errors='coerce')
+    file_path = merged_segments_path(os.path.join(results_directory, filename))
+    segments = read_segments(file_path, "ibis", cache=cache)
 
     # Drop rows with NaN values in numeric columns
+    numeric_columns = ["genetic_length", "marker_count", "error_density", "chromosome"]
     nan_rows = segments[segments[numeric_columns].isnull().any(axis=1)]
     if not nan_rows.empty:
         nan_file_path = os.path.join(output_dir, "nan_segments_ibis.csv")
@@ -647,40 +631,53 @@ def run_hap_ibd(phased_samples_dir, results_directory, utils_directory, referenc
         except subprocess.CalledProcessError as e:
             print(f"Error running hap-ibd for chromosome {chromosome}: {e}")
 
-def combine_and_sort_hap_ibd_outputs(results_dir):
+def write_merged_segments(seg_files, combined_seg_path, segment_format, sort_by, export_tsv=False,
+                          buffer_rows=MERGE_BUFFER_ROWS):
+    """
+    Merges per-chromosome segment files into the segment store next to
+    combined_seg_path (x.seg -> x.parquet), sorted by chromosome and sort_by.
+
+    The files are streamed, so memory is bounded by buffer_rows segments:
+    a chromosome that does not fit is sorted in spilled runs on disk and
+    k-way merged (see scripts_support.segment_io.merge_segment_files). The
+    store gets a sidecar region/pair index, so single pairs or regions can
+    be read with segment_io.SegmentFile instead of loading the whole file.
+    With export_tsv the store is also written, chromosome by chromosome,
+    to the legacy TSV at combined_seg_path.
+
+    Returns:
+        bool: True if any segments were written.
+    """
+    store_path = segment_store_path(combined_seg_path)
+    try:
+        stats = merge_segment_files(seg_files, store_path, segment_format, sort_by, buffer_rows=buffer_rows)
+    except Exception as e:
+        print(f"Error merging {segment_format} files: {e}")
+        return False
+
+    if not stats["segments"]:
+        print(f"No valid {segment_format} data to combine.")
+        return False
+    print(f"Combined and sorted segment store saved to: {store_path} "
+          f"({stats['segments']} segments, {stats['chromosomes']} chromosomes, "
+          f"{stats['spilled']} spilled to disk)")
+    print(f"Region and pair index saved to: {os.path.join(store_path, '_index')}")
+    if export_tsv:
+        export_segment_store_tsv(store_path, combined_seg_path, segment_format)
+        print(f"Combined and sorted .seg file saved to: {combined_seg_path}")
+    return True
+
+def combine_and_sort_hap_ibd_outputs(results_dir, export_tsv=False, buffer_rows=MERGE_BUFFER_ROWS):
 
     def process_files(file_list, output_path, file_type):
 
         if not file_list:
             print(f"No {file_type} files to process.")
             return False
-        
-        combined_data = []
-        for seg_file in file_list:
-            try:
-                seg_data = pd.read_csv(seg_file, sep="\t", header=None)
-                combined_data.append(seg_data)
-            except Exception as e:
-                print(f"Error reading {file_type} file {seg_file}: {e}")
-        
-        if combined_data:
-            combined_df = pd.concat(combined_data, ignore_index=True)
-            combined_df.columns = [
-                "id1", "id1_haplotype_index", "id2", "id2_haplotype_index",
-                "chromosome", 
-                "physical_position_start", "physical_position_end",
-                "genetic_length"
-            ]
-            sorted_df = combined_df.sort_values(
-                by=["chromosome", "physical_position_start", "physical_position_end"],
-                ascending=[True, True, True]
-            )
-            sorted_df.to_csv(output_path, sep="\t", index=False, header=False)
-            print(f"Combined and sorted {file_type} file saved to: {output_path}")
-            return True
-        else:
-            print(f"No valid {file_type} data to combine.")
-            return False
+
+        return write_merged_segments(file_list, output_path, "hapibd",
+                                     ["physical_position_start", "physical_position_end"], export_tsv,
+                                     buffer_rows)
 
     # Collect IBD and HBD files
     ibd_files = [
@@ -717,10 +714,15 @@ def explore_hap_ibd_results(
         file_prefix="hap_ibd_MergedSamples",
         min_length=3, 
         save_filtered=True, 
-        output_subdir="segments"
+        output_subdir="segments",
+        keep_unfiltered=False,
+        cache=None
 ):
     """
     Explores and optionally filters hap-IBD results for IBD and HBD files.
+
+    By default the min_length filter is applied while the file is decoded,
+    so segments below it are never loaded and no unfiltered copy is kept.
     
     Parameters:
         results_directory (str): Directory containing hap-IBD files.
@@ -728,9 +730,13 @@ def explore_hap_ibd_results(
         min_length (float): Minimum genetic length threshold for filtering.
         save_filtered (bool): If True, save filtered files.
         output_subdir (str): Subdirectory to save outputs.
+        keep_unfiltered (bool): If True, load every segment, describe it and
+                                save it as unfiltered_segments_<type>.csv.
+        cache (ParseCache): Reuse the parsed segments of an earlier run.
     
     Returns:
-        dict: DataFrames for IBD and HBD results (filtered and unfiltered).
+        dict: DataFrames for IBD and HBD results (unfiltered, filtered); the
+              unfiltered entry is None unless keep_unfiltered is set.
     """
     # Ensure output directory exists
     output_dir = os.path.join(results_directory, output_subdir)
@@ -747,29 +753,22 @@ def explore_hap_ibd_results(
             file_type (str): Type of file ('ibd' or 'hbd').
 
         Returns:
-            tuple: Unfiltered and filtered DataFrames.
+            tuple: Unfiltered (None unless keep_unfiltered) and filtered DataFrames.
         """
-        if not os.path.isfile(filename):
+        if not os.path.exists(filename):
             print(f"File not found: {filename}. Skipping {file_type} analysis.")
             return None, None
         
         print(f"loading: {filename}")
         
-        # Load the file
-        segments = pd.read_csv(filename, sep="\t", header=None)
-        segments.columns = [
-            "id1", "id1_haplotype_index", "id2", "id2_haplotype_index",
-            "chromosome", 
-            "physical_position_start", "physical_position_end",
-            "genetic_length"
-        ]
-
-        # Ensure numeric columns are properly parsed
-        numeric_columns = ["genetic_length", "chromosome", "physical_position_start", "physical_position_end"]
-        for col in numeric_columns:
-            segments[col] = pd.to_numeric(segments[col], errors='coerce')
+        # Load the file, dropping short segments while decoding unless the
+        # unfiltered data was asked for
+        segments, scanned = scan_segments(filename, "hapibd", min_cm=None if keep_unfiltered else min_length,
+                                          cache=cache)
+        print(f"Scanned {scanned} {file_type} rows, kept {len(segments)}.")
 
         # Handle NaN values
+        numeric_columns = ["genetic_length", "chromosome", "physical_position_start", "physical_position_end"]
         nan_rows = segments[segments[numeric_columns].isnull().any(axis=1)]
         if not nan_rows.empty:
             nan_file_path = os.path.join(output_dir, f"nan_segments_{file_type}.csv")
@@ -777,20 +776,23 @@ def explore_hap_ibd_results(
             print(f"Rows with NaN values in {file_type} saved to: {nan_file_path}")
         segments = segments.dropna(subset=numeric_columns).reset_index(drop=True)
 
-        # Print basic info
-        print(f"=== {file_type.upper()} Segments DataFrame Info ===")
-        segments.info()
-        print(f"\n=== Descriptive Statistics ({file_type.upper()}) ===")
-        print(segments[['genetic_length']].describe())
-        print("\n")
-
-        # Save unfiltered data
-        unfiltered_file_path = os.path.join(output_dir, f"unfiltered_segments_{file_type}.csv")
-        segments.to_csv(unfiltered_file_path, sep="\t", index=False)
-        print(f"Unfiltered {file_type} segments saved to: {unfiltered_file_path}")
-
-        # Filter segments
-        filtered_segments = segments[segments['genetic_length'] >= min_length].copy()
+        if keep_unfiltered:
+            # Print basic info
+            print(f"=== {file_type.upper()} Segments DataFrame Info ===")
+            segments.info()
+            print(f"\n=== Descriptive Statistics ({file_type.upper()}) ===")
+            print(segments[['genetic_length']].describe())
+            print("\n")
+
+            # Save unfiltered data
+            unfiltered_file_path = os.path.join(output_dir, f"unfiltered_segments_{file_type}.csv")
+            segments.to_csv(unfiltered_file_path, sep="\t", index=False)
+            print(f"Unfiltered {file_type} segments saved to: {unfiltered_file_path}")
+
+            # Filter segments
+            filtered_segments = segments[segments['genetic_length'] >= min_length].copy()
+        else:
+            filtered_segments, segments = segments, None
         print(f"=== Filtered {file_type.upper()} Segments Info ===")
         filtered_segments.info()
         print(f"\n=== Descriptive Statistics (Filtered {file_type.upper()}) ===")
@@ -806,8 +808,8 @@ def explore_hap_ibd_results(
         return segments, filtered_segments
 
     # Process IBD and HBD files
-    ibd_file = os.path.join(results_directory, "hap_ibd_MergedSamples.seg")
-    hbd_file = os.path.join(results_directory, "hap_hbd_MergedSamples.seg")
+    ibd_file = merged_segments_path(os.path.join(results_directory, "hap_ibd_MergedSamples.seg"))
+    hbd_file = merged_segments_path(os.path.join(results_directory, "hap_hbd_MergedSamples.seg"))
 
     # print()
     # print(ibd_file, hbd_file)
@@ -839,19 +841,38 @@ def main(results_directory, references_directory, utils_directory):
         required=True,
         help="The algorithm to use for IBD detection. Options: 'IBIS', 'HAP-IBD'."
     )
+    parser.add_argument(
+        "--export-tsv",
+        action="store_true",
+        help="Also write the legacy merged .seg TSV next to the Parquet segment store."
+    )
+    parser.add_argument(
+        "--merge-buffer-rows",
+        type=int,
+        default=MERGE_BUFFER_ROWS,
+        help="Segments held in memory while merging per-chromosome outputs before sorted runs are spilled to disk."
+    )
+    parser.add_argument(
+        "--no-parse-cache",
+        action="store_true",
+        help="Parse the result files again instead of reusing the parse cache in the results directory."
+    )
 
     args = parser.parse_args()
+    cache = None if args.no_parse_cache else ParseCache.for_results(results_directory)
 
     phased_samples_dir = os.path.join(results_directory, "phased_samples")
     if args.algorithm.upper() == "IBIS":
         convert_all_vcfs_to_plink(phased_samples_dir, utils_directory)
         add_genetic_map_to_all_bim(phased_samples_dir, references_directory, utils_directory)
         run_ibis(phased_samples_dir, results_directory, utils_directory)
-        ibis_completion = combine_and_sort_ibis_outputs(results_directory)
+        ibis_completion = combine_and_sort_ibis_outputs(results_directory, export_tsv=args.export_tsv,
+                                                        buffer_rows=args.merge_buffer_rows)
         # ibis_completion = True # Use only to bypass this section during testing or bebugging
 
         if ibis_completion == True:
-            explore_coefficients(results_directory, filename="ibis_MergedSamples.coef", focus_on_related=True)
+            explore_coefficients(results_directory, filename="ibis_MergedSamples.coef", focus_on_related=True,
+                                 cache=cache)
             
             explore_segments_ibis(
                 results_directory, 
@@ -860,14 +881,16 @@ def main(results_directory, references_directory, utils_directory):
                 min_markers=436, 
                 max_error_density=0.004,
                 save_plots=True, 
-                output_subdir="segments"
+                output_subdir="segments",
+                cache=cache
             )
             # FIX: add IBD Type in descriptives
     elif args.algorithm.upper() == "HAP-IBD":
         # hap_ibd_completion = run_hap_ibd(phased_samples_dir, results_directory, utils_directory, references_directory)
         hap_ibd_completion = True # Use only to bypass this section during testing or bebugging
 
-        combine_and_sort_hap_ibd_outputs(results_directory)
+        combine_and_sort_hap_ibd_outputs(results_directory, export_tsv=args.export_tsv,
+                                         buffer_rows=args.merge_buffer_rows)
 
         if hap_ibd_completion == True:
             explore_hap_ibd_results(
@@ -875,7 +898,8 @@ def main(results_directory, references_directory, utils_directory):
                 file_prefix="hap_ibd_MergedSamples",
                 min_length=3, 
                 save_filtered=True, 
-                output_subdir="segments"
+                output_subdir="segments",
+                cache=cache
             )
     else:
         raise ValueError("Unsupported algorithm. Choose 'IBIS' or 'HAP-IBD'")
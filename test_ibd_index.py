@@ -1,255 +1,1676 @@
+import os
+import sys
+import json
 import time
-import random
-from numba import jit
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from numba import njit, prange
+
+# Column layout of the IBDIndex segment table (one entry per segment)
+COLUMN_DTYPES = {
+    'id1': np.int32,        # dense code of the first individual
+    'id2': np.int32,        # dense code of the second individual
+    'hap1': np.int8,        # haplotype of id1 (-1 for unphased segments)
+    'hap2': np.int8,        # haplotype of id2 (-1 for unphased segments)
+    'chrom': np.int16,      # dense code of the chromosome
+    'start': np.float64,    # start_bp (unphased) or start_cm (phased)
+    'end': np.float64,      # end_bp (unphased) or end_cm (phased)
+    'cm': np.float64,       # segment length in cM
+    'is_full': np.bool_,    # IBD2 flag (always False for phased segments)
+    'phased': np.bool_,     # True if the segment came in the phased layout
+    'seq': np.int64,        # insertion sequence number (order segments were added in)
+}
+
+# DataFrame layouts accepted by IBDIndex.from_frame. Each field lists the
+# column names used for it across the pipeline (run_bonsai readers, the
+# ibd_complete_workflow loaders, raw header-less reads) in order of preference.
+FRAME_SCHEMAS = {
+    'ibis': {
+        'segment_type': 'unphased',
+        'id1': ('id1', 'sample1', 0),
+        'id2': ('id2', 'sample2', 1),
+        'chrom': ('chromosome', 'chrom', 2),
+        'start': ('physical_position_start', 'phys_start_pos', 'start', 3),
+        'end': ('physical_position_end', 'phys_end_pos', 'end', 4),
+        'ibd_type': ('IBD_type', 5),
+        'cm': ('genetic_length', 'genetic_seg_length', 'cM', 8),
+    },
+    'hapibd': {
+        'segment_type': 'phased',
+        'id1': ('id1', 'sample1', 0),
+        'hap1': ('id1_haplotype_index', 'sample1_haplotype', 1),
+        'id2': ('id2', 'sample2', 2),
+        'hap2': ('id2_haplotype_index', 'sample2_haplotype', 3),
+        'chrom': ('chromosome', 'chrom', 4),
+        'start': ('physical_position_start', 'start', 5),
+        'end': ('physical_position_end', 'end', 6),
+        'cm': ('genetic_length', 'cM', 7),
+    },
+    'pedsim': {
+        'segment_type': 'unphased',
+        'id1': ('id1', 'sample1', 0),
+        'id2': ('id2', 'sample2', 1),
+        'chrom': ('chromosome', 'chrom', 2),
+        'start': ('physical_position_start', 'start', 3),
+        'end': ('physical_position_end', 'end', 4),
+        'ibd_type': ('IBD_type', 5),
+        'cm': ('genetic_length', 'cM', 8),
+    },
+}
+
+# Grouping arrays that make up a built index, persisted by IBDIndex.save
+INDEX_ARRAYS = (
+    'pair_keys', 'pair_offsets',
+    'id_keys', 'id_offsets', 'id_rows',
+    'chrom_keys', 'chrom_offsets', 'chrom_rows',
+    'interval_keys', 'interval_offsets', 'interval_rows', 'interval_max_length',
+    'interval_starts', 'interval_sorted_ends',
+    'haplotype_keys', 'haplotype_offsets', 'haplotype_rows',
+)
+
+# On-disk layout: magic, format version (uint32), header length (uint64), a
+# JSON header, then every array at a 64-byte aligned offset given in the header
+INDEX_FORMAT_MAGIC = b'IBDINDEX'
+INDEX_FORMAT_VERSION = 1
+INDEX_FORMAT_ALIGNMENT = 64
+
+EMPTY_PAIR_STATS = {
+    'total_half': 0,
+    'total_full': 0,
+    'num_half': 0,
+    'num_full': 0,
+    'max_seg_cm': 0
+}
+
+
+def _row_dtype(num_rows):
+    """Smallest integer dtype able to address every row of the table."""
+    return np.int32 if num_rows < 2**31 else np.int64
+
+
+def _group_offsets(*sorted_keys):
+    """
+    Split already-sorted key arrays into runs of equal keys.
+
+    Returns the index of the first row of every run and a CSR offset array
+    (length number of runs + 1) delimiting the runs.
+    """
+    num_rows = len(sorted_keys[0])
+    if num_rows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    is_start = np.zeros(num_rows, dtype=bool)
+    is_start[0] = True
+    for keys in sorted_keys:
+        is_start[1:] |= keys[1:] != keys[:-1]
+    starts = np.flatnonzero(is_start)
+    return starts, np.append(starts, num_rows)
+
+
+def _refine_order(order, *keys):
+    """
+    Stably re-sort a row order by each key array in turn.
+
+    Like ``np.lexsort`` the last key is the primary one, and rows that tie on
+    every key keep their position in ``order``.
+    """
+    for key in keys:
+        order = order[np.argsort(key[order], kind='stable')]
+    return order
+
+
+def _in_sorted(values, sorted_keys):
+    """Boolean mask of the ``values`` present in a sorted unique key array."""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+    return sorted_keys[pos] == values
+
+
+def _merge_groups(keys, rows, new_keys, new_rows, *sort_columns):
+    """
+    Merge new entries into a grouping sorted by (key, sort columns).
+
+    ``keys``/``rows`` are the existing entries in order and ``sort_columns``
+    are table columns (least significant first, as for ``_refine_order``).
+    Only the groups receiving new entries are re-sorted; every other group is
+    copied through unchanged. Returns the merged (keys, rows).
+    """
+    if len(new_keys) == 0:
+        return keys, rows
+    touched = _in_sorted(keys, np.unique(new_keys))
+    moved_keys = np.concatenate([keys[touched], new_keys])
+    moved_rows = np.concatenate([rows[touched], new_rows])
+    order = _refine_order(np.arange(len(moved_rows)),
+                          *[column[moved_rows] for column in sort_columns], moved_keys)
+    moved_keys, moved_rows = moved_keys[order], moved_rows[order]
+    rest_keys, rest_rows = keys[~touched], rows[~touched]
+
+    # Touched and untouched groups are disjoint, so every moved entry goes
+    # right before the first untouched entry with a larger key
+    is_moved = np.zeros(len(rest_keys) + len(moved_keys), dtype=bool)
+    is_moved[np.searchsorted(rest_keys, moved_keys) + np.arange(len(moved_keys))] = True
+    merged_keys = np.empty(len(is_moved), dtype=np.result_type(keys, new_keys))
+    merged_rows = np.empty(len(is_moved), dtype=np.result_type(rows, new_rows))
+    merged_keys[is_moved], merged_keys[~is_moved] = moved_keys, rest_keys
+    merged_rows[is_moved], merged_rows[~is_moved] = moved_rows, rest_rows
+    return merged_keys, merged_rows
+
+
+def _sequence_order(offsets, rows, seq):
+    """Rows of every CSR group, reordered within the group by insertion sequence."""
+    groups = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+    num_seq = int(seq.max()) + 1 if len(seq) else 1
+    if (len(offsets) - 1) * num_seq >= 2**63:
+        return rows[np.lexsort((seq[rows], groups))]
+    # One sort on (group, seq) packed into an int64 is much faster than lexsort;
+    # rows tying on it are the same row listed twice (a self-shared segment)
+    return rows[np.argsort(groups * num_seq + seq[rows])]
+
+
+def _group_rows(offsets, groups):
+    """Concatenated positions of the given CSR groups and the size of each group."""
+    counts = offsets[groups + 1] - offsets[groups]
+    positions = np.repeat(offsets[groups] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    return positions, counts
+
+
+def _interval_block_keys(chrom, phased, start, end):
+    """Interval block key (chrom * 2 + phased) << 8 | power-of-4 length class."""
+    length_class = np.floor(np.log(np.maximum(end - start, 1e-9)) / np.log(4)).astype(np.int64) + 128
+    return ((chrom.astype(np.int64) * 2 + phased) << 8) | length_class
+
+
+def _haplotype_keys(codes, haps):
+    """Haplotype grouping key (code << 8 | hap)."""
+    return (codes.astype(np.int64) << 8) | (haps.astype(np.int64) & 0xFF)
+
+
+def pack_pair_keys(codes1, codes2):
+    """
+    Encode unordered pairs of individual codes as int64 keys (min << 32 | max).
+
+    Works on scalars or arrays; the key is the same for (a, b) and (b, a).
+    """
+    low = np.minimum(codes1, codes2).astype(np.int64)
+    high = np.maximum(codes1, codes2).astype(np.int64)
+    return (low << 32) | high
+
+
+def unpack_pair_keys(keys):
+    """Split int64 pair keys back into their (low, high) individual codes."""
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys >> 32).astype(np.int32), (keys & 0xFFFFFFFF).astype(np.int32)
+
+
+def _find_group(keys, key):
+    """Position of ``key`` in a sorted unique key array, or -1."""
+    pos = np.searchsorted(keys, key)
+    if pos < len(keys) and keys[pos] == key:
+        return int(pos)
+    return -1
+
+
+@njit(parallel=True)
+def _pair_stats_kernel(offsets, rows, cm, is_full, phased):
+    """
+    Per-pair IBD statistics of a CSR pair grouping (unphased rows only).
+
+    Pairs are processed in parallel; the rows of a pair are summed in the
+    order ``rows`` lists them, which is insertion order (_sequence_order), so
+    totals are bit-identical to adding the segments one by one.
+    """
+    num_pairs = len(offsets) - 1
+    total_half = np.zeros(num_pairs)
+    total_full = np.zeros(num_pairs)
+    num_half = np.zeros(num_pairs, dtype=np.int64)
+    num_full = np.zeros(num_pairs, dtype=np.int64)
+    max_seg_cm = np.zeros(num_pairs)
+    for pair in prange(num_pairs):
+        for position in range(offsets[pair], offsets[pair + 1]):
+            row = rows[position]
+            if phased[row]:
+                continue
+            if is_full[row]:
+                total_full[pair] += cm[row]
+                num_full[pair] += 1
+            else:
+                total_half[pair] += cm[row]
+                num_half[pair] += 1
+            max_seg_cm[pair] = max(max_seg_cm[pair], cm[row])
+    return total_half, total_full, num_half, num_full, max_seg_cm
+
+
+@njit(parallel=True)
+def _grouped_cm_kernel(offsets, rows, cm, phased, want_phased):
+    """
+    Total cM and segment count of every group of a CSR grouping, for one
+    layout, summing each group's rows in the order ``rows`` lists them.
+    """
+    num_groups = len(offsets) - 1
+    totals = np.zeros(num_groups)
+    counts = np.zeros(num_groups, dtype=np.int64)
+    for group in prange(num_groups):
+        for position in range(offsets[group], offsets[group + 1]):
+            row = rows[position]
+            if phased[row] == want_phased:
+                totals[group] += cm[row]
+                counts[group] += 1
+    return totals, counts
+
+
+@njit(parallel=True)
+def _set_pair_sum_kernel(pair_keys, pair_totals, counts1, counts2):
+    """
+    Sum pair totals over every (a in set1, b in set2, a != b) combination,
+    an individual listed several times in a set counting as often.
+
+    Contributions are computed in parallel and then reduced sequentially in
+    pair order, so the result does not depend on the number of threads.
+    """
+    num_pairs = len(pair_keys)
+    contributions = np.zeros(num_pairs)
+    for pair in prange(num_pairs):
+        low = pair_keys[pair] >> 32
+        high = pair_keys[pair] & 0xFFFFFFFF
+        if low == high:
+            continue
+        times = counts1[low] * counts2[high] + counts1[high] * counts2[low]
+        contributions[pair] = times * pair_totals[pair]
+    total = 0.0
+    for pair in range(num_pairs):
+        total += contributions[pair]
+    return total
+
+
+@njit(parallel=True)
+def _coverage_kernel(offsets, rows, chrom, start, end, classes, phased, want_phased):
+    """
+    Union length and IBD2 length of every group of a CSR grouping, for one layout.
+
+    Rows of a group must be ordered by (chromosome, start). Every chromosome
+    run is swept once over its starts and sorted ends; a stretch is IBD2
+    while class bits 0 and 3, or 1 and 2, are both open (two complementary
+    haplotype pairings, or an unphased IBD2 segment, which sets bits 0 and 3).
+    """
+    num_groups = len(offsets) - 1
+    covered = np.zeros(num_groups)
+    doubled = np.zeros(num_groups)
+    for group in prange(num_groups):
+        selected = rows[offsets[group]:offsets[group + 1]]
+        selected = selected[phased[selected] == want_phased]
+        first = 0
+        while first < len(selected):
+            last = first + 1
+            while last < len(selected) and chrom[selected[last]] == chrom[selected[first]]:
+                last += 1
+            run = selected[first:last]
+            run_ends = end[run]
+            end_order = np.argsort(run_ends)
+            open_classes = np.zeros(4, dtype=np.int64)
+            num_open = 0
+            position = start[run[0]]
+            i = 0
+            j = 0
+            while j < len(run):
+                if i < len(run) and start[run[i]] <= run_ends[end_order[j]]:
+                    next_position = start[run[i]]
+                    row_class = classes[run[i]]
+                    delta = 1
+                    i += 1
+                else:
+                    next_position = run_ends[end_order[j]]
+                    row_class = classes[run[end_order[j]]]
+                    delta = -1
+                    j += 1
+                if num_open > 0:
+                    covered[group] += next_position - position
+                    if ((open_classes[0] > 0 and open_classes[3] > 0)
+                            or (open_classes[1] > 0 and open_classes[2] > 0)):
+                        doubled[group] += next_position - position
+                for bit in range(4):
+                    if row_class & (1 << bit):
+                        open_classes[bit] += delta
+                num_open += delta
+                position = next_position
+            first = last
+    return covered, doubled
+
+
+class SegmentView:
+    """
+    Read-only window onto a group of rows in an IBDIndex.
+
+    Columns are read with ``view["cm"]``, ``view["start"]`` and so on. For pair
+    lookups ``rows`` is a slice and every column is a zero-copy view of the
+    index table; for the individual, chromosome and haplotype groupings
+    ``rows`` is a zero-copy view of that grouping's permutation array and
+    columns are gathered when accessed. Iterating yields segments in the list
+    layout accepted by ``IBDIndex.add_segment``.
+    """
+    __slots__ = ('index', 'rows')
+
+    def __init__(self, index, rows):
+        self.index = index
+        self.rows = rows
+
+    def __len__(self):
+        if isinstance(self.rows, slice):
+            return self.rows.stop - self.rows.start
+        return len(self.rows)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, column):
+        return self.index.columns[column][self.rows]
+
+    def __iter__(self):
+        ids = self.index.ids
+        chroms = self.index.chromosomes
+        cols = {name: self[name].tolist() for name in COLUMN_DTYPES}
+        for i in range(len(self)):
+            id1 = ids[cols['id1'][i]]
+            id2 = ids[cols['id2'][i]]
+            chrom = chroms[cols['chrom'][i]]
+            if cols['phased'][i]:
+                yield [id1, id2, cols['hap1'][i], cols['hap2'][i], chrom,
+                       cols['start'][i], cols['end'][i], cols['cm'][i]]
+            else:
+                yield [id1, id2, chrom, cols['start'][i], cols['end'][i],
+                       cols['is_full'][i], cols['cm'][i]]
+
+    def to_list(self):
+        """Materialise the view as a list of segments."""
+        return list(self)
+
 
 class IBDIndex:
     """
     An efficient indexing structure for IBD segments that supports both
     phased and unphased data with optimized access patterns aligned with v3.
+
+    Segments are stored column-wise (struct-of-arrays, see COLUMN_DTYPES) in a
+    single table sorted by (pair, chromosome, start). Individuals and
+    chromosomes are dictionary-encoded to dense integer codes. The pair,
+    individual, chromosome and haplotype groupings are CSR-style offset arrays
+    built in one sorted bulk pass; added segments are buffered and merged into
+    the table the next time the index is queried. Removals, chromosome
+    replacements and updates are merged into the built groupings directly,
+    re-sorting only the groups and recomputing only the pair statistics they
+    touch. Every segment keeps the sequence number it was inserted with
+    (updated segments get a new one), and the cM totals add each group's
+    segments in that order, exactly as the segments were added.
+
+    Given a SampleRegistry, the index shares its ID dictionaries, so
+    individual codes are the cohort-wide registry codes and IDs first seen
+    here are registered there.
     """
-    def __init__(self, min_cm=7.0):
+    def __init__(self, min_cm=7.0, registry=None):
         self.min_cm = min_cm
-        self.pair_index = {}           # {frozenset({id1, id2}): [segment_list]}
-        self.id_index = {}             # {id: [segment_list]}
-        self.pair_stats = {}           # {frozenset({id1, id2}): stats_dict}
-        self.chrom_index = {}          # {chrom: [segment_list]}
-        self.id_to_chrom_index = {}    # {id: {chrom: [segment_list]}}
-        self.haplotype_index = {}      # {(id, hap): [segment_list]} (for phased data)
-        
+        self.ids = registry.ids if registry is not None else []            # {code: id}
+        self.id_codes = registry.codes if registry is not None else {}     # {id: code}
+        self.registry = registry
+        self.chromosomes = []          # {code: chromosome}
+        self.chrom_codes = {}          # {chromosome: code}
+        self.columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
+        self._pending = {'unphased': [], 'phased': []}
+        self._pending_seq = {'unphased': [], 'phased': []}   # (first seq, count) per add call
+        self._pending_blocks = []
+        self._next_seq = 0
+        self._build_indexes()
+
+    def __len__(self):
+        self._flush()
+        return len(self.columns['cm'])
+
+    def _named_arrays(self):
+        """Every array of the built index, keyed by its name in the file header."""
+        arrays = {f'columns/{name}': values for name, values in self.columns.items()}
+        arrays.update({f'pair_stats/{name}': values for name, values in self.pair_stats.items()})
+        arrays.update({name: getattr(self, name) for name in INDEX_ARRAYS})
+        return arrays
+
+    def save(self, path):
+        """
+        Write the built index to a single binary file.
+
+        The file holds the segment columns, pair statistics, every grouping
+        array and the ID/chromosome dictionaries, so ``IBDIndex.open`` can map
+        it back without rebuilding anything.
+        """
+        self._flush()
+        arrays = self._named_arrays()
+        entries = {}
+        offset = 0
+        for name, values in arrays.items():
+            offset = -(-offset // INDEX_FORMAT_ALIGNMENT) * INDEX_FORMAT_ALIGNMENT
+            entries[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+            offset += values.nbytes
+        to_json = lambda value: value.item() if isinstance(value, np.generic) else value
+        header = json.dumps({
+            'min_cm': self.min_cm,
+            'ids': [to_json(id_val) for id_val in self.ids],
+            'chromosomes': [to_json(chrom) for chrom in self.chromosomes],
+            'arrays': entries,
+        }).encode('utf-8')
+
+        # Array offsets in the header are relative to the aligned data section
+        prefix_length = len(INDEX_FORMAT_MAGIC) + 4 + 8 + len(header)
+        data_start = -(-prefix_length // INDEX_FORMAT_ALIGNMENT) * INDEX_FORMAT_ALIGNMENT
+        with open(path, 'wb') as f:
+            f.write(INDEX_FORMAT_MAGIC)
+            f.write(np.uint32(INDEX_FORMAT_VERSION).tobytes())
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name, values in arrays.items():
+                f.seek(data_start + entries[name]['offset'])
+                f.write(np.ascontiguousarray(values).tobytes())
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        """
+        Load an index written by ``save``.
+
+        With ``mmap=True`` the arrays are read-only memory maps of the file,
+        so opening costs only the header parse and processes opening the same
+        file share its pages through the OS cache. Segments added afterwards
+        are merged into fresh in-memory arrays as usual.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(INDEX_FORMAT_MAGIC)) != INDEX_FORMAT_MAGIC:
+                raise ValueError(f"Not an IBDIndex file: {path}")
+            version = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+            if version != INDEX_FORMAT_VERSION:
+                raise ValueError(f"Unsupported IBDIndex format version {version} in {path}")
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        prefix_length = len(INDEX_FORMAT_MAGIC) + 4 + 8 + header_length
+        data_start = -(-prefix_length // INDEX_FORMAT_ALIGNMENT) * INDEX_FORMAT_ALIGNMENT
+
+        arrays = {}
+        with open(path, 'rb') as f:
+            for name, entry in header['arrays'].items():
+                dtype = np.dtype(entry['dtype'])
+                shape = tuple(entry['shape'])
+                count = int(np.prod(shape))
+                if count == 0:
+                    arrays[name] = np.zeros(shape, dtype=dtype)
+                elif mmap:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + entry['offset'], shape=shape)
+                else:
+                    f.seek(data_start + entry['offset'])
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+        index = cls.__new__(cls)
+        index.min_cm = header['min_cm']
+        index.ids = header['ids']
+        index.id_codes = {id_val: code for code, id_val in enumerate(index.ids)}
+        index.registry = None
+        index.chromosomes = header['chromosomes']
+        index.chrom_codes = {chrom: code for code, chrom in enumerate(index.chromosomes)}
+        # Files written before the insertion sequence was stored number their
+        # segments in table order
+        num_rows = len(arrays['columns/cm'])
+        arrays.setdefault('columns/seq', np.arange(num_rows, dtype=COLUMN_DTYPES['seq']))
+        index.columns = {name: arrays[f'columns/{name}'] for name in COLUMN_DTYPES}
+        index.pair_stats = {name: arrays[f'pair_stats/{name}'] for name in EMPTY_PAIR_STATS}
+        for name in INDEX_ARRAYS:
+            setattr(index, name, arrays[name])
+        index._pair_matrices = {}
+        index._sequence_rows = {}
+        index._pending = {'unphased': [], 'phased': []}
+        index._pending_seq = {'unphased': [], 'phased': []}
+        index._pending_blocks = []
+        index._next_seq = int(index.columns['seq'].max()) + 1 if num_rows else 0
+        return index
+
+    def _id_code(self, id_val):
+        if self.registry is not None:
+            return self.registry.code(id_val)
+        code = self.id_codes.get(id_val)
+        if code is None:
+            code = len(self.ids)
+            self.id_codes[id_val] = code
+            self.ids.append(id_val)
+        return code
+
+    def _chrom_code(self, chrom):
+        code = self.chrom_codes.get(chrom)
+        if code is None:
+            code = len(self.chromosomes)
+            self.chrom_codes[chrom] = code
+            self.chromosomes.append(chrom)
+        return code
+
+    def _reserve_seq(self, count):
+        """First of ``count`` consecutive insertion sequence numbers."""
+        first = self._next_seq
+        self._next_seq += count
+        return first
+
     def add_segment(self, segment, segment_type="unphased"):
         """Add a segment to all relevant indexes."""
+        if segment_type in self._pending:
+            self._pending[segment_type].append(segment)
+            self._pending_seq[segment_type].append((self._reserve_seq(1), 1))
+
+    def add_segments(self, segments, segment_type="unphased"):
+        """Add multiple segments at once."""
+        if segment_type in self._pending:
+            segments = list(segments)
+            self._pending[segment_type].extend(segments)
+            self._pending_seq[segment_type].append((self._reserve_seq(len(segments)), len(segments)))
+
+    @classmethod
+    def from_frame(cls, df, schema="ibis", min_cm=7.0, registry=None):
+        """
+        Build an index directly from a segment DataFrame.
+
+        Parameters:
+            df (pd.DataFrame): Segments in one of the FRAME_SCHEMAS layouts,
+                               with named or positional (header=None) columns.
+            schema (str): "ibis", "hapibd" or "pedsim".
+            min_cm (float): Minimum segment length kept in the index.
+            registry (SampleRegistry): Cohort registry whose codes the index uses.
+
+        Returns:
+            IBDIndex: The built index.
+        """
+        index = cls(min_cm=min_cm, registry=registry)
+        index.add_frame(df, schema)
+        index._flush()
+        return index
+
+    def add_frame(self, df, schema="ibis"):
+        """
+        Add every segment of a DataFrame (see from_frame) in one vectorised
+        pass: the min_cm filter is a mask, IDs and chromosomes are factorized
+        once, and the block is merged on the next query like add_segments.
+        """
+        spec = FRAME_SCHEMAS[schema]
+
+        def column(field):
+            for name in spec[field]:
+                if name in df.columns:
+                    return df[name]
+            raise KeyError(f"No column for '{field}' in {schema} frame; expected one of {spec[field]}")
+
+        cm = column('cm').to_numpy(dtype=np.float64)
+        keep = cm >= self.min_cm
+        num_kept = int(keep.sum())
+        first_seq = self._reserve_seq(len(cm))
+
+        def values(field, dtype):
+            return column(field).to_numpy()[keep].astype(dtype)
+
+        pair_ids = pd.concat([column('id1')[keep], column('id2')[keep]], ignore_index=True)
+        if self.registry is not None:
+            # Columns already recoded with the registry are used as they are
+            codes = self.registry.encode(pair_ids)
+            id1_codes, id2_codes = codes[:num_kept], codes[num_kept:]
+        else:
+            ids, unique_ids = pd.factorize(pair_ids)
+            id_lookup = np.fromiter((self._id_code(id_val) for id_val in unique_ids.tolist()), np.int32, len(unique_ids))
+            id1_codes, id2_codes = id_lookup[ids[:num_kept]], id_lookup[ids[num_kept:]]
+        chroms, unique_chroms = pd.factorize(column('chrom')[keep])
+        chrom_lookup = np.fromiter((self._chrom_code(chrom) for chrom in unique_chroms.tolist()),
+                                   np.int16, len(unique_chroms))
+
+        phased = spec['segment_type'] == "phased"
+        if phased:
+            is_full = np.zeros(num_kept, dtype=np.bool_)
+        else:
+            # IBD_type is "IBD1"/"IBD2" in IBIS and ped-sim output, 1/2 once recoded
+            ibd_type = column('ibd_type')[keep]
+            if pd.api.types.is_numeric_dtype(ibd_type):
+                is_full = ibd_type.to_numpy() == 2
+            else:
+                is_full = ibd_type.astype(str).str.upper().isin(['IBD2', '2']).to_numpy()
+
+        self._pending_blocks.append({
+            'id1': id1_codes,
+            'id2': id2_codes,
+            'hap1': values('hap1', np.int8) if phased else np.full(num_kept, -1, np.int8),
+            'hap2': values('hap2', np.int8) if phased else np.full(num_kept, -1, np.int8),
+            'chrom': chrom_lookup[chroms],
+            'start': values('start', np.float64),
+            'end': values('end', np.float64),
+            'cm': cm[keep],
+            'is_full': is_full,
+            'phased': np.full(num_kept, phased, np.bool_),
+            'seq': (first_seq + np.flatnonzero(keep)).astype(np.int64),
+        })
+
+    def _encode(self, segments, segment_type, min_cm=None, seq=None):
+        """
+        Convert buffered segment lists into typed columns. ``seq`` gives the
+        insertion sequence number of every segment (default: new ones).
+        """
+        if seq is None:
+            seq = self._reserve_seq(len(segments)) + np.arange(len(segments), dtype=np.int64)
+        if not segments:
+            return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
         if segment_type == "unphased":
             # [id1, id2, chromosome, start_bp, end_bp, is_full_ibd, seg_cm]
-            id1, id2, chrom, start, end, is_full, seg_cm = segment
-            
-            # Filter by minimum length
-            if seg_cm < self.min_cm:
-                return
-                
-            # Create keys
-            pair_key = frozenset({id1, id2})
-            
-            # Update pair index
-            if pair_key not in self.pair_index:
-                self.pair_index[pair_key] = []
-            self.pair_index[pair_key].append(segment)
-            
-            # Update individual index
-            for id_val in [id1, id2]:
-                if id_val not in self.id_index:
-                    self.id_index[id_val] = []
-                self.id_index[id_val].append(segment)
-                
-                # Update id-to-chrom index
-                if id_val not in self.id_to_chrom_index:
-                    self.id_to_chrom_index[id_val] = {}
-                if chrom not in self.id_to_chrom_index[id_val]:
-                    self.id_to_chrom_index[id_val][chrom] = []
-                self.id_to_chrom_index[id_val][chrom].append(segment)
-            
-            # Update chromosome index
-            if chrom not in self.chrom_index:
-                self.chrom_index[chrom] = []
-            self.chrom_index[chrom].append(segment)
-            
-            # Update stats
-            if pair_key not in self.pair_stats:
-                self.pair_stats[pair_key] = {
-                    'total_half': 0,
-                    'total_full': 0,
-                    'num_half': 0,
-                    'num_full': 0,
-                    'max_seg_cm': 0
-                }
-            
-            if is_full:
-                self.pair_stats[pair_key]['total_full'] += seg_cm
-                self.pair_stats[pair_key]['num_full'] += 1
-            else:
-                self.pair_stats[pair_key]['total_half'] += seg_cm
-                self.pair_stats[pair_key]['num_half'] += 1
-            
-            self.pair_stats[pair_key]['max_seg_cm'] = max(
-                self.pair_stats[pair_key]['max_seg_cm'], seg_cm
-            )
-            
-        elif segment_type == "phased":
+            id1, id2, chrom, start, end, is_full, seg_cm = zip(*segments)
+            hap1 = hap2 = None
+        else:
             # [id1, id2, hap1, hap2, chromosome, start_cm, end_cm, seg_cm]
-            id1, id2, hap1, hap2, chrom, start, end, seg_cm = segment
-            
-            # Filter by minimum length
-            if seg_cm < self.min_cm:
-                return
-                
-            # Create keys
-            pair_key = frozenset({id1, id2})
-            hap1_key = (id1, hap1)
-            hap2_key = (id2, hap2)
-            
-            # Update pair index
-            if pair_key not in self.pair_index:
-                self.pair_index[pair_key] = []
-            self.pair_index[pair_key].append(segment)
-            
-            # Update individual index
-            for id_val in [id1, id2]:
-                if id_val not in self.id_index:
-                    self.id_index[id_val] = []
-                self.id_index[id_val].append(segment)
-            
-            # Update haplotype index
-            for hap_key in [hap1_key, hap2_key]:
-                if hap_key not in self.haplotype_index:
-                    self.haplotype_index[hap_key] = []
-                self.haplotype_index[hap_key].append(segment)
-            
-            # Update chromosome index
-            if chrom not in self.chrom_index:
-                self.chrom_index[chrom] = []
-            self.chrom_index[chrom].append(segment)
-    
-    def add_segments(self, segments, segment_type="unphased"):
-        """Add multiple segments at once."""
-        for segment in segments:
-            self.add_segment(segment, segment_type)
-    
-    # Removed the @jit decorator to avoid Numba errors with frozenset
+            id1, id2, hap1, hap2, chrom, start, end, seg_cm = zip(*segments)
+            is_full = None
+
+        # Filter by minimum length before any value is encoded
+        cm = np.asarray(seg_cm, dtype=np.float64)
+        keep = np.flatnonzero(cm >= (self.min_cm if min_cm is None else min_cm))
+        num_kept = len(keep)
+
+        def take(values, dtype):
+            return np.asarray(values)[keep].astype(dtype)
+
+        kept = keep.tolist()
+        return {
+            'id1': np.fromiter((self._id_code(id1[i]) for i in kept), np.int32, num_kept),
+            'id2': np.fromiter((self._id_code(id2[i]) for i in kept), np.int32, num_kept),
+            'hap1': take(hap1, np.int8) if hap1 is not None else np.full(num_kept, -1, np.int8),
+            'hap2': take(hap2, np.int8) if hap2 is not None else np.full(num_kept, -1, np.int8),
+            'chrom': np.fromiter((self._chrom_code(chrom[i]) for i in kept), np.int16, num_kept),
+            'start': take(start, np.float64),
+            'end': take(end, np.float64),
+            'cm': cm[keep],
+            'is_full': take(is_full, np.bool_) if is_full is not None else np.zeros(num_kept, np.bool_),
+            'phased': np.full(num_kept, segment_type == "phased", np.bool_),
+            'seq': seq[keep],
+        }
+
+    def _flush(self):
+        """Merge buffered segments into the table and rebuild the groupings."""
+        blocks, self._pending_blocks = self._pending_blocks, []
+        for segment_type, segments in self._pending.items():
+            if segments:
+                seq = np.concatenate([np.arange(first, first + count, dtype=np.int64)
+                                      for first, count in self._pending_seq[segment_type]])
+                blocks.append(self._encode(segments, segment_type, seq=seq))
+                self._pending[segment_type] = []
+                self._pending_seq[segment_type] = []
+        if not blocks:
+            return
+        self.columns = {
+            name: np.concatenate([self.columns[name]] + [block[name] for block in blocks])
+            for name in COLUMN_DTYPES
+        }
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """Sort the table by pair and build every CSR grouping in one pass."""
+        cols = self.columns
+        num_rows = len(cols['cm'])
+        row_dtype = _row_dtype(2 * num_rows)
+
+        # Pair grouping: the table itself is ordered by (pair, chrom, start).
+        # The float columns are sorted once; every grouping below refines that
+        # (start, end) order with stable integer sorts on its own keys.
+        keys = pack_pair_keys(cols['id1'], cols['id2'])
+        by_start = np.lexsort((cols['end'], cols['start']))
+        order = _refine_order(by_start, cols['chrom'], keys)
+        for name in cols:
+            cols[name] = cols[name][order]
+        starts, self.pair_offsets = _group_offsets(keys[order])
+        self.pair_keys = keys[order][starts]
+        self._pair_matrices = {}
+        self._sequence_rows = {}
+        position = np.empty(num_rows, dtype=row_dtype)
+        position[order] = np.arange(num_rows, dtype=row_dtype)
+        by_start = position[by_start]
+
+        # Pair statistics (unphased segments only), one array per statistic,
+        # summed in insertion order within each pair
+        pair_rows = _sequence_order(self.pair_offsets, np.arange(num_rows, dtype=row_dtype), cols['seq'])
+        self.pair_stats = dict(zip(EMPTY_PAIR_STATS, _pair_stats_kernel(
+            self.pair_offsets, pair_rows, cols['cm'], cols['is_full'], cols['phased'])))
+
+        # Individual grouping: every row is listed under both of its individuals
+        by_chrom = _refine_order(by_start, cols['chrom'])
+        # Entries are interleaved (row, row) so the stable key sort keeps the
+        # (chrom, start) order within each individual
+        rows = np.repeat(by_chrom, 2)
+        keys = np.column_stack([cols['id1'][by_chrom], cols['id2'][by_chrom]]).ravel()
+        order = np.argsort(keys, kind='stable')
+        self.id_rows = rows[order]
+        starts, self.id_offsets = _group_offsets(keys[order])
+        self.id_keys = keys[order][starts]
+
+        # Chromosome grouping, ordered by (layout, start) within each chromosome
+        order = _refine_order(by_start, cols['phased'], cols['chrom'])
+        self.chrom_rows = order
+        starts, self.chrom_offsets = _group_offsets(cols['chrom'][order])
+        self.chrom_keys = cols['chrom'][order][starts]
+
+        # Interval index. Phased (cM) and unphased (bp) coordinates get separate
+        # blocks per chromosome, each split further into power-of-4 length
+        # classes so that a region query only looks back by the longest segment
+        # of a class instead of the longest on the chromosome. Blocks are keyed
+        # on (chrom * 2 + phased) << 8 | length class and keep their sorted
+        # starts, sorted ends and maximum length.
+        lengths = cols['end'] - cols['start']
+        block_keys = _interval_block_keys(cols['chrom'], cols['phased'], cols['start'], cols['end'])
+        order = _refine_order(by_start, block_keys)
+        self.interval_rows = order
+        starts, self.interval_offsets = _group_offsets(block_keys[order])
+        self.interval_keys = block_keys[order][starts]
+        self.interval_max_length = (np.maximum.reduceat(lengths[order], starts)
+                                    if len(starts) else np.zeros(0))
+        self.interval_starts = cols['start'][order]
+        self.interval_sorted_ends = cols['end'][order]
+        for first, last in zip(self.interval_offsets[:-1], self.interval_offsets[1:]):
+            self.interval_sorted_ends[first:last].sort()
+
+        # Haplotype grouping (phased segments only), keyed on (code << 8 | hap)
+        phased_rows = by_chrom[cols['phased'][by_chrom]]
+        rows = np.repeat(phased_rows, 2)
+        keys = np.column_stack([_haplotype_keys(cols['id1'][phased_rows], cols['hap1'][phased_rows]),
+                                _haplotype_keys(cols['id2'][phased_rows], cols['hap2'][phased_rows])]).ravel()
+        order = np.argsort(keys, kind='stable')
+        self.haplotype_rows = rows[order]
+        starts, self.haplotype_offsets = _group_offsets(keys[order])
+        self.haplotype_keys = keys[order][starts]
+
+    def remove_individual(self, individual_id):
+        """
+        Remove every segment involving an individual (e.g. a sample failing QC).
+
+        The individual keeps its code in ``ids`` so pair matrices stay
+        aligned. Returns the number of segments removed.
+        """
+        self._flush()
+        code = self.id_codes.get(individual_id, -1)
+        group = _find_group(self.id_keys, code) if code >= 0 else -1
+        if group < 0:
+            return 0
+        rows = np.unique(self.id_rows[self.id_offsets[group]:self.id_offsets[group + 1]])
+        self._apply_changes(rows)
+        return len(rows)
+
+    def remove_pair(self, id1, id2):
+        """Remove every segment shared by a pair. Returns the number removed."""
+        self._flush()
+        group = self._pair_group(id1, id2)
+        if group < 0:
+            return 0
+        rows = np.arange(self.pair_offsets[group], self.pair_offsets[group + 1])
+        self._apply_changes(rows)
+        return len(rows)
+
+    def replace_chromosome(self, chrom, new_segments, segment_type="unphased"):
+        """
+        Swap the segments of one chromosome and layout for a new detection run.
+
+        Parameters:
+            chrom: Chromosome to replace.
+            new_segments (list): Segments in the add_segment layout, all on ``chrom``.
+            segment_type (str): "unphased" or "phased"; the other layout is kept.
+        """
+        self._flush()
+        block = self._encode(new_segments, segment_type)
+        code = self.chrom_codes.get(chrom, -1)
+        if (block['chrom'] != code).any():
+            raise ValueError(f"replace_chromosome({chrom!r}) got segments on other chromosomes")
+        group = _find_group(self.chrom_keys, code)
+        rows = np.zeros(0, dtype=np.int64)
+        if group >= 0:
+            rows = self.chrom_rows[self.chrom_offsets[group]:self.chrom_offsets[group + 1]]
+            rows = rows[self.columns['phased'][rows] == (segment_type == "phased")]
+        self._apply_changes(rows, block)
+
+    def update_segments(self, segments, segment_type="unphased"):
+        """
+        Insert or overwrite segments.
+
+        A segment replaces the stored one with the same pair, chromosome,
+        layout and start/end (so its length or IBD type can be corrected) and
+        is added otherwise. Updates that fall below ``min_cm`` remove the
+        stored segment.
+        """
+        self._flush()
+        block = self._encode(segments, segment_type, min_cm=-np.inf)
+        cols = self.columns
+
+        # Candidate rows: every stored segment of the pairs being updated
+        pair_keys = pack_pair_keys(block['id1'], block['id2'])
+        found = np.flatnonzero(_in_sorted(pair_keys, self.pair_keys))
+        rows, counts = _group_rows(self.pair_offsets, np.searchsorted(self.pair_keys, pair_keys[found]))
+        update = np.repeat(found, counts)
+        same = ((cols['chrom'][rows] == block['chrom'][update])
+                & (cols['start'][rows] == block['start'][update])
+                & (cols['end'][rows] == block['end'][update])
+                & (cols['phased'][rows] == block['phased'][update]))
+        keep = block['cm'] >= self.min_cm
+        self._apply_changes(np.unique(rows[same]), {name: values[keep] for name, values in block.items()})
+
+    def _apply_changes(self, drop_rows, block=None):
+        """
+        Remove table rows and merge a block of encoded segments into the
+        built index without a full rebuild.
+
+        Only the groups a change touches are re-sorted and only the touched
+        pairs have their statistics recomputed; everything else is carried
+        over with linear copies and row renumbering.
+        """
+        old = self.columns
+        num_old = len(old['cm'])
+        if block is None:
+            block = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
+        num_new = len(block['cm'])
+        drop = np.zeros(num_old, dtype=bool)
+        drop[drop_rows] = True
+        if not drop.any() and num_new == 0:
+            return
+        combined = {name: np.concatenate([old[name], block[name]]) for name in COLUMN_DTYPES}
+        num_rows = num_old - int(drop.sum()) + num_new
+        row_dtype = _row_dtype(2 * num_rows)
+        new_rows = np.arange(num_old, num_old + num_new)
+        dropped = np.flatnonzero(drop)
+
+        # Table order, then each old and new row's position in it
+        pair_keys = pack_pair_keys(combined['id1'], combined['id2'])
+        kept = np.flatnonzero(~drop)
+        keys, order = _merge_groups(pair_keys[kept], kept, pair_keys[new_rows], new_rows,
+                                    combined['end'], combined['start'], combined['chrom'])
+        cols = self.columns = {name: values[order] for name, values in combined.items()}
+        position = np.full(num_old + num_new, -1, dtype=row_dtype)
+        position[order] = np.arange(num_rows, dtype=row_dtype)
+        added = position[new_rows]
+        self._pair_matrices = {}
+        self._sequence_rows = {}
+
+        # Pair grouping and statistics: untouched pairs keep theirs
+        old_pair_keys, old_stats = self.pair_keys, self.pair_stats
+        starts, self.pair_offsets = _group_offsets(keys)
+        self.pair_keys = keys[starts]
+        touched = _in_sorted(self.pair_keys, np.unique(pair_keys[np.concatenate([dropped, new_rows])]))
+        carried = np.searchsorted(old_pair_keys, self.pair_keys[~touched])
+        rows, counts = _group_rows(self.pair_offsets, np.flatnonzero(touched))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        recomputed = _pair_stats_kernel(offsets, _sequence_order(offsets, rows, cols['seq']),
+                                        cols['cm'], cols['is_full'], cols['phased'])
+        self.pair_stats = {}
+        for name, values in zip(EMPTY_PAIR_STATS, recomputed):
+            stat = np.zeros(len(self.pair_keys), dtype=values.dtype)
+            stat[~touched] = old_stats[name][carried]
+            stat[touched] = values
+            self.pair_stats[name] = stat
+
+        def regroup(name, new_keys, new_entries, *sort_columns):
+            keys = np.repeat(getattr(self, f'{name}_keys'), np.diff(getattr(self, f'{name}_offsets')))
+            rows = position[getattr(self, f'{name}_rows')]
+            keys, rows = _merge_groups(keys[rows >= 0], rows[rows >= 0], new_keys, new_entries, *sort_columns)
+            starts, offsets = _group_offsets(keys)
+            setattr(self, f'{name}_keys', keys[starts])
+            setattr(self, f'{name}_offsets', offsets)
+            setattr(self, f'{name}_rows', rows.astype(row_dtype))
+
+        regroup('id', np.concatenate([block['id1'], block['id2']]), np.tile(added, 2),
+               cols['end'], cols['start'], cols['chrom'])
+        regroup('chrom', block['chrom'], added, cols['end'], cols['start'], cols['phased'])
+        phased = block['phased']
+        regroup('haplotype', np.concatenate([_haplotype_keys(block['id1'][phased], block['hap1'][phased]),
+                                            _haplotype_keys(block['id2'][phased], block['hap2'][phased])]),
+               np.tile(added[phased], 2), cols['end'], cols['start'], cols['chrom'])
+
+        # Interval blocks: untouched blocks keep their sorted ends
+        old_interval_keys, old_interval_offsets = self.interval_keys, self.interval_offsets
+        old_sorted_ends = self.interval_sorted_ends
+        block_keys = _interval_block_keys(block['chrom'], block['phased'], block['start'], block['end'])
+        touched_blocks = np.unique(np.concatenate([block_keys, _interval_block_keys(
+            old['chrom'][dropped], old['phased'][dropped], old['start'][dropped], old['end'][dropped])]))
+        regroup('interval', block_keys, added, cols['end'], cols['start'])
+        lengths = cols['end'] - cols['start']
+        starts = self.interval_offsets[:-1]
+        self.interval_max_length = (np.maximum.reduceat(lengths[self.interval_rows], starts)
+                                    if len(starts) else np.zeros(0))
+        self.interval_starts = cols['start'][self.interval_rows]
+        self.interval_sorted_ends = cols['end'][self.interval_rows]
+        is_touched = _in_sorted(self.interval_keys, touched_blocks)
+        for block_index, key in enumerate(self.interval_keys.tolist()):
+            first, last = self.interval_offsets[block_index], self.interval_offsets[block_index + 1]
+            if is_touched[block_index]:
+                self.interval_sorted_ends[first:last].sort()
+            else:
+                old_block = _find_group(old_interval_keys, key)
+                self.interval_sorted_ends[first:last] = old_sorted_ends[
+                    old_interval_offsets[old_block]:old_interval_offsets[old_block + 1]]
+
+    def _pair_group(self, id1, id2):
+        """Position of the (id1, id2) pair in the pair grouping, or -1."""
+        code1 = self.id_codes.get(id1)
+        code2 = self.id_codes.get(id2)
+        if code1 is None or code2 is None:
+            return -1
+        return _find_group(self.pair_keys, pack_pair_keys(code1, code2))
+
+    def pair_stat_matrix(self, stat='total'):
+        """
+        Symmetric scipy.sparse CSR matrix of a pair statistic, indexed by
+        individual code (see ``ids``/``id_codes``).
+
+        ``stat`` is any key of ``pair_stats`` or ``'total'`` for
+        total_half + total_full. Matrices are cached until the next rebuild.
+        """
+        self._flush()
+        if stat not in self._pair_matrices:
+            if stat == 'total':
+                values = self.pair_stats['total_half'] + self.pair_stats['total_full']
+            else:
+                values = self.pair_stats[stat]
+            low, high = unpack_pair_keys(self.pair_keys)
+            off_diagonal = low != high
+            rows = np.concatenate([low, high[off_diagonal]])
+            cols = np.concatenate([high, low[off_diagonal]])
+            data = np.concatenate([values, values[off_diagonal]])
+            num_ids = len(self.ids)
+            self._pair_matrices[stat] = sparse.csr_matrix((data, (rows, cols)), shape=(num_ids, num_ids))
+        return self._pair_matrices[stat]
+
+    def _grouped_view(self, rows, offsets, group):
+        if group < 0:
+            return SegmentView(self, rows[:0])
+        return SegmentView(self, rows[offsets[group]:offsets[group + 1]])
+
     def get_segments_for_pair(self, id1, id2):
         """Get all segments shared between a pair of individuals."""
-        pair_key = frozenset({id1, id2})
-        return self.pair_index.get(pair_key, [])
-    
+        self._flush()
+        group = self._pair_group(id1, id2)
+        if group < 0:
+            return SegmentView(self, slice(0, 0))
+        return SegmentView(self, slice(int(self.pair_offsets[group]), int(self.pair_offsets[group + 1])))
+
     def get_stats_for_pair(self, id1, id2):
         """Get IBD statistics for a pair of individuals."""
-        pair_key = frozenset({id1, id2})
-        return self.pair_stats.get(pair_key, {
-            'total_half': 0,
-            'total_full': 0,
-            'num_half': 0,
-            'num_full': 0,
-            'max_seg_cm': 0
-        })
-    
+        self._flush()
+        group = self._pair_group(id1, id2)
+        if group < 0:
+            return dict(EMPTY_PAIR_STATS)
+        return {name: values[group].item() for name, values in self.pair_stats.items()}
+
     def get_segments_by_chromosome(self, chrom):
         """Get all segments on a particular chromosome."""
-        return self.chrom_index.get(chrom, [])
-    
+        self._flush()
+        code = self.chrom_codes.get(chrom, -1)
+        group = _find_group(self.chrom_keys, code) if code >= 0 else -1
+        return self._grouped_view(self.chrom_rows, self.chrom_offsets, group)
+
+    def query_regions(self, chroms, starts, ends, segment_type="unphased"):
+        """
+        Find the segments overlapping each of a batch of regions.
+
+        Regions are closed intervals [start, end] in the coordinates of the
+        chosen layout (bp for unphased, cM for phased segments); ``chroms`` is
+        either one chromosome for the whole batch or one per region. In every
+        length-class block of the chromosome, only segments starting in
+        [start - longest segment of the class, end] are scanned.
+
+        Returns:
+            tuple: (offsets, rows) in CSR form, rows[offsets[i]:offsets[i + 1]]
+                   being the table rows that overlap region i, ordered by
+                   length class and then by start.
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        num_queries = len(starts)
+        query_keys = self._interval_query_keys(chroms, num_queries, segment_type)
+
+        # Candidate window of every (query, block) combination
+        window_queries, window_lo, window_hi = [], [], []
+        for block, selected in self._interval_blocks(query_keys, starts):
+            first, last = self.interval_offsets[block], self.interval_offsets[block + 1]
+            block_starts = self.interval_starts[first:last]
+            reach = starts[selected] - self.interval_max_length[block]
+            window_queries.append(selected)
+            window_lo.append(first + np.searchsorted(block_starts, reach, 'left'))
+            window_hi.append(first + np.searchsorted(block_starts, ends[selected], 'right'))
+        offsets = np.zeros(num_queries + 1, dtype=np.int64)
+        if not window_queries:
+            return offsets, self.interval_rows[:0]
+        lo = np.concatenate(window_lo)
+        counts = np.maximum(np.concatenate(window_hi) - lo, 0)
+
+        # Expand the windows, keep candidates that reach the region start and
+        # group the hits by query
+        query_of_candidate = np.repeat(np.concatenate(window_queries), counts)
+        window_start = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        rows = self.interval_rows[np.arange(counts.sum()) + window_start]
+        hit = self.columns['end'][rows] >= starts[query_of_candidate]
+        rows, query_of_hit = rows[hit], query_of_candidate[hit]
+        order = np.argsort(query_of_hit, kind='stable')
+        np.cumsum(np.bincount(query_of_hit, minlength=num_queries), out=offsets[1:])
+        return offsets, rows[order]
+
+    def count_regions(self, chroms, starts, ends, segment_type="unphased"):
+        """
+        Count the segments overlapping each region without materialising them.
+
+        A segment misses [start, end] only if it ends before start or begins
+        after end, so per block the count is #(seg_start <= end) -
+        #(seg_end < start), two binary searches per region and block.
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        query_keys = self._interval_query_keys(chroms, len(starts), segment_type)
+        counts = np.zeros(len(starts), dtype=np.int64)
+        for block, selected in self._interval_blocks(query_keys, ends):
+            first, last = self.interval_offsets[block], self.interval_offsets[block + 1]
+            counts[selected] += (np.searchsorted(self.interval_starts[first:last], ends[selected], 'right')
+                                 - np.searchsorted(self.interval_sorted_ends[first:last], starts[selected], 'left'))
+        return counts
+
+    def _interval_query_keys(self, chroms, num_queries, segment_type):
+        """Chromosome/layout key (chrom * 2 + phased) of every query, -1 if unknown."""
+        self._flush()
+        if np.ndim(chroms) == 0:
+            codes = np.full(num_queries, self.chrom_codes.get(chroms, -1), dtype=np.int64)
+        else:
+            unique_chroms, inverse = np.unique(np.asarray(chroms), return_inverse=True)
+            lookup = np.array([self.chrom_codes.get(chrom, -1) for chrom in unique_chroms.tolist()], dtype=np.int64)
+            codes = lookup[inverse.ravel()]
+        return np.where(codes >= 0, codes * 2 + (segment_type == "phased"), -1)
+
+    def _interval_blocks(self, query_keys, values):
+        """
+        Yield (block, query indices) for every interval block a batch touches.
+
+        Queries are grouped by chromosome/layout and visited in ``values``
+        order so the binary searches inside a block stay cache friendly.
+        """
+        order = np.lexsort((values, query_keys))
+        sorted_keys = query_keys[order]
+        block_groups = self.interval_keys >> 8
+        for key in np.unique(sorted_keys).tolist():
+            if key < 0:
+                continue
+            selected = order[np.searchsorted(sorted_keys, key, 'left'):np.searchsorted(sorted_keys, key, 'right')]
+            first_block = np.searchsorted(block_groups, key, 'left')
+            last_block = np.searchsorted(block_groups, key, 'right')
+            for block in range(first_block, last_block):
+                yield block, selected
+
+    def get_segments_in_region(self, chrom, start, end, segment_type="unphased"):
+        """Get all segments overlapping chrom:start-end."""
+        _, rows = self.query_regions(chrom, [start], [end], segment_type)
+        return SegmentView(self, rows)
+
+    def get_segments_at_position(self, chrom, position, segment_type="unphased"):
+        """Get all segments covering a single position."""
+        return self.get_segments_in_region(chrom, position, position, segment_type)
+
+    def get_pairs_in_region(self, chrom, start, end, segment_type="unphased"):
+        """Get the sorted (id1, id2) pairs sharing IBD anywhere in chrom:start-end."""
+        view = self.get_segments_in_region(chrom, start, end, segment_type)
+        low, high = unpack_pair_keys(np.unique(pack_pair_keys(view['id1'], view['id2'])))
+        return [(self.ids[a], self.ids[b]) for a, b in zip(low.tolist(), high.tolist())]
+
+    def get_haplotypes_in_region(self, chrom, start, end):
+        """Get the (id, hap) haplotypes carrying phased IBD in chrom:start-end."""
+        view = self.get_segments_in_region(chrom, start, end, segment_type="phased")
+        haplotypes = set(zip(view['id1'].tolist(), view['hap1'].tolist()))
+        haplotypes.update(zip(view['id2'].tolist(), view['hap2'].tolist()))
+        return sorted((self.ids[code], hap) for code, hap in haplotypes)
+
     def get_segments_for_individual(self, individual_id):
         """Get all segments involving a particular individual."""
-        return self.id_index.get(individual_id, [])
-    
+        self._flush()
+        code = self.id_codes.get(individual_id, -1)
+        group = _find_group(self.id_keys, code) if code >= 0 else -1
+        return self._grouped_view(self.id_rows, self.id_offsets, group)
+
     def get_segments_for_haplotype(self, individual_id, haplotype):
         """Get all segments on a specific haplotype (for phased data)."""
-        key = (individual_id, haplotype)
-        return self.haplotype_index.get(key, [])
-    
+        self._flush()
+        code = self.id_codes.get(individual_id, -1)
+        group = _find_group(self.haplotype_keys, (code << 8) | (haplotype & 0xFF)) if code >= 0 else -1
+        return self._grouped_view(self.haplotype_rows, self.haplotype_offsets, group)
+
     def get_total_ibd_between_id_sets(self, id_set1, id_set2):
-        """Calculate total IBD shared between two sets of IDs."""
-        total_ibd = 0
-        
-        for id1 in id_set1:
-            for id2 in id_set2:
-                if id1 == id2:
-                    continue
-                    
-                pair_key = frozenset({id1, id2})
-                if pair_key in self.pair_stats:
-                    stats = self.pair_stats[pair_key]
-                    total_ibd += stats['total_half'] + stats['total_full']
-        
-        return total_ibd
-
-def generate_random_segments(num_individuals, num_segments, phased=False):
+        """
+        Calculate total IBD shared between two sets of IDs.
+
+        Every (id1, id2) combination with id1 != id2 is counted, so a pair
+        present in both sets contributes twice, as before. This is a sum over
+        the id_set1 x id_set2 submatrix of ``pair_stat_matrix('total')``.
+        """
+        self._flush()
+        codes1 = [self.id_codes[id_val] for id_val in id_set1 if id_val in self.id_codes]
+        codes2 = [self.id_codes[id_val] for id_val in id_set2 if id_val in self.id_codes]
+        if not codes1 or not codes2:
+            return 0
+        if len(codes1) + len(codes2) > len(self.ids) // 8:
+            # Large sets touch most pairs anyway: one parallel pass over them
+            return self.set_pair_total(codes1, codes2)
+        return self.submatrix_pair_total(codes1, codes2)
+
+    def submatrix_pair_total(self, codes1, codes2, stat='total'):
+        """
+        Set-vs-set sum of a pair statistic over individual codes taken from
+        the codes1 x codes2 submatrix of ``pair_stat_matrix``, counting every
+        (a, b) combination with a != b like get_total_ibd_between_id_sets.
+        """
+        matrix = self.pair_stat_matrix(stat)
+        total = matrix[codes1][:, codes2].sum()
+        # Segments an individual shares with itself sit on the diagonal and
+        # are skipped, matching the id1 == id2 check of the pairwise loop:
+        # once for every time the individual appears in both sets
+        diagonal = matrix.diagonal()
+        if diagonal.any():
+            counts1 = np.bincount(codes1, minlength=len(self.ids))
+            counts2 = np.bincount(codes2, minlength=len(self.ids))
+            total -= (diagonal * counts1 * counts2).sum()
+        return float(total)
+
+    def shared_matches(self, query_pairs, min_cm=0.0, stat='total'):
+        """
+        Find the third parties sharing at least ``min_cm`` with both members
+        of each (A, B) query pair ("in common with" matches).
+
+        Every query is an element-wise intersection of two rows of the
+        thresholded pair matrix, and the whole batch is one sparse product.
+        Queries naming an unknown individual get no matches.
+
+        Returns:
+            tuple: (offsets, codes, cm_a, cm_b) in CSR form, codes[offsets[i]:
+                   offsets[i + 1]] being the individual codes (see ``ids``)
+                   matching both members of query i, in code order, with the
+                   statistic they share with A and with B.
+        """
+        self._flush()
+        key = (stat, min_cm)
+        if key not in self._pair_matrices:
+            matrix = self.pair_stat_matrix(stat).copy()
+            matrix.data[matrix.data < min_cm] = 0
+            matrix.eliminate_zeros()
+            self._pair_matrices[key] = matrix
+        matrix = self._pair_matrices[key]
+
+        codes = np.array([[self.id_codes.get(id_val, -1) for id_val in pair] for pair in query_pairs],
+                         dtype=np.int64).reshape(-1, 2)
+        known = (codes >= 0).all(axis=1)
+        codes_a, codes_b = np.where(known, codes[:, 0], 0), np.where(known, codes[:, 1], 0)
+        rows_a, rows_b = matrix[codes_a], matrix[codes_b]
+        both = rows_a.multiply(rows_b).tocoo()
+
+        # Drop unknown queries and the query members themselves
+        queries, matches = both.row, both.col
+        keep = known[queries] & (matches != codes_a[queries]) & (matches != codes_b[queries])
+        queries, matches = queries[keep], matches[keep]
+        order = np.lexsort((matches, queries))
+        queries, matches = queries[order], matches[order]
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(queries, minlength=len(codes)), out=offsets[1:])
+        cm_a = np.asarray(rows_a[queries, matches]).ravel()
+        cm_b = np.asarray(rows_b[queries, matches]).ravel()
+        return offsets, matches.astype(np.int32), cm_a, cm_b
+
+    def get_shared_matches(self, id_a, id_b, min_cm=0.0):
+        """Get the (id, cM with A, cM with B) matches both individuals share, strongest first."""
+        _, codes, cm_a, cm_b = self.shared_matches([(id_a, id_b)], min_cm)
+        matches = [(self.ids[code], a, b) for code, a, b in zip(codes.tolist(), cm_a.tolist(), cm_b.tolist())]
+        return sorted(matches, key=lambda match: -min(match[1], match[2]))
+
+    def set_pair_total(self, codes1, codes2, stat='total'):
+        """
+        Compiled set-vs-set sum of a pair statistic over individual codes,
+        counting every (a, b) combination with a != b like
+        get_total_ibd_between_id_sets.
+        """
+        self._flush()
+        if stat == 'total':
+            values = self.pair_stats['total_half'] + self.pair_stats['total_full']
+        else:
+            values = self.pair_stats[stat].astype(np.float64)
+        counts1 = np.bincount(np.asarray(codes1, dtype=np.int64), minlength=len(self.ids))
+        counts2 = np.bincount(np.asarray(codes2, dtype=np.int64), minlength=len(self.ids))
+        return float(_set_pair_sum_kernel(self.pair_keys, values, counts1, counts2))
+
+    def _rows_in_sequence(self, name):
+        """
+        Rows of the ``name`` grouping ('id' or 'haplotype') reordered by
+        insertion sequence within each group, cached until the next change.
+        """
+        if name not in self._sequence_rows:
+            self._sequence_rows[name] = _sequence_order(
+                getattr(self, f'{name}_offsets'), getattr(self, f'{name}_rows'), self.columns['seq'])
+        return self._sequence_rows[name]
+
+    def individual_total_cm(self, segment_type="unphased"):
+        """
+        Total cM and number of segments each individual shares, as arrays
+        indexed by individual code (see ``ids``). Each total adds the
+        individual's segments in the order they were inserted.
+        """
+        self._flush()
+        group_totals, group_counts = _grouped_cm_kernel(
+            self.id_offsets, self._rows_in_sequence('id'), self.columns['cm'], self.columns['phased'],
+            segment_type == "phased")
+        totals = np.zeros(len(self.ids))
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        totals[self.id_keys] = group_totals
+        counts[self.id_keys] = group_counts
+        return totals, counts
+
+    def haplotype_total_cm(self):
+        """Total cM and number of phased segments on every haplotype, as {(id, hap): (cM, count)}."""
+        self._flush()
+        totals, counts = _grouped_cm_kernel(
+            self.haplotype_offsets, self._rows_in_sequence('haplotype'), self.columns['cm'],
+            self.columns['phased'], True)
+        codes = (self.haplotype_keys >> 8).tolist()
+        haps = (self.haplotype_keys & 0xFF).astype(np.int8).tolist()
+        return {(self.ids[code], hap): (total, count)
+                for code, hap, total, count in zip(codes, haps, totals.tolist(), counts.tolist())}
+
+    def _haplotype_pairings(self):
+        """
+        Per row: (hap of the lower-coded individual, hap of the other), and
+        the coverage class bits of the row (see _coverage_kernel).
+
+        Haplotypes are told apart by parity, which works for both 0/1 and
+        hap-IBD's 1/2 numbering.
+        """
+        cols = self.columns
+        low_first = cols['id1'] <= cols['id2']
+        hap_low = np.where(low_first, cols['hap1'], cols['hap2'])
+        hap_high = np.where(low_first, cols['hap2'], cols['hap1'])
+        pairing = (hap_low & 1) * 2 + (hap_high & 1)
+        classes = np.where(cols['phased'], np.left_shift(1, pairing), np.where(cols['is_full'], 0b1001, 0b0001))
+        return hap_low, hap_high, pairing, classes.astype(np.int8)
+
+    def _coverage(self, offsets, rows, classes, segment_type):
+        cols = self.columns
+        return _coverage_kernel(offsets, rows, cols['chrom'], cols['start'], cols['end'], classes,
+                                cols['phased'], segment_type == "phased")
+
+    def pair_coverage(self, segment_type="unphased"):
+        """
+        Non-overlapping IBD shared by every pair, split into IBD1 and IBD2.
+
+        Overlapping calls are counted once. For unphased segments IBD2 is the
+        stretch covered by IBD2 calls; for phased segments it is where both
+        haplotypes of each individual are IBD (overlapping 1-1/2-2 or 1-2/2-1
+        haplotype pairings).
+
+        Returns:
+            dict: {'covered', 'ibd1', 'ibd2'} arrays aligned with ``pair_keys``,
+                  in layout units (bp for unphased, cM for phased segments).
+        """
+        self._flush()
+        _, _, _, classes = self._haplotype_pairings()
+        rows = np.arange(len(self.columns['cm']), dtype=_row_dtype(len(self.columns['cm'])))
+        covered, ibd2 = self._coverage(self.pair_offsets, rows, classes, segment_type)
+        return {'covered': covered, 'ibd1': covered - ibd2, 'ibd2': ibd2}
+
+    def haplotype_coverage_cm(self):
+        """Non-overlapping phased IBD on every haplotype, as {(id, hap): cM}."""
+        self._flush()
+        _, _, _, classes = self._haplotype_pairings()
+        covered, _ = self._coverage(self.haplotype_offsets, self.haplotype_rows, classes, "phased")
+        codes = (self.haplotype_keys >> 8).tolist()
+        haps = (self.haplotype_keys & 0xFF).astype(np.int8).tolist()
+        return {(self.ids[code], hap): total for code, hap, total in zip(codes, haps, covered.tolist())}
+
+    def haplotype_pair_coverage_cm(self):
+        """
+        Non-overlapping phased IBD between every pair of haplotypes, as
+        {(id1, hap1, id2, hap2): cM} with id1 the lower-coded individual.
+        """
+        self._flush()
+        hap_low, hap_high, pairing, classes = self._haplotype_pairings()
+        phased_rows = np.flatnonzero(self.columns['phased'])
+        pair_index = np.repeat(np.arange(len(self.pair_keys)), np.diff(self.pair_offsets))[phased_rows]
+        keys = pair_index * 4 + pairing[phased_rows]
+        order = np.argsort(keys, kind='stable')
+        rows = phased_rows[order]
+        starts, offsets = _group_offsets(keys[order])
+        covered, _ = self._coverage(offsets, rows, classes, "phased")
+        low, high = unpack_pair_keys(self.pair_keys[pair_index[order][starts]])
+        first_rows = rows[starts]
+        return {(self.ids[a], hap1, self.ids[b], hap2): total
+                for a, hap1, b, hap2, total in zip(low.tolist(), hap_low[first_rows].tolist(), high.tolist(),
+                                                    hap_high[first_rows].tolist(), covered.tolist())}
+
+# Approximate GRCh38 autosome lengths in bp and sex-averaged genetic lengths in cM
+CHROMOSOME_LENGTHS_BP = [
+    248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973, 145138636,
+    138394717, 133797422, 135086622, 133275309, 114364328, 107043718, 101991189, 90338345,
+    83257441, 80373285, 58617616, 64444167, 46709983, 50818468,
+]
+CHROMOSOME_LENGTHS_CM = [
+    284, 269, 223, 214, 204, 192, 187, 168, 166, 181, 159,
+    172, 126, 118, 141, 134, 128, 117, 107, 108, 62, 73,
+]
+
+# (num_individuals, num_segments) combinations run by benchmark_ibd_index
+BENCHMARK_SIZES = [
+    (100, 1_000),
+    (1_000, 10_000),
+    (10_000, 100_000),
+    (30_000, 1_000_000),
+    (100_000, 10_000_000),
+]
+
+def generate_random_columns(num_individuals, num_segments, phased=False, seed=None):
+    """
+    Draw random IBD segments as numpy columns.
+
+    Chromosomes are chosen in proportion to their genetic length, segment
+    lengths follow the roughly exponential tail seen above the 7 cM detection
+    threshold, and positions are placed uniformly inside the chromosome with
+    a constant bp-per-cM rate. About 20% of unphased segments are IBD2.
+    """
+    rng = np.random.default_rng(seed)
+    chrom_cm = np.array(CHROMOSOME_LENGTHS_CM, dtype=np.float64)
+    bp_per_cm = np.array(CHROMOSOME_LENGTHS_BP, dtype=np.float64) / chrom_cm
+
+    # Choose random pairs of distinct individuals
+    id1 = rng.integers(1, num_individuals + 1, num_segments)
+    id2 = (id1 + rng.integers(0, num_individuals - 1, num_segments)) % num_individuals + 1
+
+    # Generate random segment attributes
+    chrom_index = rng.choice(len(chrom_cm), size=num_segments, p=chrom_cm / chrom_cm.sum())
+    length_cm = np.minimum(7.0 + rng.exponential(12.0, num_segments), chrom_cm[chrom_index])
+    start_cm = rng.uniform(0.0, 1.0, num_segments) * (chrom_cm[chrom_index] - length_cm)
+    end_cm = start_cm + length_cm
+
+    columns = {'id1': id1, 'id2': id2, 'chrom': chrom_index + 1, 'cm': length_cm}
+    if phased:
+        columns['hap1'] = rng.integers(0, 2, num_segments)
+        columns['hap2'] = rng.integers(0, 2, num_segments)
+        columns['start'] = start_cm
+        columns['end'] = end_cm
+    else:
+        columns['start'] = np.round(start_cm * bp_per_cm[chrom_index]).astype(np.int64) + 1
+        columns['end'] = np.round(end_cm * bp_per_cm[chrom_index]).astype(np.int64)
+        columns['is_full'] = rng.random(num_segments) < 0.2
+    return columns
+
+def generate_random_segments(num_individuals, num_segments, phased=False, seed=None):
     """Generate random IBD segments for benchmarking."""
-    segments = []
-    
-    for _ in range(num_segments):
-        # Choose random individuals
-        id1, id2 = random.sample(range(1, num_individuals + 1), 2)
-        
-        # Generate random segment attributes
-        chrom = random.randint(1, 22)
-        start_pos = random.randint(1, 200_000_000)
-        end_pos = start_pos + random.randint(1_000_000, 50_000_000)
-        is_ibd2 = random.random() < 0.2  # 20% chance of IBD2
-        length_cm = random.uniform(7.0, 100.0)  # Random length between 7 and 100 cM
-        
-        if not phased:
-            # Unphased format
-            segments.append([id1, id2, chrom, start_pos, end_pos, is_ibd2, length_cm])
+    cols = {name: values.tolist() for name, values in
+            generate_random_columns(num_individuals, num_segments, phased, seed).items()}
+    if not phased:
+        # Unphased format
+        return [list(row) for row in zip(cols['id1'], cols['id2'], cols['chrom'], cols['start'],
+                                         cols['end'], cols['is_full'], cols['cm'])]
+    # Phased format (add haplotype info)
+    return [list(row) for row in zip(cols['id1'], cols['id2'], cols['hap1'], cols['hap2'],
+                                     cols['chrom'], cols['start'], cols['end'], cols['cm'])]
+
+def reference_aggregates(segments, min_cm=7.0):
+    """
+    Pair statistics and per-individual totals of unphased segments, built the
+    way the original dict-based index did: replaying the segments in
+    insertion order and accumulating into plain dicts.
+
+    Returns ({frozenset({id1, id2}): stats}, {id: total cM}).
+    """
+    pair_stats = {}
+    individual_totals = {}
+    for id1, id2, chrom, start, end, is_full, seg_cm in segments:
+        if seg_cm < min_cm:
+            continue
+        stats = pair_stats.setdefault(frozenset({id1, id2}), dict(EMPTY_PAIR_STATS))
+        if is_full:
+            stats['total_full'] += seg_cm
+            stats['num_full'] += 1
         else:
-            # Phased format (add haplotype info)
-            hap1 = random.randint(0, 1)
-            hap2 = random.randint(0, 1)
-            segments.append([id1, id2, hap1, hap2, chrom, start_pos/1_000_000, end_pos/1_000_000, length_cm])
-    
-    return segments
+            stats['total_half'] += seg_cm
+            stats['num_half'] += 1
+        stats['max_seg_cm'] = max(stats['max_seg_cm'], seg_cm)
+        for id_val in [id1, id2]:
+            individual_totals[id_val] = individual_totals.get(id_val, 0.0) + seg_cm
+    return pair_stats, individual_totals
+
+def verify_kernels(index, unphased_segments):
+    """
+    Assert that the compiled pair and individual aggregates of ``index`` match
+    reference_aggregates over the unphased segments it was built from bit for
+    bit: the kernels add each group's segments in insertion order too.
+    """
+    index._flush()
+    pair_stats, individual_totals = reference_aggregates(unphased_segments, index.min_cm)
+    low, high = unpack_pair_keys(index.pair_keys)
+    for group, (code1, code2) in enumerate(zip(low.tolist(), high.tolist())):
+        expected = pair_stats.get(frozenset({index.ids[code1], index.ids[code2]}), EMPTY_PAIR_STATS)
+        for name, value in expected.items():
+            assert index.pair_stats[name][group].item() == value, f"pair statistic {name} differs"
+    assert len(pair_stats) == int(((index.pair_stats['num_half'] + index.pair_stats['num_full']) > 0).sum()), \
+        "pairs with unphased segments differ"
+
+    totals = index.individual_total_cm()[0]
+    for id_val, value in individual_totals.items():
+        assert totals[index.id_codes[id_val]] == value, "individual totals differ"
+    assert np.count_nonzero(totals) == len(individual_totals), "individuals with unphased segments differ"
+
+def verify_id_set_totals(index, id_sets):
+    """
+    Assert that both paths of get_total_ibd_between_id_sets
+    (submatrix_pair_total and set_pair_total) agree with the pairwise loop,
+    duplicate IDs in a set counting once per listing.
+    """
+    for id_set1, id_set2 in id_sets:
+        expected = 0.0
+        for id1 in id_set1:
+            for id2 in id_set2:
+                if id1 != id2:
+                    stats = index.get_stats_for_pair(id1, id2)
+                    expected += stats['total_half'] + stats['total_full']
+        codes1 = [index.id_codes[id_val] for id_val in id_set1 if id_val in index.id_codes]
+        codes2 = [index.id_codes[id_val] for id_val in id_set2 if id_val in index.id_codes]
+        for name, total in (('submatrix_pair_total', index.submatrix_pair_total),
+                            ('set_pair_total', index.set_pair_total)):
+            value = total(codes1, codes2)
+            assert np.isclose(value, expected, rtol=1e-9, atol=1e-9), \
+                f"{name} total {value} for {id_set1} x {id_set2} differs from {expected}"
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MiB."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _timed(results, name, num_ops, func):
+    """Run func once, recording seconds and operations per second under name."""
+    start_time = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start_time
+    results[f'{name}_seconds'] = elapsed
+    results[f'{name}_per_second'] = num_ops / elapsed if elapsed > 0 else float('inf')
+    return value
+
+def benchmark_size(num_individuals, num_segments, num_queries=1000, seed=0):
+    """
+    Benchmark one index size: build time, query throughput for every access
+    pattern, index memory and the peak RSS of the process.
+
+    Meant to run in a fresh process (see run_benchmarks) so that peak RSS
+    belongs to this size alone.
+    """
+    rng = np.random.default_rng(seed)
+    results = {'num_individuals': num_individuals, 'num_segments': num_segments, 'num_queries': num_queries}
+
+    segments = {
+        'unphased': generate_random_segments(num_individuals, num_segments // 2, seed=seed),
+        'phased': generate_random_segments(num_individuals, num_segments - num_segments // 2,
+                                           phased=True, seed=seed + 1),
+    }
+
+    # Load the compiled kernels before anything is timed
+    warm_up = IBDIndex()
+    warm_up.add_segments(generate_random_segments(10, 10, seed=seed))
+    warm_up.individual_total_cm()
+    warm_up.haplotype_total_cm()
+    warm_up.set_pair_total([0], [1])
+    warm_up.pair_coverage()
+
+    def build():
+        # Popping the lists drops their last reference once they are indexed,
+        # so they do not count towards the peak RSS of the queries below
+        index = IBDIndex()
+        for segment_type in ("unphased", "phased"):
+            index.add_segments(segments.pop(segment_type), segment_type)
+        len(index)
+        return index
+
+    index = _timed(results, 'build', num_segments, build)
+    index_bytes = sum(values.nbytes for values in index._named_arrays().values())
+    results['index_bytes_per_segment'] = index_bytes / max(len(index), 1)
+
+    ids = rng.integers(1, num_individuals + 1, (num_queries, 2)).tolist()
+    haps = rng.integers(0, 2, num_queries).tolist()
+    _timed(results, 'pair_lookup', num_queries,
+           lambda: [len(index.get_segments_for_pair(a, b)) for a, b in ids])
+    _timed(results, 'pair_stats', num_queries,
+           lambda: [index.get_stats_for_pair(a, b) for a, b in ids])
+    _timed(results, 'individual_lookup', num_queries,
+           lambda: [len(index.get_segments_for_individual(a)) for a, _ in ids])
+    _timed(results, 'haplotype_lookup', num_queries,
+           lambda: [len(index.get_segments_for_haplotype(a, h)) for (a, _), h in zip(ids, haps)])
+
+    # Set-vs-set totals over sets of about 1% of the cohort
+    set_size = max(5, num_individuals // 100)
+    num_set_queries = max(1, num_queries // 100)
+    id_sets = [(set(rng.integers(1, num_individuals + 1, set_size).tolist()),
+                set(rng.integers(1, num_individuals + 1, set_size).tolist()))
+               for _ in range(num_set_queries)]
+    _timed(results, 'set_vs_set', num_set_queries,
+           lambda: [index.get_total_ibd_between_id_sets(a, b) for a, b in id_sets])
+
+    # Batched in-common-with queries over the query pairs
+    _timed(results, 'shared_matches', num_queries, lambda: index.shared_matches(ids, 20.0))
+
+    # Compiled whole-cohort aggregations
+    _timed(results, 'individual_totals', len(index), index.individual_total_cm)
+    _timed(results, 'haplotype_totals', len(index), index.haplotype_total_cm)
+    _timed(results, 'pair_coverage', len(index), index.pair_coverage)
+    _timed(results, 'haplotype_coverage', len(index), index.haplotype_coverage_cm)
+
+    # Batched 1 Mb region queries on unphased segments
+    chroms = rng.integers(1, 23, num_queries)
+    starts = rng.uniform(0, 1, num_queries) * np.array(CHROMOSOME_LENGTHS_BP)[chroms - 1]
+    _timed(results, 'region_query', num_queries,
+           lambda: index.query_regions(chroms, starts, starts + 1_000_000))
+    _timed(results, 'region_count', num_queries,
+           lambda: index.count_regions(chroms, starts, starts + 1_000_000))
+
+    results['peak_rss_mb'] = _peak_rss_mb()
+    return results
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, num_queries=1000, seed=0):
+    """Run benchmark_size for every (num_individuals, num_segments) in a fresh process."""
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for num_individuals, num_segments in sizes:
+        print(f"Benchmarking {num_segments:,} segments for {num_individuals:,} individuals...")
+        with context.Pool(1) as pool:
+            result = pool.apply(benchmark_size, (num_individuals, num_segments, num_queries, seed))
+        print(f"  build {result['build_seconds']:.3f}s, "
+              f"{result['index_bytes_per_segment']:.1f} bytes/segment, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MiB")
+        results.append(result)
+    return results
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """
+    Compare results against a stored baseline run of the same sizes.
+
+    Any timing or peak RSS more than ``tolerance`` (fractional) above the
+    baseline value for the same size is reported.
+
+    Returns:
+        list: Human-readable description of every regression found.
+    """
+    baseline_by_size = {(run['num_individuals'], run['num_segments']): run for run in baseline['results']}
+    regressions = []
+    for run in results:
+        base = baseline_by_size.get((run['num_individuals'], run['num_segments']))
+        if base is None:
+            continue
+        for metric, value in run.items():
+            if not (metric.endswith('_seconds') or metric == 'peak_rss_mb') or metric not in base:
+                continue
+            if value > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{run['num_segments']:,} segments / {run['num_individuals']:,} individuals: "
+                    f"{metric} {value:.4f} vs baseline {base[metric]:.4f} "
+                    f"(+{(value / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
 
 # Benchmark the IBD index
-def benchmark_ibd_index():
-    # Reduced dataset size for faster execution in the notebook environment
-    num_individuals = 50  # Reduced from 500
-    num_segments = 1000   # Reduced from 10000
-    
-    print(f"Generating {num_segments} random segments for {num_individuals} individuals...")
-    unphased_segments = generate_random_segments(num_individuals, num_segments)
-    phased_segments = generate_random_segments(num_individuals, num_segments, phased=True)
-    
-    # Time index creation
-    print("\nBenchmarking index creation...")
-    start_time = time.time()
-    index = IBDIndex()
-    index.add_segments(unphased_segments, "unphased")
-    index.add_segments(phased_segments, "phased")
-    end_time = time.time()
-    print(f"Time to build index: {end_time - start_time:.4f} seconds")
-    
-    # Time pair lookup
-    print("\nBenchmarking pair lookup (100 random pairs)...")
-    start_time = time.time()
-    lookup_count = 0
-    for _ in range(100):  # Reduced from 1000
-        id1, id2 = random.sample(range(1, num_individuals + 1), 2)
-        segments = index.get_segments_for_pair(id1, id2)
-        if segments:
-            lookup_count += 1
-    end_time = time.time()
-    print(f"Time for 100 pair lookups: {end_time - start_time:.4f} seconds")
-    print(f"Average time per lookup: {(end_time - start_time) / 100:.6f} seconds")
-    print(f"Found segments for {lookup_count}/100 pairs")
-    
-    # Time individual lookup
-    print("\nBenchmarking individual lookup (100 random individuals)...")
-    start_time = time.time()
-    ind_count = 0
-    for _ in range(100):  # Reduced from 1000
-        id1 = random.randint(1, num_individuals)
-        segments = index.get_segments_for_individual(id1)
-        if segments:
-            ind_count += 1
-    end_time = time.time()
-    print(f"Time for 100 individual lookups: {end_time - start_time:.4f} seconds")
-    print(f"Average time per lookup: {(end_time - start_time) / 100:.6f} seconds")
-    print(f"Found segments for {ind_count}/100 individuals")
-    
-    # Time ID set calculations
-    print("\nBenchmarking ID set calculations (10 random set pairs)...")
-    start_time = time.time()
-    set_count = 0
-    for _ in range(10):  # Reduced from 100
-        set1 = set(random.sample(range(1, num_individuals + 1), 5))  # Reduced size
-        set2 = set(random.sample(range(1, num_individuals + 1), 5))  # Reduced size
-        total_ibd = index.get_total_ibd_between_id_sets(set1, set2)
-        if total_ibd > 0:
-            set_count += 1
-    end_time = time.time()
-    print(f"Time for 10 ID set calculations: {end_time - start_time:.4f} seconds")
-    print(f"Average time per calculation: {(end_time - start_time) / 10:.6f} seconds")
-    print(f"Found IBD between {set_count}/10 set pairs")
-    
-    return index
+def benchmark_ibd_index(sizes=BENCHMARK_SIZES, output=None, baseline=None, tolerance=0.25, num_queries=1000):
+    """
+    Run the scaling benchmark, optionally writing the results to ``output``
+    as JSON and flagging regressions against a ``baseline`` JSON file.
+
+    Returns:
+        tuple: (report dict, list of regression messages)
+    """
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'results': run_benchmarks(sizes, num_queries=num_queries),
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to: {output}")
+
+    regressions = []
+    if baseline and os.path.exists(baseline):
+        with open(baseline, 'r') as f:
+            regressions = find_regressions(report['results'], json.load(f), tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {baseline}:")
+            for message in regressions:
+                print(f"  {message}")
+        else:
+            print(f"\nNo regressions against {baseline}")
+    return report, regressions
 
 if __name__ == "__main__":
-    print("Testing IBDIndex class with frozenset...")
-    index = benchmark_ibd_index()
-    print("Benchmark completed successfully!")
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Scaling benchmark for the columnar IBDIndex")
+    parser.add_argument('--max-segments', type=int, default=1_000_000,
+                        help='Largest benchmark size to run (sizes go up to 10,000,000).')
+    parser.add_argument('--queries', type=int, default=1000, help='Number of queries per access pattern.')
+    parser.add_argument('--output', type=str, help='Path of the JSON results file to write.')
+    parser.add_argument('--baseline', type=str, help='Baseline JSON results file to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fractional slowdown over the baseline reported as a regression.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the compiled kernels against the pure-Python aggregates first.')
+    args = parser.parse_args()
+
+    if args.verify:
+        print("Verifying compiled kernels against pure-Python aggregates...")
+        unphased_segments = generate_random_segments(1_000, 50_000, seed=0)
+        index = IBDIndex()
+        index.add_segments(unphased_segments, "unphased")
+        index.add_segments(generate_random_segments(1_000, 50_000, phased=True, seed=1), "phased")
+        verify_kernels(index, unphased_segments)
+        print("Kernels match the insertion-order reference bit for bit.")
+
+        # Duplicate IDs and a segment an individual shares with itself
+        index = IBDIndex()
+        index.add_segments(generate_random_segments(20, 500, seed=2), "unphased")
+        index.add_segments([[1, 1, 3, 1_000_000, 9_000_000, False, 12.5]], "unphased")
+        # Segments added since the last query must be seen without an explicit flush
+        index.add_segments([[1, 21, 4, 1_000_000, 9_000_000, False, 30.0]], "unphased")
+        assert index.get_total_ibd_between_id_sets([21], [1]) == 30.0, "pending segments not flushed"
+        verify_id_set_totals(index, [([1, 1], [1, 1]), ([1, 1, 2], [1, 2]), ([1, 2, 3, 3], [3, 1, 4]),
+                                     (list(range(1, 21)) * 2, list(range(1, 21)))])
+        print("Set-vs-set totals match the pairwise loop.")
+
+    sizes = [size for size in BENCHMARK_SIZES if size[1] <= args.max_segments]
+    _, regressions = benchmark_ibd_index(sizes, args.output, args.baseline, args.tolerance, args.queries)
+    sys.exit(1 if regressions else 0)